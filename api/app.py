@@ -5,11 +5,16 @@ from flask_restful import Api
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
 
+from api.common.cache import make_cache
+from api.common.kmers import SequenceIndex
+from api.common.utils import compile_serializers
 from api.config import app_config
 from api.db import init_db
-from api.resources import (Divers, DiveSites, Extracts, Fractions, Heartbeat,
-                           Isolates, Libraries, MediaEP, Permits, PermitsFile,
-                           Samples, SampleTypes, ScreenPlates, Summary)
+from api.resources import (Divers, DiveSites, Extracts, FractionNames,
+                           Fractions, Heartbeat, Import, Isolates, Libraries,
+                           MediaEP, Permits, PermitsFile, Samples, SampleTypes,
+                           ScreenPlateLayout, ScreenPlates, Search,
+                           SimilarIsolates, Stats, Summary)
 
 
 def create_app(config_name):
@@ -17,7 +22,10 @@ def create_app(config_name):
     app.config.from_object(app_config[config_name])
     api = Api(app)
     init_db(app)
-    
+    compile_serializers()
+    app.response_cache = make_cache(app.config)
+    app.sequence_index = SequenceIndex(app.config['SEQUENCE_INDEX_FILE'])
+
     # TODO: Implement collections
 
     # Simple collections + resources
@@ -27,7 +35,10 @@ def create_app(config_name):
     api.add_resource(DiveSites, '/api/v1/divesites', '/api/v1/divesites/<string:id>')
     api.add_resource(Extracts, '/api/v1/extracts', '/api/v1/extracts/<string:id>')
     api.add_resource(Fractions, '/api/v1/fractions', '/api/v1/fractions/<string:id>')
+    api.add_resource(FractionNames, '/api/v1/fractions/resolve')
+    api.add_resource(Import, '/api/v1/import/<string:resource>')
     api.add_resource(Isolates, '/api/v1/isolates', '/api/v1/isolates/<string:id>')
+    api.add_resource(SimilarIsolates, '/api/v1/isolates/similar')
     api.add_resource(Libraries, '/api/v1/libraries', '/api/v1/libraries/<string:id>')
     api.add_resource(MediaEP, '/api/v1/media', '/api/v1/media/<string:id>')
     api.add_resource(Permits, '/api/v1/permits', '/api/v1/permits/<string:id>')
@@ -39,6 +50,9 @@ def create_app(config_name):
     )
     api.add_resource(SampleTypes, '/api/v1/sampletypes', '/api/v1/sampletypes/<string:id>')
     api.add_resource(ScreenPlates, '/api/v1/screenplates', '/api/v1/screenplates/<string:id>')
+    api.add_resource(ScreenPlateLayout, '/api/v1/screenplates/<string:id>/layout')
+    api.add_resource(Stats, '/api/v1/stats/<string:resource>')
+    api.add_resource(Search, '/api/v1/search')
 
     from .auth import auth_blueprint
     app.register_blueprint(auth_blueprint)
@@ -0,0 +1,183 @@
+"""ASGI serving mode
+
+Serves the app of `create_app` from an ASGI server, e.g.
+
+    gunicorn -k uvicorn.workers.UvicornWorker -w 4 "api.asgi:create_asgi_app('production')"
+
+Request bodies are received on the event loop before the request runs,
+so slow uploads and idle connections do not hold a thread. Requests run
+in a pool of `ASGI_THREADS` threads, where the thread-local sessions
+work as under WSGI. A streamed response is produced by the thread that
+ran its request, as it needs the request context and session. That
+thread only waits for the client once `ASGI_SEND_BUFFER` chunks are
+queued.
+"""
+import asyncio
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from api.app import create_app
+
+# Request bodies above this size are spooled to disk
+BODY_MEMORY_MAX = 1024 * 1024
+
+
+def build_environ(scope, body):
+    """WSGI environ of an ASGI http scope, `body` a file of the request body"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    # The whole body was received, chunked uploads included
+    environ['CONTENT_LENGTH'] = str(body.seek(0, 2))
+    body.seek(0)
+    return environ
+
+
+class AsgiAdapter(object):
+    """ASGI application running a WSGI application in a thread pool"""
+
+    def __init__(self, wsgi_app, threads=16, send_buffer=16):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='asgi')
+        self.send_buffer = send_buffer
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        body = tempfile.SpooledTemporaryFile(BODY_MEMORY_MAX)
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            environ = build_environ(scope, body)
+            await self.respond(environ, send)
+        finally:
+            body.close()
+
+    async def respond(self, environ, send):
+        loop = asyncio.get_running_loop()
+        messages = asyncio.Queue()
+        # Chunks the request thread may queue before waiting for the client
+        credits = threading.Semaphore(self.send_buffer)
+        closed = threading.Event()
+
+        def put(message):
+            credits.acquire()
+            if closed.is_set():
+                raise ConnectionAbortedError
+            loop.call_soon_threadsafe(messages.put_nowait, message)
+
+        def run():
+            response = {}
+
+            def write(data):
+                # Headers are sent with the first chunk, as late as possible
+                if 'sent' not in response:
+                    put([response['status'], response['headers']])
+                    response['sent'] = True
+                if data:
+                    put(data)
+
+            def start_response(status, headers, exc_info=None):
+                if exc_info and 'sent' in response:
+                    raise exc_info[1].with_traceback(exc_info[2])
+                response.update(status=status, headers=headers)
+                return write
+
+            result = self.wsgi_app(environ, start_response)
+            try:
+                for chunk in result:
+                    write(chunk)
+                write(b'')
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+
+        def done(future):
+            # The request thread stops with ConnectionAbortedError once closed
+            if closed.is_set() and not future.cancelled():
+                future.exception()
+            messages.put_nowait(None)
+
+        future = loop.run_in_executor(self.executor, run)
+        future.add_done_callback(done)
+        try:
+            started = False
+            while True:
+                message = await messages.get()
+                if message is None:
+                    break
+                credits.release()
+                if isinstance(message, list):
+                    status, headers = message
+                    await send({
+                        'type': 'http.response.start',
+                        'status': int(status.split(' ', 1)[0]),
+                        'headers': [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in headers],
+                    })
+                    started = True
+                else:
+                    await send({'type': 'http.response.body', 'body': message, 'more_body': True})
+            await future
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        except Exception:
+            if not future.done() or started:
+                raise
+            await send({'type': 'http.response.start', 'status': 500,
+                        'headers': [(b'content-type', b'application/json')]})
+            await send({'type': 'http.response.body', 'body': b'{"message": "Internal Server Error"}'})
+        finally:
+            # Stops the request thread if the client went away
+            closed.set()
+            for _ in range(self.send_buffer):
+                credits.release()
+
+
+def create_asgi_app(config_name):
+    app = create_app(config_name)
+    return AsgiAdapter(app, app.config['ASGI_THREADS'], app.config['ASGI_SEND_BUFFER'])
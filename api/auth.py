@@ -1,9 +1,15 @@
 import os
 import datetime
+import hashlib
+import sqlite3
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
 
 import jwt
 from functools import wraps
-from flask import Blueprint, current_app, jsonify, request, abort
+from flask import Blueprint, current_app, g, jsonify, request, abort
 
 from api.db import session_scope
 from api.models import User, UserToken
@@ -20,45 +26,220 @@ except FileNotFoundError as e:
     PUBLIC_KEY = PRIVATE_KEY
     ALGORITHM = "HS256"
 
-def token_is_valid(token):
+def decode_token(token):
+    """Decode and verify a JWT
+
+    returns: token claims or None if invalid
+    """
     try:
-        _ = jwt.decode(token, key=PUBLIC_KEY, algorithm=ALGORITHM)
+        return jwt.decode(token, key=PUBLIC_KEY, algorithm=ALGORITHM)
     except jwt.ExpiredSignatureError:
-        return False
+        return None
     except jwt.InvalidSignatureError:
-        return False
-    return True
+        return None
+
+
+def token_is_valid(token):
+    return decode_token(token) is not None
+
+
+class TokenCache(object):
+    """Per-worker LRU cache of token identities
+
+    Entries are keyed by token digest and expire after a TTL or when
+    the token itself expires, whichever comes first. The token id is
+    kept with the identity so hits can be checked against revocations.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token):
+        key = self.key(token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            identity, jti, expires = entry
+            if expires <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return identity, jti
+
+    def set(self, token, identity, jti, expires, maxsize):
+        key = self.key(token)
+        with self.lock:
+            self.entries[key] = (identity, jti, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, token):
+        with self.lock:
+            self.entries.pop(self.key(token), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+TOKEN_CACHE = TokenCache()
+
+
+class RevocationList(object):
+    """Revoked token ids shared by all workers through a SQLite file
+
+    Each worker keeps the unexpired revoked `jti`s in memory and reads
+    rows added since its last refresh at most every `refresh` seconds.
+    """
+
+    def __init__(self, path, refresh=1):
+        self.path = path
+        self.refresh = refresh
+        self.revoked = {}
+        self.last_id = 0
+        self.checked = 0
+        self.lock = Lock()
+        conn = self.connect()
+        try:
+            with conn:
+                # AUTOINCREMENT so ids of purged rows are never reused
+                conn.execute("CREATE TABLE IF NOT EXISTS revoked (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                    "jti TEXT NOT NULL UNIQUE, exp INTEGER NOT NULL)")
+        finally:
+            conn.close()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def revoke(self, jti, exp):
+        now = int(time.time())
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO revoked (jti, exp) VALUES (?, ?)", (jti, exp))
+                # Expired tokens are rejected anyway
+                conn.execute("DELETE FROM revoked WHERE exp < ?", (now,))
+        finally:
+            conn.close()
+        with self.lock:
+            self.revoked[jti] = exp
+
+    def load(self):
+        now = time.time()
+        conn = self.connect()
+        try:
+            rows = conn.execute("SELECT id, jti, exp FROM revoked WHERE id > ? ORDER BY id",
+                (self.last_id,)).fetchall()
+        finally:
+            conn.close()
+        for id_, jti, exp in rows:
+            self.revoked[jti] = exp
+            self.last_id = id_
+        self.revoked = {k: v for k, v in self.revoked.items() if v >= now}
+        self.checked = now
+
+    def is_revoked(self, jti):
+        with self.lock:
+            if time.time() - self.checked >= self.refresh:
+                self.load()
+            return jti in self.revoked
+
 
 
 def clean_tokens(user, sess):
     # Remove expired tokens
     for token in user.tokens:
         if not token_is_valid(token.token):
+            TOKEN_CACHE.invalidate(token.token)
             sess.delete(token)
 
 
+def get_request_tokens(request):
+    """Tokens provided with a request, query arg before header"""
+    token = request.args.get('token')
+    if token:
+        yield token
+    token = request.headers.get('Authorization')
+    if token:
+        yield token.replace('JWT', '', 1).strip()
+
+
+def stateless_identity(claims):
+    """Given verified token claims, get user id and authorization level
+
+    returns: (user id, level) or None if revoked
+    """
+    if current_app.revocations.is_revoked(claims['jti']):
+        return None
+    return int(claims['sub']), claims['level']
+
+
+def lookup_identity(token):
+    """Given a token, look up user id and authorization level
+
+    Cached identities are returned without decoding the token unless
+    its id has been revoked. In stateless mode verified claims are trusted without a database query.
+
+    returns: (user id, level) or None
+    """
+    claims = None
+    if current_app.config['AUTH_MODE'] == 'stateless':
+        claims = decode_token(token)
+        if claims is None:
+            return None
+        # Tokens issued without `sub` and `jti` are checked in the database
+        if 'sub' in claims and 'jti' in claims:
+            return stateless_identity(claims)
+    ttl = current_app.config['AUTH_CACHE_TTL']
+    if ttl > 0:
+        entry = TOKEN_CACHE.get(token)
+        if entry:
+            identity, jti = entry
+            # Logout in another worker only reaches this one through the file
+            if jti and current_app.revocations.is_revoked(jti):
+                TOKEN_CACHE.invalidate(token)
+                return None
+            return identity
+    if claims is None:
+        # Not decoded yet in database mode
+        claims = decode_token(token)
+        if claims is None:
+            return None
+    with session_scope() as sess:
+        identity = sess.query(User.id, User.level).join(UserToken)\
+            .filter(UserToken.token == token).first()
+    if not identity:
+        return None
+    identity = tuple(identity)
+    if ttl > 0:
+        expires = min(time.time() + ttl, claims.get('exp', float('inf')))
+        TOKEN_CACHE.set(token, identity, claims.get('jti'), expires,
+            current_app.config['AUTH_CACHE_SIZE'])
+    return identity
+
+
 def get_identify(request):
     """Given a request, try to get authenticated user
 
-    returns: user and user authorization level
+    The identity is resolved once per request and kept on `flask.g`.
+
+    returns: user id and user authorization level
     """
-    # Query Arg based auth
-    token = request.args.get('token')
-    if token and token_is_valid(token):
-        with session_scope() as sess:
-            user = sess.query(User).join(UserToken).filter_by(token=token).first()
-            if user:
-                return user, user.level
-    # Header based auth
-    token = request.headers.get('Authorization')
-    if token:
-        token = token.replace('JWT', '', 1).strip()
-        if token_is_valid(token):
-            with session_scope() as sess:
-                user = sess.query(User).join(UserToken).filter_by(token=token).first()
-                if user:
-                    return user, user.level
-    return None, None
+    if 'identity' not in g:
+        g.identity = None, None
+        for token in get_request_tokens(request):
+            identity = lookup_identity(token)
+            if identity:
+                g.identity = identity
+                break
+    return g.identity
 
 
 def get_user_id(request):
@@ -66,23 +247,8 @@ def get_user_id(request):
 
     returns: User id or None
     """
-    # Query Arg based auth
-    token = request.args.get('token')
-    if token and token_is_valid(token):
-        with session_scope() as sess:
-            user = sess.query(User).join(UserToken).filter_by(token=token).first()
-            if user:
-                return user.id
-    # Header based auth
-    token = request.headers.get('Authorization')
-    if token:
-        token = token.replace('JWT', '', 1).strip()
-        if token_is_valid(token):
-            with session_scope() as sess:
-                user = sess.query(User).join(UserToken).filter_by(token=token).first()
-                if user:
-                    return user.id
-    return None
+    user_id, _ = get_identify(request)
+    return user_id
 
 
 def check_auth(func):
@@ -106,6 +272,13 @@ def check_auth(func):
 auth_blueprint = Blueprint('auth', __name__)
 
 
+@auth_blueprint.record_once
+def init_revocations(state):
+    app = state.app
+    app.revocations = RevocationList(app.config['AUTH_REVOCATION_FILE'],
+        app.config['AUTH_REVOCATION_REFRESH'])
+
+
 @auth_blueprint.route('/api/v1/login', methods=['GET', 'POST'])
 def login():
     """Handle login requests
@@ -122,6 +295,7 @@ def login():
                 abort(401, 'User not found')
             jw_token = jwt.encode(
                 {'login': uname, 'level': user.level, 
+                'sub': str(user.id), 'jti': uuid.uuid4().hex,
                 'iat': datetime.datetime.utcnow(),
                 'exp': datetime.datetime.utcnow()+datetime.timedelta(30)},
                 key=PRIVATE_KEY,
@@ -153,6 +327,10 @@ def logout():
     if not token:
         token = request.headers.get('Authorization')
         token = token.replace('JWT', '', 1).strip()
+    TOKEN_CACHE.invalidate(token)
+    claims = decode_token(token)
+    if claims and 'jti' in claims:
+        current_app.revocations.revoke(claims['jti'], claims['exp'])
     with session_scope() as sess:
         tok = sess.query(UserToken).filter_by(token=token).first()
         sess.delete(tok)
@@ -0,0 +1,142 @@
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class MemoryCache(object):
+    """In-process LRU of responses, one per worker
+
+    The least recently used entries are evicted beyond `maxsize` entries
+    or once the bodies take more than `max_bytes`. Bodies larger than
+    `max_entry_bytes` are not cached.
+    """
+
+    def __init__(self, maxsize=1024, max_bytes=64 * 1024 * 1024, max_entry_bytes=1024 * 1024):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        size = len(entry[2])
+        if size > self.max_entry_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[2])
+            self.entries[key] = entry
+            self.size += size
+            while len(self.entries) > self.maxsize or self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[2])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class DiskCache(object):
+    """Responses shared by all workers on a host through a SQLite file
+
+    The least recently used entries are evicted once the bodies
+    take more than `max_bytes`. Bodies larger than `max_entry_bytes`
+    are not cached.
+    """
+
+    # Access times are only written back this often (seconds)
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, max_entry_bytes=1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS response (key TEXT PRIMARY KEY, "
+                    "status INTEGER, headers TEXT, body BLOB, size INTEGER, accessed REAL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS response_accessed ON response (accessed)")
+        finally:
+            conn.close()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, key):
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT status, headers, body, accessed FROM response WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                return None
+            status, headers, body, accessed = row
+            now = time.time()
+            if now - accessed > self.TOUCH_INTERVAL:
+                with conn:
+                    conn.execute("UPDATE response SET accessed = ? WHERE key = ?", (now, key))
+        finally:
+            conn.close()
+        return status, json.loads(headers), body
+
+    def set(self, key, entry):
+        status, headers, body = entry
+        if len(body) > self.max_entry_bytes:
+            return
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, status, json.dumps(headers), body, len(body), time.time()))
+                total, = conn.execute("SELECT COALESCE(SUM(size), 0) FROM response").fetchone()
+                if total > self.max_bytes:
+                    self._evict(conn, total - self.max_bytes)
+        finally:
+            conn.close()
+
+    def _evict(self, conn, excess):
+        keys = []
+        for key, size in conn.execute("SELECT key, size FROM response ORDER BY accessed"):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        conn.executemany("DELETE FROM response WHERE key = ?", keys)
+
+    def clear(self):
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM response")
+        finally:
+            conn.close()
+
+
+def make_cache(config):
+    """Response cache backend selected by `RESPONSE_CACHE`
+
+    returns: cache or None when caching is disabled
+    """
+    backend = config['RESPONSE_CACHE']
+    if backend == 'memory':
+        return MemoryCache(config['RESPONSE_CACHE_SIZE'], config['RESPONSE_CACHE_MEMORY_BYTES'],
+                           config['RESPONSE_CACHE_ENTRY_MAX_BYTES'])
+    if backend == 'disk':
+        return DiskCache(config['RESPONSE_CACHE_FILE'], config['RESPONSE_CACHE_MAX_BYTES'],
+                         config['RESPONSE_CACHE_ENTRY_MAX_BYTES'])
+    if backend not in (None, '', 'none'):
+        raise ValueError(f"Unknown RESPONSE_CACHE backend {backend}")
+    return None
@@ -0,0 +1,108 @@
+"""Geohash cells and great circle distances for dive site searches
+
+Sites store a geohash of their position in an indexed column, so a
+bounding box is a handful of `geohash LIKE 'prefix%'` index ranges.
+Candidates are then refined with the exact coordinates.
+"""
+import math
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 9
+EARTH_RADIUS_KM = 6371.0088
+# Half the circumference, no two points are further apart
+MAX_DISTANCE_KM = math.pi * EARTH_RADIUS_KM
+# Most geohash prefixes used to cover a bounding box
+MAX_CELLS = 16
+
+
+def encode_geohash(lat, lon, precision=GEOHASH_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        rng, coord = (lon_range, lon) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        value <<= 1
+        if coord >= mid:
+            value |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = value = 0
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    """(height, width) in degrees of the cells of a geohash precision"""
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+def _cells(south, west, north, east, precision):
+    height, width = cell_size(precision)
+    rows = range(int((south + 90) // height), int(min(north + 90, 180 - 1e-9) // height) + 1)
+    columns = range(int((west + 180) // width), int(min(east + 180, 360 - 1e-9) // width) + 1)
+    return rows, columns
+
+
+def geohash_prefixes(south, west, north, east, max_cells=MAX_CELLS):
+    """Geohash prefixes of the cells covering a bounding box
+
+    Uses the finest precision needing at most `max_cells` cells.
+    The box must not cross the antimeridian (see `split_bbox`).
+
+    returns: [prefix] or [] when the box is too large to be worth it
+    """
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        rows, columns = _cells(south, west, north, east, precision)
+        if len(rows) * len(columns) <= max_cells:
+            break
+    else:
+        return []
+    height, width = cell_size(precision)
+    return sorted({
+        encode_geohash((i + 0.5) * height - 90, (j + 0.5) * width - 180, precision)
+        for i in rows for j in columns
+    })
+
+
+def split_bbox(south, west, north, east):
+    """Boxes crossing the antimeridian (west > east) as two boxes"""
+    if west <= east:
+        return [(south, west, north, east)]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+
+def bbox_around(lat, lon, radius_km):
+    """(south, west, north, east) box containing a circle
+
+    May cross the antimeridian, and covers all longitudes near the poles.
+    """
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    south, north = lat - dlat, lat + dlat
+    if south <= -90 or north >= 90 or radius_km >= MAX_DISTANCE_KM:
+        return max(south, -90.0), -180.0, min(north, 90.0), 180.0
+    ratio = math.sin(radius_km / EARTH_RADIUS_KM) / math.cos(math.radians(lat))
+    if ratio >= 1:
+        return south, -180.0, north, 180.0
+    dlon = math.degrees(math.asin(ratio))
+    west, east = lon - dlon, lon + dlon
+    if west < -180:
+        west += 360
+    if east > 180:
+        east -= 360
+    return south, west, north, east
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2\
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
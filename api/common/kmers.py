@@ -0,0 +1,210 @@
+"""k-mer sketches of isolate sequences for similarity searches
+
+Sequences are sketched with FracMinHash: the canonical k-mers whose
+64 bit hash falls below 2^64 / SCALED. Sketches of similar sequences
+share a proportional fraction of their hashes, so the Jaccard index
+(and a Mash identity estimate) is computed from the sketches alone.
+
+The index is built from the database with
+
+    python -m api.common.kmers [--rebuild]
+
+and then kept up to date as isolates are written through the API.
+"""
+import argparse
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import sys
+import time
+from array import array
+from functools import partial
+from threading import local
+
+K = 21
+# Keep about one k-mer in SCALED
+SCALED = 8
+MAX_HASH = 2 ** 64 // SCALED
+COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+NOT_ACGT = re.compile('[^ACGT]+')
+# Layout of the index file, older files are emptied
+INDEX_FORMAT = 2
+
+
+def _hash(kmer):
+    return int.from_bytes(hashlib.blake2b(kmer.encode(), digest_size=8).digest(), 'little')
+
+
+def sketch(sequence, k=K):
+    """Sorted hashes of the kept canonical k-mers of a sequence
+
+    Whitespace is ignored, U is read as T and k-mers spanning other
+    characters (N, gaps...) are skipped.
+    """
+    hashes = set()
+    sequence = ''.join(sequence.split()).upper().replace('U', 'T')
+    for part in NOT_ACGT.split(sequence):
+        reverse = part.translate(COMPLEMENT)[::-1]
+        n = len(part)
+        for i in range(n - k + 1):
+            kmer = part[i:i + k]
+            other = reverse[n - k - i:n - i]
+            value = _hash(kmer if kmer <= other else other)
+            if value < MAX_HASH:
+                hashes.add(value)
+    return array('Q', sorted(hashes))
+
+
+def estimate_identity(jaccard, k=K):
+    """Mash estimate of sequence identity from the Jaccard index"""
+    if jaccard <= 0:
+        return 0.0
+    return max(0.0, 1 + math.log(2 * jaccard / (1 + jaccard)) / k)
+
+
+class SequenceIndex(object):
+    """Sketches of isolate sequences shared by all workers through a SQLite file
+
+    Searches are answered from the file, where `posting` holds the
+    isolates of every hash clustered by hash, so workers keep no copy
+    of the index in memory and see each other's writes at once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = local()
+        conn = self.connection()
+        with conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] != INDEX_FORMAT:
+                for table in ('sketch', 'posting', 'meta'):
+                    conn.execute(f"DROP TABLE IF EXISTS {table}")
+                conn.execute(f"PRAGMA user_version = {INDEX_FORMAT}")
+            conn.execute("CREATE TABLE IF NOT EXISTS sketch (isolate_id INTEGER PRIMARY KEY, "
+                "size INTEGER NOT NULL, hashes BLOB NOT NULL)")
+            # Kept hashes are below 2^61, they fit SQLite's signed integers
+            conn.execute("CREATE TABLE IF NOT EXISTS posting (hash INTEGER NOT NULL, "
+                "isolate_id INTEGER NOT NULL, PRIMARY KEY (hash, isolate_id)) WITHOUT ROWID")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        # Searches keep reading while a build writes
+        conn.execute("PRAGMA journal_mode = WAL")
+
+    def connection(self):
+        """SQLite connection of the current thread"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=30)
+        return conn
+
+    def _write(self, conn, sequences):
+        for id_, seq in sequences:
+            old = conn.execute("SELECT hashes FROM sketch WHERE isolate_id = ?", (id_,)).fetchone()
+            if old is not None:
+                hashes = array('Q')
+                hashes.frombytes(old[0])
+                conn.executemany("DELETE FROM posting WHERE hash = ? AND isolate_id = ?",
+                    [(value, id_) for value in hashes])
+                conn.execute("DELETE FROM sketch WHERE isolate_id = ?", (id_,))
+            hashes = sketch(seq) if seq else None
+            if hashes:
+                conn.execute("INSERT INTO sketch (isolate_id, size, hashes) VALUES (?, ?, ?)",
+                    (id_, len(hashes), hashes.tobytes()))
+                conn.executemany("INSERT INTO posting (hash, isolate_id) VALUES (?, ?)",
+                    [(value, id_) for value in hashes])
+
+    def add(self, sequences):
+        """Sketch new or changed sequences, [(isolate id, sequence or None)]"""
+        conn = self.connection()
+        with conn:
+            self._write(conn, sequences)
+
+    def is_built(self):
+        conn = self.connection()
+        return conn.execute("SELECT 1 FROM meta WHERE key = 'built'").fetchone() is not None
+
+    def build(self, batches, rebuild=False):
+        """Sketch every isolate, resuming an interrupted build
+
+        `batches(after)` returns [(isolate id, sequence)] lists of the
+        isolates with an id above `after`, in id order. Each batch is
+        committed on its own, memory use does not depend on their number.
+
+        returns: number of isolates sketched
+        """
+        conn = self.connection()
+        with conn:
+            if rebuild:
+                for table in ('sketch', 'posting', 'meta'):
+                    conn.execute(f"DELETE FROM {table}")
+            row = conn.execute("SELECT value FROM meta WHERE key = 'progress'").fetchone()
+        after = int(row[0]) if row else 0
+        count = 0
+        for batch in batches(after):
+            with conn:
+                self._write(conn, batch)
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('progress', ?)", (str(batch[-1][0]),))
+            count += len(batch)
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('built', ?)", (str(time.time()),))
+            conn.execute("DELETE FROM meta WHERE key = 'progress'")
+        return count
+
+    def search(self, sequence, limit=10):
+        """Isolates sharing the most sketch hashes with a sequence
+
+        About one in SCALED shared k-mers is a shared hash.
+
+        returns: [{"id", "shared_hashes", "jaccard", "containment", "identity"}]
+        """
+        query = sketch(sequence)
+        if not query:
+            raise ValueError(f"Sequence too short, needs k-mers of {K} A, C, G or T")
+        conn = self.connection()
+        with conn:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS query (hash INTEGER PRIMARY KEY)")
+            conn.execute("DELETE FROM temp.query")
+            conn.executemany("INSERT INTO temp.query VALUES (?)", [(value,) for value in query])
+            # CROSS JOIN keeps the query hashes as the outer loop, SQLite
+            # would otherwise scan every posting
+            top = conn.execute(
+                "SELECT hits.isolate_id, hits.shared, sketch.size FROM ("
+                "SELECT posting.isolate_id, count(*) AS shared FROM temp.query "
+                "CROSS JOIN posting ON posting.hash = query.hash "
+                "GROUP BY posting.isolate_id ORDER BY shared DESC, posting.isolate_id LIMIT ?"
+                ") AS hits JOIN sketch ON sketch.isolate_id = hits.isolate_id "
+                "ORDER BY hits.shared DESC, hits.isolate_id", (limit,)).fetchall()
+        results = []
+        for id_, count, size in top:
+            jaccard = count / (len(query) + size - count)
+            results.append({
+                "id": id_,
+                "shared_hashes": count,
+                "jaccard": round(jaccard, 4),
+                "containment": round(count / len(query), 4),
+                "identity": round(estimate_identity(jaccard), 4),
+            })
+        return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the k-mer sketch index of isolate sequences")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="Sketch every isolate again, e.g. after changing sequences in the database")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--config', default=os.getenv('FLASK_ENV', 'development'))
+    args = parser.parse_args(argv)
+
+    from api.app import create_app
+    from api.db import iter_isolate_sequences, session_scope
+    app = create_app(args.config)
+    start = time.perf_counter()
+    with app.app_context(), session_scope() as sess:
+        count = app.sequence_index.build(
+            partial(iter_isolate_sequences, batch_size=args.batch_size, sess=sess), args.rebuild)
+    print(f"{count} isolates sketched in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
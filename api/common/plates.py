@@ -0,0 +1,30 @@
+"""Screening plate formats and well names
+
+Wells are named by a row letter (A..Z, then AA..AF on 1536 well plates)
+and a 1 based column number, e.g. A1, P24 or AF48.
+"""
+import re
+
+# (rows, columns) of the standard plate formats
+PLATE_FORMATS = {
+    96: (8, 12),
+    384: (16, 24),
+    1536: (32, 48),
+}
+WELL_NAME = re.compile(r'^([A-Z]{1,2})0*(\d+)$')
+
+
+def parse_well(well):
+    """0 based (row, column) of a well name, or None when not a well"""
+    match = WELL_NAME.match((well or '').strip().upper())
+    if match is None:
+        return None
+    letters, number = match.groups()
+    row = 0
+    for letter in letters:
+        row = row * 26 + ord(letter) - ord('A') + 1
+    column = int(number)
+    if column < 1:
+        return None
+    return row - 1, column - 1
+
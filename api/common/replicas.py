@@ -0,0 +1,183 @@
+"""Routing of read-only requests to read replicas
+
+Sessions of GET, HEAD and OPTIONS requests read from a replica, every
+other request, and any request following a write by the same user or
+client within `REPLICA_PIN_SECONDS`, uses the primary. Anonymous clients
+are told apart by a random id in the `REPLICA_PIN_COOKIE` cookie, never
+by address, which proxies share.
+
+Replica lag is estimated from the `table_version` counters: a replica
+missing a version bump is at least as old as that bump on the primary.
+"""
+import datetime
+import secrets
+import sqlite3
+import time
+from itertools import count
+from threading import Lock, Thread, local
+
+from flask import current_app, g, request
+from sqlalchemy import create_engine, select
+from sqlalchemy.engine.url import make_url
+
+from api.models import TableVersion
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# Read from the primary, identities and logouts must apply at once
+PRIMARY_TABLES = {'user', 'user_token'}
+
+
+def replica_lag(primary_versions, replica_versions, now):
+    """Lower bound of a replica's lag in seconds, 0 when up to date
+
+    Versions are {table name: (version, last modified)}.
+    """
+    lag = 0
+    for name, (version, modified) in primary_versions.items():
+        replica_version, _ = replica_versions.get(name, (-1, None))
+        if replica_version < version:
+            lag = max(lag, (now - modified).total_seconds())
+    return lag
+
+
+def writer_keys():
+    """Keys of the user and client sending the current request"""
+    user_id, _ = g.get('identity', (None, None))
+    client = g.get('pin_client') or request.cookies.get(current_app.config['REPLICA_PIN_COOKIE'])
+    keys = []
+    if user_id:
+        keys.append(f'user:{user_id}')
+    if client:
+        keys.append(f'client:{client}')
+    return keys
+
+
+def set_pin_cookie(response):
+    """Give a client that wrote anonymously the id it is pinned by"""
+    if 'pin_client' in g:
+        response.set_cookie(current_app.config['REPLICA_PIN_COOKIE'], g.pin_client,
+                            max_age=int(current_app.config['REPLICA_PIN_SECONDS']) + 1,
+                            httponly=True, samesite='Lax')
+    return response
+
+
+def connect_args(url, timeout):
+    """Driver arguments bounding the time to connect to `url`"""
+    if make_url(url).get_dialect().name in ('mysql', 'postgresql'):
+        return {'connect_timeout': timeout}
+    return {}
+
+
+class WritePins(object):
+    """Writers pinned to the primary, shared by all workers through a SQLite file
+
+    Unlike the revocation list it is read on every check, a write in
+    one worker must be seen by the next request in any other.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = local()
+        with self.connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS pin (key TEXT PRIMARY KEY, until REAL NOT NULL)")
+
+    def connection(self):
+        """SQLite connection of the current thread"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=10)
+        return conn
+
+    def pin(self, keys, seconds):
+        now = time.time()
+        with self.connection() as conn:
+            conn.executemany("INSERT OR REPLACE INTO pin (key, until) VALUES (?, ?)",
+                [(key, now + seconds) for key in keys])
+            conn.execute("DELETE FROM pin WHERE until < ?", (now,))
+
+    def is_pinned(self, keys):
+        if not keys:
+            return False
+        row = self.connection().execute("SELECT 1 FROM pin WHERE until >= ? AND key IN ({})".format(
+            ', '.join('?' * len(keys))), [time.time()] + list(keys)).fetchone()
+        return row is not None
+
+
+class ReplicaRouter(object):
+    """Engines of the read replicas and which of them are usable
+
+    Replicas are checked at most every `REPLICA_LAG_CHECK` seconds per
+    worker, in a background thread: requests use the result of the last
+    check and never wait for one. Until the first check completes, and
+    for unreachable replicas and replicas more than `REPLICA_MAX_LAG`
+    seconds behind, reads go to the primary.
+    """
+
+    def __init__(self, primary, config):
+        self.primary = primary
+        timeout = config['REPLICA_CONNECT_TIMEOUT']
+        self.engines = [create_engine(url, pool_size=8, pool_pre_ping=True,
+                                      connect_args=connect_args(url, timeout))
+                        for url in config['REPLICA_DATABASE_URIS']]
+        self.max_lag = config['REPLICA_MAX_LAG']
+        self.check_every = config['REPLICA_LAG_CHECK']
+        self.pin_seconds = config['REPLICA_PIN_SECONDS']
+        self.pins = WritePins(config['REPLICA_PIN_FILE']) if self.engines else None
+        self.lags = [None] * len(self.engines)
+        self.healthy = []
+        self.checked = 0
+        self.checking = False
+        self.turn = count()
+        self.lock = Lock()
+
+    def versions(self, engine):
+        table = TableVersion.__table__
+        with engine.connect() as conn:
+            return {name: (version, modified) for name, version, modified in conn.execute(select([table]))}
+
+    def check(self):
+        """Estimate the lag of every replica"""
+        primary = self.versions(self.primary)
+        now = datetime.datetime.utcnow()
+        for i, engine in enumerate(self.engines):
+            try:
+                self.lags[i] = replica_lag(primary, self.versions(engine), now)
+            except Exception:
+                self.lags[i] = None
+        self.healthy = [engine for engine, lag in zip(self.engines, self.lags)
+                        if lag is not None and lag <= self.max_lag]
+        self.checked = time.time()
+
+    def _check_in_background(self):
+        try:
+            self.check()
+        except Exception:
+            # Primary unreachable, retry at the next interval
+            self.checked = time.time()
+        finally:
+            self.checking = False
+
+    def replica(self):
+        """An up to date replica as of the last check, or None"""
+        with self.lock:
+            if not self.checking and time.time() - self.checked >= self.check_every:
+                self.checking = True
+                Thread(target=self._check_in_background, daemon=True).start()
+        healthy = self.healthy
+        if not healthy:
+            return None
+        return healthy[next(self.turn) % len(healthy)]
+
+    def read_engine(self):
+        """Engine serving the reads of the current request"""
+        if request.method not in SAFE_METHODS or self.pins.is_pinned(writer_keys()):
+            return self.primary
+        return self.replica() or self.primary
+
+    def wrote(self):
+        """Pin the writer of the current request to the primary"""
+        keys = writer_keys()
+        if not keys:
+            g.pin_client = secrets.token_urlsafe(16)
+            keys = writer_keys()
+        self.pins.pin(keys, self.pin_seconds)
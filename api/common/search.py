@@ -0,0 +1,278 @@
+"""Full-text search over the names and notes of every resource
+
+MySQL searches a FULLTEXT index of each table, created offline with
+`python -m api.common.search`, and tables missing it with LIKE. SQLite
+keeps the text of every row in one FTS5 table, written by the flushes
+changing it.
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+from sqlalchemy import (Float, String, and_, cast, event, inspect, literal,
+                        or_, select, text, union_all)
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ColumnElement
+
+from api.common.sql_models import (Base, Diver, DiveSite, Extract, Isolate,
+                                   Library, Media, Permit, Sample, SampleType,
+                                   ScreenPlate)
+
+# Text columns searched in each table
+SEARCH_COLUMNS = {
+    Sample: ('name', 'genus_species', 'notes'),
+    SampleType: ('name', 'description', 'notes'),
+    DiveSite: ('name', 'notes'),
+    Diver: ('first_name', 'last_name', 'institution', 'notes'),
+    Permit: ('name', 'iss_auth', 'notes'),
+    Isolate: ('name', 'morphology', 'notes'),
+    Extract: ('name', 'notes'),
+    Media: ('name', 'notes'),
+    Library: ('name', 'description', 'notes'),
+    ScreenPlate: ('name', 'htcb_name', 'notes'),
+}
+SEARCH_TABLES = {Doa.__table__.name: Doa for Doa in SEARCH_COLUMNS}
+FULLTEXT_INDEX = 'ft_search'
+SEARCH_TERM = re.compile(r'(\w+)(\*?)')
+
+SQLITE_DDL = [
+    # Maps FTS5 rowids to rows, primary keys are not all integers
+    "CREATE TABLE IF NOT EXISTS search_row (id INTEGER PRIMARY KEY, "
+    "resource VARCHAR(64) NOT NULL, key VARCHAR(64) NOT NULL, UNIQUE (resource, key))",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_text USING fts5(body, tokenize='porter unicode61')",
+]
+
+
+def parse_search(q):
+    """Words of a search, a trailing * matches prefixes
+
+    returns: [(word, prefix)]
+    """
+    return [(word, bool(star)) for word, star in SEARCH_TERM.findall(q or '')]
+
+
+def _primary_key(Doa):
+    return Doa.__mapper__.primary_key[0]
+
+
+def _document(Doa, obj):
+    return ' '.join(str(x) for x in (getattr(obj, c) for c in SEARCH_COLUMNS[Doa]) if x)
+
+
+def _write_documents(conn, documents, deleted):
+    """Replace the FTS5 text of rows, [{"resource", "key", "body"}]"""
+    row_id = "(SELECT id FROM search_row WHERE resource = :resource AND key = :key)"
+    changed = documents + deleted
+    if changed:
+        conn.execute(text(f"DELETE FROM search_text WHERE rowid = {row_id}"), changed)
+    if deleted:
+        conn.execute(text("DELETE FROM search_row WHERE resource = :resource AND key = :key"), deleted)
+    if documents:
+        conn.execute(text("INSERT OR IGNORE INTO search_row (resource, key) VALUES (:resource, :key)"),
+                     documents)
+        conn.execute(text("INSERT INTO search_text (rowid, body) "
+                          "SELECT id, :body FROM search_row WHERE resource = :resource AND key = :key"),
+                     documents)
+
+
+def _init_sqlite(conn):
+    # The FTS5 tables, filled from existing rows
+    exists = conn.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE name = 'search_text'")).first()
+    if exists:
+        return
+    for ddl in SQLITE_DDL:
+        conn.execute(text(ddl))
+    for Doa, columns in SEARCH_COLUMNS.items():
+        table = Doa.__table__
+        rows = conn.execute(select([_primary_key(Doa)] + [table.c[c] for c in columns]))
+        _write_documents(conn, [
+            {'resource': table.name, 'key': str(row[0]),
+             'body': ' '.join(str(x) for x in row[1:] if x)}
+            for row in rows
+        ], [])
+
+
+def fulltext_indexed(conn):
+    """Names of the MySQL tables with the FULLTEXT search index"""
+    return {name for name, in conn.execute(text(
+        "SELECT DISTINCT table_name FROM information_schema.statistics "
+        "WHERE table_schema = DATABASE() AND index_name = :name"), name=FULLTEXT_INDEX)}
+
+
+def init_search_index(engine):
+    """Prepare the search index at startup
+
+    SQLite gets the FTS5 tables when missing, the flushes write to them.
+    MySQL FULLTEXT indexes rebuild their table, they are only detected
+    here, see `create_search_index`.
+
+    returns: names of the tables with a full-text index
+    """
+    with engine.begin() as conn:
+        if engine.dialect.name == 'sqlite':
+            _init_sqlite(conn)
+            return set(SEARCH_TABLES)
+        if engine.dialect.name == 'mysql':
+            return fulltext_indexed(conn)
+    return set()
+
+
+def create_search_index(engine, log=None):
+    """Create the missing FULLTEXT indexes of a MySQL database (or the SQLite FTS5 tables)
+
+    returns: names of the tables indexed
+    """
+    with engine.begin() as conn:
+        if engine.dialect.name == 'sqlite':
+            _init_sqlite(conn)
+            return set(SEARCH_TABLES)
+        indexed = fulltext_indexed(conn)
+    created = set()
+    for Doa, columns in SEARCH_COLUMNS.items():
+        name = Doa.__table__.name
+        if name in indexed:
+            continue
+        start = time.perf_counter()
+        with engine.begin() as conn:
+            conn.execute(text(f"CREATE FULLTEXT INDEX {FULLTEXT_INDEX} "
+                              f"ON {name} ({', '.join(columns)})"))
+        created.add(name)
+        if log:
+            log(f"{name} indexed in {time.perf_counter() - start:.1f} s")
+    return created
+
+
+@event.listens_for(Base.metadata, "before_drop")
+def drop_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text("DROP TABLE IF EXISTS search_text"))
+        connection.execute(text("DROP TABLE IF EXISTS search_row"))
+
+
+def index_search_text(session, flush_context):
+    """Keep the SQLite FTS5 text of rows written by a flush up to date"""
+    conn = session.connection()
+    if conn.dialect.name != 'sqlite':
+        return
+    documents, deleted = [], []
+    for obj in list(session.new) + list(session.dirty):
+        Doa = type(obj)
+        if Doa not in SEARCH_COLUMNS:
+            continue
+        attrs = inspect(obj).attrs
+        if obj not in session.new and not any(
+                attrs[c].history.has_changes() for c in SEARCH_COLUMNS[Doa]):
+            continue
+        documents.append({'resource': Doa.__table__.name,
+                          'key': str(getattr(obj, _primary_key(Doa).key)),
+                          'body': _document(Doa, obj)})
+    for obj in session.deleted:
+        Doa = type(obj)
+        if Doa in SEARCH_COLUMNS:
+            deleted.append({'resource': Doa.__table__.name,
+                            'key': str(getattr(obj, _primary_key(Doa).key))})
+    _write_documents(conn, documents, deleted)
+
+
+def _sqlite_hits(terms):
+    match = ' '.join('"{}"{}'.format(word, ' *' if prefix else '') for word, prefix in terms)
+    hits = text(
+        "SELECT search_row.resource AS resource, search_row.key AS key, "
+        "-bm25(search_text) AS score FROM search_text "
+        "JOIN search_row ON search_row.id = search_text.rowid "
+        "WHERE search_text MATCH :match"
+    ).bindparams(match=match).columns(resource=String, key=String, score=Float)
+    return hits.alias('hits')
+
+
+class Match(ColumnElement):
+    """MySQL `MATCH (columns) AGAINST (terms IN BOOLEAN MODE)` relevance"""
+    type = Float()
+
+    def __init__(self, columns, against):
+        self.columns = columns
+        self.against = literal(against)
+
+
+@compiles(Match)
+def compile_match(element, compiler, **kw):
+    return "MATCH ({}) AGAINST ({} IN BOOLEAN MODE)".format(
+        ', '.join(compiler.process(c, **kw) for c in element.columns),
+        compiler.process(element.against, **kw))
+
+
+def _like_all(Doa, terms):
+    # Every word in one of the columns, words are not stemmed
+    columns = [Doa.__table__.c[c] for c in SEARCH_COLUMNS[Doa]]
+    return and_(*[or_(*[c.contains(word, autoescape=True) for c in columns]) for word, _ in terms])
+
+
+def _mysql_hits(terms, tables, indexed=None):
+    against = ' '.join('+{}{}'.format(word, '*' if prefix else '') for word, prefix in terms)
+    selects = []
+    for name in tables:
+        Doa = SEARCH_TABLES[name]
+        if indexed is None or name in indexed:
+            match = Match([Doa.__table__.c[c] for c in SEARCH_COLUMNS[Doa]], against)
+            score, where = match, match > 0
+        else:
+            # No FULLTEXT index yet, unranked
+            score, where = cast(literal(0), Float), _like_all(Doa, terms)
+        selects.append(
+            select([literal(name).label('resource'),
+                    cast(_primary_key(Doa), String(64)).label('key'),
+                    score.label('score')])
+            .select_from(Doa.__table__)
+            .where(where)
+        )
+    return union_all(*selects).alias('hits')
+
+
+def fulltext_query(dialect, terms, tables, limit, after=None, indexed=None):
+    """Rows of `tables` matching every term, best first
+
+    `after` is the (score, resource, key) of the last row of the
+    previous page. On MySQL, tables missing from `indexed` (all
+    indexed when None) are searched with LIKE.
+
+    returns: select of (resource, key, score)
+    """
+    if dialect == 'sqlite':
+        hits = _sqlite_hits(terms)
+    elif dialect == 'mysql':
+        hits = _mysql_hits(terms, tables, indexed)
+    else:
+        raise NotImplementedError(f"Full-text search not supported on {dialect}")
+    query = select([hits.c.resource, hits.c.key, hits.c.score])\
+        .where(hits.c.resource.in_(tables))\
+        .order_by(hits.c.score.desc(), hits.c.resource, hits.c.key)\
+        .limit(limit)
+    if after is not None:
+        score, resource, key = after
+        query = query.where(or_(
+            hits.c.score < score,
+            and_(hits.c.score == score, or_(
+                hits.c.resource > resource,
+                and_(hits.c.resource == resource, hits.c.key > key)))
+        ))
+    return query
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create the full-text search indexes")
+    parser.add_argument('--config', default=os.getenv('FLASK_ENV', 'development'))
+    args = parser.parse_args(argv)
+
+    from api.app import create_app
+    app = create_app(args.config)
+    log = lambda message: print(message, file=sys.stderr)
+    created = create_search_index(app.engine, log)
+    log(f"{len(created)} tables indexed, restart the API to search them")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
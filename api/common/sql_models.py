@@ -5,14 +5,18 @@ ORM Mapping of Linington Lab Database
 """
 from sqlalchemy import (Boolean, Column, Date, DateTime, Float, ForeignKey,
                         Integer, String, Table, UniqueConstraint,
-                        create_engine, func)
+                        create_engine, event, func)
 # from sqlalchemy.dialects.mysql import DOUBLE, ENUM
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import backref, relationship, sessionmaker
+from sqlalchemy.orm import Session as OrmSession
+from sqlalchemy.orm import (backref, joinedload, object_session, relationship,
+                            sessionmaker)
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.types import Text
 
+from api.common.geo import encode_geohash
+
 Base = declarative_base()
 
 # # Patch relationship to ignore typechecking...
@@ -35,7 +39,8 @@ class Sample(Base):
     name = Column(String(255), nullable=False, unique=True)
     collection_number = Column(Integer, nullable=False)
     collection_year = Column(Integer, nullable=False)
-    collection_date = Column(Date)
+    # Indexed for `sort=-collection_date` (latest samples)
+    collection_date = Column(Date, index=True)
     color = Column(String(45))
     depth_ft = Column(Float)
     genus_species = Column(String(255))
@@ -88,6 +93,13 @@ class DiveSite(Base):
     lat = Column(Float, nullable=False)
     lon = Column(Float, nullable=False)
     notes = Column(Text)
+    # Geohash of lat / lon for spatial searches, see `set_geohashes`
+    geohash = Column(String(12), index=True)
+
+    def build_geohash(self):
+        if self.lat is None or self.lon is None:
+            return None
+        return encode_geohash(self.lat, self.lon)
 
     def __repr__(self):
         return f"<{self.__class__.__name__} id={self.id}>"
@@ -233,11 +245,16 @@ class Extract(Base):
     library_abbrev = Column(String(5), ForeignKey("library.abbrev"))
     library = relationship("Library", backref="extracts")
     fractions = relationship("Fraction", back_populates="extract")
-
-    @property
-    def name(self):
+    # Persisted RL{abbrev}-{number:04d} name, see `set_names`
+    name = Column(String(64), unique=True)
+
+    def build_name(self):
+        if self.number is None:
+            return None
+        # The foreign key is only set from the relationship on flush
+        abbrev = self.library.abbrev if self.library is not None else self.library_abbrev
         return "RL{}-{:04d}".format(
-            self.library_abbrev,
+            abbrev,
             self.number,
         )
 
@@ -258,18 +275,21 @@ class Fraction(Base):
     extract_id = Column(Integer, ForeignKey("extract.id"))
     extract = relationship("Extract")
     code = Column(String(45))
-
-    @hybrid_property
-    def name(self):
-        try:
-            ex = self.extract
-            return "RL{}-{:04d}{}".format(
-                ex.library_abbrev,
-                ex.number,
-                self.code
-            )
-        except AttributeError:
-            None
+    # Persisted extract name followed by code, see `set_names`
+    name = Column(String(64), unique=True)
+
+    def build_name(self):
+        extract = self.extract
+        # Pending rows given only extract_id do not lazy load extract,
+        # `set_names` loads them into the identity map beforehand
+        if extract is None and self.extract_id is not None:
+            extract = object_session(self).query(Extract).get(self.extract_id)
+        if extract is None:
+            return None
+        extract_name = extract.build_name()
+        if extract_name is None:
+            return None
+        return "{}{}".format(extract_name, self.code)
 
     @hybrid_property
     def library(self):
@@ -390,6 +410,41 @@ class FractionScreenPlate(Base):
         return hash(self.id)
 
 
+@event.listens_for(OrmSession, "before_flush")
+def set_names(session, flush_context, instances):
+    """Keep persisted extract and fraction names consistent
+
+    Renaming an extract also renames its fractions. The extracts of
+    fractions given only an extract id are loaded in one query.
+    """
+    extract_ids = {obj.extract_id for obj in session.new
+                   if isinstance(obj, Fraction) and obj.extract is None and obj.extract_id is not None}
+    # Referenced until the names are set, the identity map is weak
+    extracts = session.query(Extract).options(joinedload(Extract.library))\
+                      .filter(Extract.id.in_(extract_ids)).all() if extract_ids else []
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Extract):
+            name = obj.build_name()
+            if name != obj.name:
+                obj.name = name
+                for fraction in obj.fractions:
+                    fraction.name = fraction.build_name()
+        elif isinstance(obj, Fraction):
+            name = obj.build_name()
+            if name != obj.name:
+                obj.name = name
+
+
+@event.listens_for(OrmSession, "before_flush")
+def set_geohashes(session, flush_context, instances):
+    """Keep dive site geohashes consistent with their position"""
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, DiveSite):
+            geohash = obj.build_geohash()
+            if geohash != obj.geohash:
+                obj.geohash = geohash
+
+
 # Should be a singleton object for instantiating DB connection
 class LiningtonDB(object):
 
@@ -408,10 +463,4 @@ class LiningtonDB(object):
         return Session()
 
     def get_fraction_by_name(self, sess, fraction_name):
-        lib_abbrev = fraction_name.split('-')[0].replace('RL', '')
-        extract_num = fraction_name.split('-')[-1][:4]
-        prefac_code = fraction_name[-1]
-        return sess.query(Fraction).filter(Fraction.code == prefac_code)\
-                    .join(Extract).filter(Extract.number == extract_num)\
-                    .join(Library).filter(Library.abbrev == lib_abbrev)\
-                    .first()
+        return sess.query(Fraction).filter(Fraction.name == fraction_name).first()
@@ -1,12 +1,39 @@
+import base64
 import datetime
+import gc
+import hashlib
+import math
 import os
+import re
+from contextlib import contextmanager
 from decimal import Decimal
+from functools import partial, wraps
+from operator import itemgetter
+from threading import Lock
+from urllib.parse import urlencode
 
-from flask import abort, jsonify
+from flask import (Response, abort, current_app, json, jsonify, request,
+                   stream_with_context)
+from flask_restful.representations.json import output_json
+from flask_restful.utils import unpack
+from werkzeug.http import http_date, quote_etag
 
+from api.auth import get_identify
 from api.common.exc import ValidationException
 from api.common.sql_models import Base
 from api.config import app_config
+from api.common.geo import MAX_DISTANCE_KM
+from api.common.plates import PLATE_FORMATS, parse_well
+from api.common.search import SEARCH_TABLES, parse_search
+from api.db import (add_many, bbox_filter, count_query, get_link_ids,
+                    get_order, get_primary_key, get_table_versions,
+                    iter_pages, nearest_sites, paginate, search_rows,
+                    sites_within)
+from sqlalchemy import (Boolean, Date, DateTime, Float, Integer, Numeric, String,
+                        and_, case, select)
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.orm import (configure_mappers, joinedload, load_only,
+                            object_session, selectinload)
 from api.common.sql_models import (Diver, DiveSite, Extract, Fraction,
                                    FractionScreenPlate, Isolate, IsolateStock,
                                    Library, Media, MediaRecipe, Permit, Sample,
@@ -64,163 +91,1484 @@ def get_embedding(embed):
     return embed.split(',')
 
 
+def parse_embed(embed):
+    """Parse embed list into {key: nested embed or None}
+
+    "a b c" embeds `a` with `b` and `c` embedded inside each `a`.
+    """
+    parsed = {}
+    for e in embed:
+        e_split = e.split(' ')
+        parsed[e_split[0]] = parse_embed(e_split[1:]) if len(e_split) > 1 else None
+    return parsed
+
+
+# Metadata fields not serialized by row2dict
+METADATA_COLUMNS = ('insert_by', 'insert_date')
+
+# Fields added by the custom serializers below and the relationships
+# they read, independently of the relationship links and `embed`.
+# Trees map relationship -> subtree, with the columns to load under None
+# (None for all columns).
+SERIALIZED_FIELDS = {
+    Fraction: {
+        'screen_plates': {'fraction_screen_plates': {None: None, 'screen_plate': {None: None}}},
+    },
+    Isolate: {'stocks': {'stocks': {None: None}}},
+    Media: {'recipe': {'recipe': {None: None}}},
+}
+# Columns needed to compute serialized fields
+SERIALIZED_FIELD_COLUMNS = {}
+
+
+def _isoformat(value):
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+def _float(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def _column_converter(column):
+    if isinstance(column.type, (Date, DateTime)):
+        return _isoformat
+    if getattr(column.type, 'asdecimal', False):
+        return _float
+    return None
+
+
+def _link_columns(Doa, rel):
+    """(foreign key, parent key) attributes used to build links for rel
+    """
+    prop = Doa.__mapper__.relationships[rel]
+    local_col = prop.local_remote_pairs[0][0]
+    key = Doa.__mapper__.get_property_by_column(local_col).key
+    if prop.direction is MANYTOONE:
+        return key, None
+    return None, key
+
+
+def _tuple_getter(keys):
+    if len(keys) == 1:
+        key = keys[0]
+        return lambda d: (d[key],)
+    return itemgetter(*keys)
+
+
+class ModelSerializer(object):
+    """Serialization metadata for one model, compiled once
+
+    Column lists, value converters and relationship links are resolved
+    from the mapper up front so serializing a row is a dict lookup per
+    column instead of re-walking the table for every row.
+    """
+
+    def __init__(self, Doa, only=None):
+        self.Doa = Doa
+        self.only = only
+        self.pk = get_primary_key(Doa).key
+        columns = list(Doa.__table__.columns)
+        self.column_keys = tuple(c.key for c in columns)
+        self.foreign_keys = tuple(c.key for c in columns if c.foreign_keys)
+        if only is not None:
+            # Primary key is always serialized
+            columns = [c for c in columns if c.key in only or c.key == self.pk]
+        # row2dict - no foreign keys or metadata, converted values
+        self.columns = tuple(c.key for c in columns
+            if not c.foreign_keys and c.name not in METADATA_COLUMNS)
+        self.converters = tuple((c.key, _column_converter(c)) for c in columns
+            if c.key in self.columns and _column_converter(c))
+        # media2dict / fraction2dict - all raw columns
+        self.all_columns = tuple(c.key for c in columns)
+        self._get_columns = _tuple_getter(self.columns)
+        self._get_all_columns = _tuple_getter(self.all_columns)
+        # Relationships as (attribute, endpoint key, uselist, model)
+        self.relationships = tuple(
+            (rel, ENDPOINT_MAP.get(rel, rel), prop.uselist, prop.mapper.class_)
+            for rel, prop in Doa.__mapper__.relationships.items()
+        )
+        self.relationship_keys = [key for _, key, _, _ in self.relationships]
+        self.embeddable = {key: Sub for _, key, _, Sub in self.relationships}
+        # Link metadata, many-to-one links are read from the foreign key
+        # column `fk`, collections are fetched by `parent_key`.
+        # Stocks are always serialized inline with isolates
+        self.links = tuple(
+            (rel, key, uselist, f"/api/v1/{key}/", get_primary_key(Sub).key)
+                + _link_columns(Doa, rel)
+            for rel, key, uselist, Sub in self.relationships if key != "stocks"
+        )
+        self.wanted_links = frozenset(link[1] for link in self.links if self.wants(link[1]))
+        self.field_names = set(self.column_keys) | set(self.relationship_keys)\
+            | set(SERIALIZED_FIELDS.get(Doa, {}))
+        self._projections = {}
+        self.serialize = self._compile()
+
+    def wants(self, field):
+        return self.only is None or field in self.only
+
+    def project(self, only):
+        """Serializer restricted to a sparse fieldset (None for all fields)
+        """
+        if only is None:
+            return self
+        try:
+            return self._projections[only]
+        except KeyError:
+            self._projections[only] = ModelSerializer(self.Doa, only)
+            return self._projections[only]
+
+    def load_columns(self):
+        """Columns to load for this fieldset, None for all
+
+        Keys are always loaded so relationships and cursors still work.
+        """
+        if self.only is None:
+            return None
+        columns = set(self.only) & set(self.column_keys)
+        for field, needed in SERIALIZED_FIELD_COLUMNS.get(self.Doa, {}).items():
+            if field in self.only:
+                columns.update(needed)
+        return columns | {self.pk} | set(self.foreign_keys)
+
+    def _values(self, row, keys, getter):
+        try:
+            return getter(row.__dict__)
+        except KeyError:
+            # Expired or deferred attributes, load through the ORM
+            return tuple(getattr(row, k) for k in keys)
+
+    def row2dict(self, row):
+        result = dict(zip(self.columns, self._values(row, self.columns, self._get_columns)))
+        for key, convert in self.converters:
+            result[key] = convert(result[key])
+        return result
+
+    def raw2dict(self, row):
+        return dict(zip(self.all_columns, self._values(row, self.all_columns, self._get_all_columns)))
+
+    def _compile(self):
+        """Row with its relationship links and nothing embedded
+
+        Same output as `_serialize_row` without `embed`, as a closure
+        over the column getter and one link function per wanted
+        relationship.
+        """
+        if self.Doa is Fraction:
+            # fraction2dict
+            plates = (('screen_plates', fraction_screen_plates),) if self.wants('screen_plates') else ()
+            base = _column_values(self.all_columns, (), plates)
+        elif self.Doa in ROW_SERIALIZERS:
+            to_dict, only = ROW_SERIALIZERS[self.Doa], self.only
+            base = lambda row: to_dict(row, only)
+        else:
+            base = _column_values(self.columns, self.converters)
+        links = tuple(
+            _many_to_one_link(rel, key, prefix, pk, fk) if fk is not None
+            else _collection_link(self.Doa, rel, key, uselist, prefix, pk, parent_key)
+            for rel, key, uselist, prefix, pk, fk, parent_key in self.links
+            if key in self.wanted_links
+        )
+
+        def serialize(row, link_index=None):
+            result = base(row)
+            for link in links:
+                link(result, row, link_index)
+            return result
+        return serialize
+
+
+def _column_values(keys, converters, extras=()):
+    # Columns, converted values and (key, function of the row) extras
+    def columns(row):
+        d = row.__dict__
+        try:
+            result = {k: d[k] for k in keys}
+        except KeyError:
+            # Expired or deferred attributes, load through the ORM
+            result = {k: getattr(row, k) for k in keys}
+        for key, convert in converters:
+            result[key] = convert(result[key])
+        for key, value in extras:
+            result[key] = value(row)
+        return result
+    return columns
+
+
+def _many_to_one_link(rel, key, prefix, pk, fk):
+    def link(result, row, link_index):
+        if link_index is None:
+            x = _attr(row, rel)
+            x = None if x is None else _attr(x, pk)
+        else:
+            d = row.__dict__
+            x = d[fk] if fk in d else getattr(row, fk)
+        result[key] = {"links": [] if x is None else [f"{prefix}{x}"]}
+    return link
+
+
+def _collection_link(Doa, rel, key, uselist, prefix, pk, parent_key):
+    def link(result, row, link_index):
+        d = row.__dict__
+        if rel in d:
+            related = d[rel]
+        elif link_index is None:
+            related = getattr(row, rel)
+        else:
+            ids = link_index.get(Doa, rel, _attr(row, parent_key))
+            result[key] = {"links": [f"{prefix}{x}" for x in ids]}
+            return
+        if not uselist:
+            related = [] if related is None else [related]
+        result[key] = {"links": [f"{prefix}{_attr(x, pk)}" for x in related]}
+    return link
+
+
+SERIALIZERS = {}
+
+
+def get_serializer(Doa, only=None):
+    try:
+        ser = SERIALIZERS[Doa]
+    except KeyError:
+        ser = SERIALIZERS[Doa] = ModelSerializer(Doa)
+    return ser.project(only)
+
+
+def compile_serializers():
+    """Compile serializers for every model, called once at startup
+    """
+    configure_mappers()
+    for Doa in MODEL_MAP.values():
+        get_serializer(Doa)
+
+
+def _values(obj, keys):
+    # Several loaded attributes at once, falling back to the ORM
+    try:
+        return itemgetter(*keys)(obj.__dict__)
+    except KeyError:
+        return tuple(getattr(obj, k) for k in keys)
+
+
+FRACTION_SCREEN_PLATE_KEYS = ('screen_plate', 'well', 'notes')
+SCREEN_PLATE_KEYS = ('name', 'htcb_name', 'well_format')
+
+
+def _attr(obj, key):
+    # Loaded attributes straight from the instance dict
+    try:
+        return obj.__dict__[key]
+    except KeyError:
+        return getattr(obj, key)
+
+
 def validate_embed(Doa, embed):
-    relationships = get_relationships(Doa)
+    embeddable = get_serializer(Doa).embeddable
     for e in embed:
         if " " in e:
             e_split = e.split(' ')
             e1 = e_split[0]
-            e2s = e_split[1:]
-            sub_Doa = MODEL_MAP[TABLE_MAP[e1]]
-            sub_relationships = get_relationships(sub_Doa)
-            if e1 not in relationships or any(e2 not in sub_relationships for e2 in e2s):
+            if e1 not in embeddable:
+                return False
+            sub_relationships = get_serializer(embeddable[e1]).embeddable
+            if any(e2 not in sub_relationships for e2 in e_split[1:]):
                 return False
             continue
-        if e not in relationships:
+        if e not in embeddable:
             return False
     return True
 
 
 def get_relationships(Doa):
     assert issubclass(Doa, Base)
-    relationships = []
-    keys = Doa.__mapper__.relationships.keys()
-    for k in keys:
+    return list(get_serializer(Doa).relationship_keys)
+
+
+class FieldSet(object):
+    """Sparse fieldsets for one request
+
+    `only` maps an embedded endpoint key (None for the requested
+    resource itself) to the frozenset of fields to serialize.
+    `links` toggles relationship link blocks.
+    """
+
+    def __init__(self, only=None, links=True):
+        self.only = only or {}
+        self.links = links
+
+    def get(self, key=None):
+        return self.only.get(key)
+
+
+ALL_FIELDS = FieldSet()
+
+
+def get_fieldset(Doa, args):
+    """Parse `fields`, `fields[<embedded>]` and `links` arguments
+    """
+    only = {}
+    for arg, value in args.items():
+        if arg == 'fields':
+            key, Sub = None, Doa
+        elif arg.startswith('fields[') and arg.endswith(']'):
+            key = arg[len('fields['):-1]
+            try:
+                Sub = MODEL_MAP[TABLE_MAP[key]]
+            except KeyError:
+                abort(400, f"Invalid fieldset {arg}")
+        else:
+            continue
+        fields = frozenset(f for f in value.split(',') if f)
+        invalid = fields - get_serializer(Sub).field_names
+        if invalid:
+            abort(400, f"Invalid fields: {', '.join(sorted(invalid))}")
+        only[key] = fields
+    links = args.get('links', 'true').lower() not in ('false', '0', 'no')
+    return FieldSet(only, links)
+
+
+def convert_value(column, value):
+    """Convert a query string or CSV value to the type of `column`"""
+    value = value.strip()
+    if isinstance(column.type, Boolean):
+        return value.lower() in ('true', '1', 'yes', 'y')
+    if isinstance(column.type, DateTime):
+        return datetime.datetime.fromisoformat(value)
+    if isinstance(column.type, Date):
+        return datetime.date.fromisoformat(value)
+    return column.type.python_type(value)
+
+
+def _list_value(column, value):
+    return [convert_value(column, x) for x in value.split(',') if x.strip()]
+
+
+def _null_value(column, value):
+    return value.lower() not in ('false', '0', 'no')
+
+
+# op: (value parser, SQL expression builder)
+FILTER_OPERATORS = {
+    'eq': (convert_value, lambda c, v: c == v),
+    'ne': (convert_value, lambda c, v: c != v),
+    'lt': (convert_value, lambda c, v: c < v),
+    'lte': (convert_value, lambda c, v: c <= v),
+    'gt': (convert_value, lambda c, v: c > v),
+    'gte': (convert_value, lambda c, v: c >= v),
+    'in': (_list_value, lambda c, v: c.in_(v)),
+    'nin': (_list_value, lambda c, v: ~c.in_(v)),
+    'like': (lambda c, v: v, lambda c, v: c.like(v)),
+    'null': (_null_value, lambda c, v: c.is_(None) if v else c.isnot(None)),
+}
+# `<column>[<op>]`, the column may follow a relationship path
+# (`sample.dive_site.name`), in which case `[<op>]` defaults to eq
+FILTER_ARG = re.compile(r'^(\w+(?:\.\w+)*)(?:\[(\w+)\])?$')
+
+
+def _related_model(Doa, rel):
+    """Relationship attribute and model for a mapper or endpoint key"""
+    for attr, key, uselist, Sub in get_serializer(Doa).relationships:
+        if rel in (attr, key):
+            return attr, uselist, Sub
+    return None
+
+
+def _column_filter(Doa, key, op, value, arg):
+    columns = Doa.__table__.columns
+    if key not in columns:
+        abort(400, f"Invalid filter {arg}, unknown field {key}")
+    if op not in FILTER_OPERATORS:
+        abort(400, f"Invalid filter {arg}, unknown operator {op}")
+    column = columns[key]
+    if op == 'like' and not isinstance(column.type, String):
+        abort(400, f"Invalid filter {arg}, {key} is not text")
+    parse, expression = FILTER_OPERATORS[op]
+    try:
+        parsed = parse(column, value)
+    except ValueError:
+        abort(400, f"Invalid filter value {arg}={value}")
+    if op in ('in', 'nin') and not parsed:
+        abort(400, f"Invalid filter value {arg}={value}")
+    return expression(getattr(Doa, column.key), parsed)
+
+
+def _compile_filters(Doa, conditions):
+    """Filter expressions for (relationship path, column, op, value, arg)
+
+    Conditions under the same relationship share one EXISTS subquery
+    (`has` / `any`), so they must hold for the same related row.
+    """
+    filters = []
+    nested = {}
+    for path, key, op, value, arg in conditions:
+        if not path:
+            filters.append(_column_filter(Doa, key, op, value, arg))
+            continue
+        related = _related_model(Doa, path[0])
+        if related is None:
+            abort(400, f"Invalid filter {arg}, unknown relationship {path[0]}")
+        nested.setdefault(related, []).append((path[1:], key, op, value, arg))
+    for (attr, uselist, Sub), sub_conditions in nested.items():
+        criterion = and_(*_compile_filters(Sub, sub_conditions))
+        rel = getattr(Doa, attr)
+        filters.append(rel.any(criterion) if uselist else rel.has(criterion))
+    return filters
+
+
+def get_filters(Doa, args):
+    """Parse `<column>[<op>]=<value>` filter arguments
+
+    Values are converted to the column type so the filters compile to
+    plain comparisons on the columns, e.g. `collection_year[gte]=2015`,
+    `genus_species[like]=Strepto%` or `id[in]=1,2,3`. Columns of related
+    rows are given by relationship path, e.g. `sample.dive_site.name=Foo`,
+    and compiled to EXISTS subqueries.
+
+    returns: [SQLAlchemy filter expressions]
+    """
+    conditions = []
+    for arg, value in args.items(multi=True):
+        m = FILTER_ARG.match(arg)
+        if not m or m.group(1) == 'fields':
+            continue
+        path, op = m.groups()
+        # Plain `<column>=` arguments are handled by each resource
+        if op is None and '.' not in path:
+            continue
+        *path, key = path.split('.')
+        conditions.append((tuple(path), key, op or 'eq', value, arg))
+    return _compile_filters(Doa, conditions)
+
+
+AGGREGATE_ARG = re.compile(r'^(min|max|avg|sum)\((\w+)\)$')
+NUMERIC_TYPES = (Integer, Float, Numeric)
+
+
+def _resolve_path(Doa, path, arg):
+    """Relationships (model, attribute, uselist, related model) of a path"""
+    joins = []
+    for rel in path:
+        related = _related_model(Doa, rel)
+        if related is None:
+            abort(400, f"Invalid {arg}, unknown relationship {rel}")
+        attr, uselist, Sub = related
+        joins.append((Doa, attr, uselist, Sub))
+        Doa = Sub
+    return joins
+
+
+def get_group_by(Doa, args):
+    """Parse `group_by`, comma separated columns or relationship paths
+
+    A path ends with a column of the related rows
+    (`extract.library_abbrev`) or a relationship, grouped by its
+    primary key (`divers`).
+
+    returns: [(field, [(model, attribute, uselist, related model)], column key)]
+    """
+    groups = []
+    for field in args.get('group_by', '').split(','):
+        field = field.strip()
+        if not field:
+            continue
+        *path, key = field.split('.')
+        joins = _resolve_path(Doa, path, f"group_by {field}")
+        Sub = joins[-1][3] if joins else Doa
+        if key not in Sub.__table__.columns:
+            joins += _resolve_path(Sub, [key], f"group_by {field}")
+            Sub = joins[-1][3]
+            key = get_primary_key(Sub).key
+        groups.append((field, joins, Sub.__table__.columns[key].key))
+    if not groups:
+        abort(400, "Missing group_by")
+    # Counts would be multiplied by each collection
+    if len({tuple(j[:2] for j in joins) for _, joins, _ in groups if any(j[2] for j in joins)}) > 1:
+        abort(400, "Invalid group_by, only one collection relationship can be grouped")
+    return groups
+
+
+def get_aggregates(Doa, args):
+    """Parse `agg`, `count` and `min|max|avg|sum(<column>)`
+
+    returns: [(name, function, column key or None for count)]
+    """
+    aggregates = []
+    columns = Doa.__table__.columns
+    for field in args.get('agg', 'count').split(','):
+        field = field.strip()
+        if field == 'count':
+            aggregates.append(('count', 'count', None))
+            continue
+        m = AGGREGATE_ARG.match(field)
+        if not m:
+            abort(400, f"Invalid aggregate {field}")
+        function, key = m.groups()
+        if key not in columns:
+            abort(400, f"Invalid aggregate {field}, unknown field {key}")
+        if function in ('avg', 'sum') and not isinstance(columns[key].type, NUMERIC_TYPES):
+            abort(400, f"Invalid aggregate {field}, {key} is not numeric")
+        aggregates.append((f"{function}_{key}", function, columns[key].key))
+    return aggregates
+
+
+def jsonify_stats(group_by, aggregates, query):
+    """Rows of a statistics query as dicts of group and aggregate values"""
+    names = [x[0] for x in group_by] + [x[0] for x in aggregates]
+    return {"results": [
+        {name: _float(_isoformat(value)) for name, value in zip(names, row)} for row in query
+    ]}
+
+
+def stats_tables(Doa, args):
+    """Tables read by a statistics query, see `get_group_by`"""
+    tables = {Doa.__table__.name} | get_filter_tables(Doa, args)
+    for field in args.get('group_by', '').split(','):
+        Sub = Doa
+        for rel in field.strip().split('.'):
+            related = _related_model(Sub, rel)
+            # Invalid fields are rejected by the resource
+            if related is None:
+                break
+            prop = Sub.__mapper__.relationships[related[0]]
+            if prop.secondary is not None:
+                tables.add(prop.secondary.name)
+            Sub = related[2]
+            tables.add(Sub.__table__.name)
+    return sorted(tables)
+
+
+def search_tables(args):
+    """Tables searched by `resource=<endpoint>,...`, all by default"""
+    resources = args.get('resource')
+    if not resources:
+        return sorted(SEARCH_TABLES)
+    return sorted({TABLE_MAP.get(x.strip()) for x in resources.split(',')} & set(SEARCH_TABLES))
+
+
+def jsonify_search(args):
+    """Ranked page of rows matching every word of `q`
+
+    Paginated like sorted collections, `after` is the cursor of the
+    `next` link.
+    """
+    terms = parse_search(args.get('q'))
+    if not terms:
+        abort(400, "No search terms")
+    for resource in filter(None, args.get('resource', '').split(',')):
+        if TABLE_MAP.get(resource.strip()) not in SEARCH_TABLES:
+            abort(400, f"Invalid resource {resource}")
+    tables = search_tables(args)
+    try:
+        limit = int(args.get('limit', current_app.config['PAGE_SIZE']))
+    except ValueError:
+        abort(400, "Invalid limit")
+    if limit < 1:
+        abort(400, "Invalid limit")
+    limit = min(limit, current_app.config['PAGE_SIZE_MAX'])
+    after = args.get('after')
+    if after is not None:
         try:
-            key = ENDPOINT_MAP[k]
-        except KeyError:
-            key = k
-        relationships.append(key)
-    return relationships
+            after = json.loads(base64.urlsafe_b64decode(after + '=' * (-len(after) % 4)))
+            score, resource, key = after
+            after = float(score), str(resource), str(key)
+        except (TypeError, ValueError):
+            abort(400, "Invalid after cursor")
+    try:
+        rows = search_rows(terms, tables, limit + 1, after)
+    except NotImplementedError as e:
+        abort(501, str(e))
+    headers = {}
+    next_ = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        table, key, score = rows[-1]
+        next_ = page_link(limit=limit, after=encode_cursor((score, table, key)))
+        headers['Link'] = f'<{next_}>; rel="next"'
+    results = [{
+        "resource": ENDPOINT_MAP[table],
+        "id": SEARCH_TABLES[table].__mapper__.primary_key[0].type.python_type(key),
+        "link": f"/api/v1/{ENDPOINT_MAP[table]}/{key}",
+        "score": score,
+    } for table, key, score in rows]
+    return {"results": results, "next": next_}, 200, headers
+
 
+LAYOUT_TABLES = ['extract', 'fraction', 'fraction_screen_plate', 'library', 'screen_plate']
 
-def row2dict(row):
-    result = {}
-    if isinstance(row, Extract):
-        extra = ['name']
+
+def _well_order(well):
+    # Wells that are not named like A1 come last
+    position = parse_well(well['well'])
+    return position if position is not None else (math.inf, math.inf)
+
+
+def jsonify_layout(rows, fmt=None):
+    """Wells of a screen plate in plate order, see `get_plate_layout`
+
+    `fmt=grid` gives the fraction names as a list of rows of columns
+    instead, wells outside of the grid are listed as `unplaced`.
+    """
+    if fmt not in (None, 'grid'):
+        abort(400, "Invalid format")
+    first = rows[0]
+    plate = {"id": first.id, "name": first.name, "well_format": first.well_format}
+    wells = []
+    for row in rows:
+        if row.well_id is None:
+            continue
+        position = parse_well(row.well)
+        wells.append({
+            "id": row.well_id,
+            "well": row.well,
+            "row": position[0] if position else None,
+            "column": position[1] if position else None,
+            "fraction_id": row.fraction_id,
+            "fraction": row.fraction,
+            "extract_id": row.extract_id,
+            "extract": row.extract,
+            "library": row.library,
+            "library_name": row.library_name,
+            "notes": row.notes,
+        })
+    wells.sort(key=_well_order)
+    if fmt is None:
+        return dict(plate, wells=wells)
+    size = PLATE_FORMATS.get(first.well_format)
+    if size is None:
+        abort(400, f"Grid format needs a {', '.join(map(str, PLATE_FORMATS))} well plate")
+    n_rows, n_columns = size
+    grid = [[None] * n_columns for _ in range(n_rows)]
+    unplaced = []
+    for well in wells:
+        i, j = well['row'], well['column']
+        if i is None or i >= n_rows or j >= n_columns:
+            unplaced.append(well)
+            continue
+        # Wells holding several fractions list their names
+        cell = grid[i][j]
+        if cell is None:
+            grid[i][j] = well['fraction']
+        else:
+            grid[i][j] = (cell if isinstance(cell, list) else [cell]) + [well['fraction']]
+    return dict(plate, rows=n_rows, columns=n_columns, grid=grid, unplaced=unplaced)
+
+
+def _floats(arg, value, count):
+    try:
+        values = [float(x) for x in value.split(',')]
+    except ValueError:
+        abort(400, f"Invalid {arg}")
+    if len(values) != count:
+        abort(400, f"Invalid {arg}")
+    return values
+
+
+def _check_position(arg, lat, lon):
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        abort(400, f"Invalid {arg}, out of range")
+
+
+def get_geo_filters(Doa, args):
+    """Parse dive site searches for dive sites and samples
+
+    `bbox=<west>,<south>,<east>,<north>` (crossing the antimeridian when
+    west > east), `near=<lat>,<lon>` with `radius_km` and / or `k`
+    nearest sites. Samples are those of the matching sites. Without
+    `sort`, `near` can't be combined with `limit`, `after` or `stream`.
+
+    returns: ([filter expressions], order by distance or None)
+    """
+    column = DiveSite.id if Doa is DiveSite else Doa.dive_site_id
+    filters = []
+    order = None
+    bbox = args.get('bbox')
+    if bbox is not None:
+        west, south, east, north = _floats('bbox', bbox, 4)
+        _check_position('bbox', south, west)
+        _check_position('bbox', north, east)
+        if south > north:
+            abort(400, "Invalid bbox, south is above north")
+        in_box = bbox_filter(south, west, north, east)
+        filters.append(in_box if Doa is DiveSite else column.in_(select([DiveSite.id]).where(in_box)))
+    near = args.get('near')
+    radius, k = args.get('radius_km'), args.get('k')
+    if near is None:
+        if radius is not None or k is not None:
+            abort(400, "radius_km and k need near")
+        return filters, order
+    lat, lon = _floats('near', near, 2)
+    _check_position('near', lat, lon)
+    if radius is None and k is None:
+        abort(400, "near needs radius_km or k")
+    # Pages and streams follow the primary key, not the distance
+    if not args.get('sort') and any(args.get(x) is not None for x in ('limit', 'after', 'stream')):
+        abort(400, "near results are ordered by distance, give sort to paginate or stream them")
+    try:
+        radius = float(radius) if radius is not None else MAX_DISTANCE_KM
+        k = int(k) if k is not None else None
+    except ValueError:
+        abort(400, "Invalid radius_km or k")
+    if radius <= 0 or (k is not None and not 0 < k <= current_app.config['PAGE_SIZE_MAX']):
+        abort(400, "Invalid radius_km or k")
+    # Nearest sites of samples only count sites with samples
+    site_filters = () if Doa is DiveSite else (DiveSite.id.in_(select([column])),)
+    if k is None:
+        found = sites_within(lat, lon, radius, filters=site_filters)
     else:
-        extra = []
-    # Serialize table without foreign keys
-    for c in row.__table__.columns:
-        # Remove metadata fields
-        if c.name in ['insert_by', 'insert_date']:
+        found = nearest_sites(lat, lon, k, radius, filters=site_filters)
+    ids = [id_ for _, id_ in found]
+    filters.append(column.in_(ids))
+    if ids:
+        order = case({id_: i for i, id_ in enumerate(ids)}, value=column)
+    return filters, order
+
+
+def _merge_columns(a, b):
+    if a is None or b is None:
+        return None
+    return a | b
+
+
+def _merge_trees(tree, other):
+    for k, v in other.items():
+        if k is None:
+            tree[None] = _merge_columns(tree.get(None, v), v)
+        else:
+            _merge_trees(tree.setdefault(k, {None: v.get(None)}), v)
+    return tree
+
+
+def _content_tree(ser):
+    tree = {}
+    for field, subtree in SERIALIZED_FIELDS.get(ser.Doa, {}).items():
+        if ser.wants(field):
+            _merge_trees(tree, subtree)
+    return tree
+
+
+def _serialized_tree(Doa, parsed_embed, fieldset, only=None):
+    """Tree of relationships read by `serialize_row` for Doa
+    """
+    ser = get_serializer(Doa, only)
+    tree = _content_tree(ser)
+    # Media is serialized with its recipe only
+    if Doa is Media:
+        return tree
+    for rel, key, _, Sub in ser.relationships:
+        # Links are built without loading the related rows, see LinkIndex
+        if key not in parsed_embed:
             continue
-        r = getattr(row, c.name)
-        # Handle all relationships separately
-        if c.foreign_keys:
+        sub = get_serializer(Sub, fieldset.get(key))
+        if parsed_embed[key]:
+            subtree = _serialized_tree(Sub, parsed_embed[key], fieldset, fieldset.get(key))
+        elif key in EMBEDDED_SERIALIZERS:
+            subtree = _content_tree(sub)
+        else:
+            # Plain row2dict, columns only
+            subtree = {}
+        subtree[None] = sub.load_columns()
+        _merge_trees(tree, {rel: subtree})
+    return tree
+
+
+def _load_only(Sub, columns):
+    # Keep keys loaded for identity, links and relationship joins
+    ser = get_serializer(Sub)
+    return set(columns) | {ser.pk} | set(ser.foreign_keys)
+
+
+def _tree_to_options(Doa, tree, parent=None):
+    options = []
+    for rel, subtree in tree.items():
+        if rel is None:
             continue
-        elif isinstance(r, Decimal):
-            result[c.name] = float(r)
-        elif isinstance(r, datetime.date):
-            result[c.name] = r.isoformat()
+        prop = Doa.__mapper__.relationships[rel]
+        Sub = prop.mapper.class_
+        # Join many-to-one, separate IN query for collections
+        loader = 'selectinload' if prop.uselist else 'joinedload'
+        attr = getattr(Doa, rel)
+        if parent is None:
+            option = selectinload(attr) if prop.uselist else joinedload(attr)
         else:
-            result[c.name] = r
-    for e in extra:
-        r = getattr(row, e)
-        result[e] = r
-    return result
+            option = getattr(parent, loader)(attr)
+        if subtree.get(None) is not None:
+            options.append(option.load_only(*_load_only(Sub, subtree[None])))
+        else:
+            options.append(option)
+        options.extend(_tree_to_options(Sub, subtree, option))
+    return options
+
 
+def plan_loading(Doa, embed, fieldset=ALL_FIELDS):
+    """Loading options for everything serialized for Doa with embed
 
-def media2dict(row):
-    result = {}
+    Relationships are eager loaded so the number of queries depends on
+    embed depth, not number of rows. Sparse fieldsets become `load_only`
+    so unused columns are never selected.
+    """
+    options = _tree_to_options(Doa, _serialized_tree(Doa, parse_embed(embed), fieldset, fieldset.get()))
+    columns = get_serializer(Doa, fieldset.get()).load_columns()
+    if columns is not None:
+        options.append(load_only(*columns))
+    return options
+
+
+def row2dict(row, only=None):
+    return get_serializer(type(row), only).row2dict(row)
+
+
+def media2dict(row, only=None):
     # Serialize table without foreign keys
-    for c in row.__table__.columns:
-        r = getattr(row, c.name)
-        result[c.name] = r
-    recipe=[]
-    for i in row.recipe:
-        recipe.append({
-            "ingredient": i.ingredient,
-            "amount": i.amount,
-            "unit": i.unit,
-            "notes": i.notes
-        })
-    result['recipe'] = recipe
+    ser = get_serializer(type(row), only)
+    result = ser.raw2dict(row)
+    if ser.wants('recipe'):
+        result['recipe'] = [{
+                "ingredient": i.ingredient,
+                "amount": i.amount,
+                "unit": i.unit,
+                "notes": i.notes
+            } for i in row.recipe]
     return result
 
 
-def fraction2dict(row):
-    result = {}
-    # Serialize table without foreign keys
-    for c in row.__table__.columns:
-        r = getattr(row, c.name)
-        result[c.name] = r
-    # Extra name attribute
-    result['name'] = row.name    
+_get_fraction_screen_plate = itemgetter(*FRACTION_SCREEN_PLATE_KEYS)
+_get_screen_plate = itemgetter(*SCREEN_PLATE_KEYS)
+
+
+def fraction_screen_plates(row):
     screen_plates = []
-    for i in row.fraction_screen_plates:
+    for i in _attr(row, 'fraction_screen_plates'):
+        try:
+            plate, well, notes = _get_fraction_screen_plate(i.__dict__)
+            name, htcb_name, well_format = _get_screen_plate(plate.__dict__)
+        except KeyError:
+            plate, well, notes = _values(i, FRACTION_SCREEN_PLATE_KEYS)
+            name, htcb_name, well_format = _values(plate, SCREEN_PLATE_KEYS)
         screen_plates.append({
-            "name": i.screen_plate.name,
-            "htcb_name": i.screen_plate.htcb_name,
-            "plate_format": i.screen_plate.well_format,
-            "well": i.well,
-            "notes": i.notes
+            "name": name,
+            "htcb_name": htcb_name,
+            "plate_format": well_format,
+            "well": well,
+            "notes": notes
         })
-    result['screen_plates'] = screen_plates
+    return screen_plates
+
+
+def fraction2dict(row, only=None):
+    ser = get_serializer(type(row), only)
+    result = ser.raw2dict(row)
+    if ser.wants('screen_plates'):
+        result['screen_plates'] = fraction_screen_plates(row)
     return result
 
 
-def isolate2dict(row):
-    result = row2dict(row)
-    result['stocks'] = [row2dict(s) for s in row.stocks]
+def isolate2dict(row, only=None):
+    result = row2dict(row, only)
+    if only is None or 'stocks' in only:
+        result['stocks'] = [row2dict(s) for s in row.stocks]
     return result
 
 
-def serialize_row(row, embed):
-    self_ = f"/{ENDPOINT_MAP[row.__table__.name]}/{row.id}"
-    # Check for nested embedding
-    nested_embed = {}
-    parsed_embed = []
-    for e in embed:
-        if " " in e:
-            e_split = e.split(' ')
-            parsed_embed.append(e_split[0])
-            nested_embed[e_split[0]] = e_split[1:]
-        else:
-            parsed_embed.append(e)
+# Row serializer per model, for the row itself and for embedded rows
+ROW_SERIALIZERS = {
+    Fraction: fraction2dict,
+    Isolate: isolate2dict,
+}
+EMBEDDED_SERIALIZERS = {
+    "fractions": fraction2dict,
+    "isolates": isolate2dict,
+}
+
+
+def _related(row, rel, uselist):
+    r = _attr(row, rel)
+    if not uselist:
+        return [r] if r is not None else []
+    return r
+
+
+class LinkIndex(object):
+    """Relationship link ids for a page of rows
+
+    Many-to-one links are read from the foreign key column of each row.
+    Collection links are fetched with one grouped id-only query per
+    relationship for the whole page, at every level of nested embedding.
+    Related rows are only loaded when they are embedded.
+    """
+
+    def __init__(self, rows, parsed_embed, fieldset=ALL_FIELDS):
+        keys = {}
+        self._collect(rows, parsed_embed, fieldset, fieldset.get(), keys)
+        # Query through the same session the rows were loaded from
+        sess = object_session(rows[0]) if rows else None
+        self.ids = {(Doa, rel): get_link_ids(Doa, rel, parent_keys, sess=sess)
+                    for (Doa, rel), parent_keys in keys.items()}
+
+    def _collect(self, rows, parsed_embed, fieldset, only, keys):
+        by_model = {}
+        for row in rows:
+            by_model.setdefault(type(row), []).append(row)
+        for Doa, rows in by_model.items():
+            # Media is serialized with its recipe only
+            if Doa is Media:
+                continue
+            ser = get_serializer(Doa, only)
+            for rel, key, uselist, _, _, fk, parent_key in ser.links:
+                if parsed_embed.get(key):
+                    children = [x for row in rows for x in _related(row, rel, uselist)]
+                    self._collect(children, parsed_embed[key], fieldset, fieldset.get(key), keys)
+                elif key not in parsed_embed and fieldset.links\
+                        and key in ser.wanted_links and fk is None:
+                    # Skip collections already loaded for serialization
+                    keys.setdefault((Doa, rel), set()).update(
+                        _attr(row, parent_key) for row in rows if rel not in row.__dict__)
 
+    def get(self, Doa, rel, key):
+        try:
+            return self.ids[(Doa, rel)].get(key, [])
+        except KeyError:
+            return []
+
+
+def _serialize_row(row, parsed_embed, fieldset=ALL_FIELDS, only=None, link_index=None):
     # Separate media to serialize so that recipe is included
     if isinstance(row, Media):
-        result = media2dict(row)
-    else:
-         # Separate fraction to serialize so that screen_plate data is included
-        if isinstance(row, Fraction):
-            result = fraction2dict(row)
-        elif isinstance(row, Isolate):
-            result = isolate2dict(row)
+        return media2dict(row, only)
+    ser = get_serializer(type(row), only)
+    links = fieldset.links
+    if links and not parsed_embed:
+        return ser.serialize(row, link_index)
+    to_dict = ROW_SERIALIZERS.get(ser.Doa)
+    result = to_dict(row, only) if to_dict else ser.row2dict(row)
+    # Serialize relationships as lists of links
+    for rel, key, uselist, prefix, pk, fk, parent_key in ser.links:
+        if key in parsed_embed:
+            pass
+        elif links and key in ser.wanted_links:
+            if link_index is None or (fk is None and rel in row.__dict__):
+                ids = [_attr(x, pk) for x in _related(row, rel, uselist)]
+            elif fk is not None:
+                id_ = _attr(row, fk)
+                ids = [id_] if id_ is not None else []
+            else:
+                ids = link_index.get(ser.Doa, rel, _attr(row, parent_key))
+            result[key] = {"links": [f"{prefix}{x}" for x in ids]}
+            continue
         else:
-            result = row2dict(row)
-        # Serialize relationships as lists of links
-        for rel in row.__mapper__.relationships.keys():
-            try:
-                key = ENDPOINT_MAP[rel]
-            except KeyError:
-                key = rel
-            # Pass over stocks
-            if key == "stocks":
-                continue
-            r = getattr(row, rel)
-            if not isinstance(r, list):
-                r = [r]
-            # result[key] = {"links":[f"{BASE_URL}/api/v1/{key}/{x.id}" for x in r if x]}
-            result[key] = {"links":[f"/api/v1/{key}/{x.id}" for x in r if x]}
-            if key in parsed_embed:
-                if nested_embed.get(key):
-                    result[key]["embedded"] = [serialize_row(x, embed=nested_embed.get(key)) for x in r if x]
-                else:
-                    if key == "fractions":
-                        result[key]["embedded"] = [fraction2dict(x) for x in r if x]
-                    elif key == "isolates":
-                        result[key]["embedded"] = [isolate2dict(x) for x in r if x]
-                    else:
-                        result[key]["embedded"] = [row2dict(x) for x in r if x]
+            continue
+        r = _related(row, rel, uselist)
+        result[key] = block = {}
+        if links:
+            block["links"] = [f"{prefix}{_attr(x, pk)}" for x in r]
+        nested = parsed_embed[key]
+        sub_only = fieldset.get(key)
+        if nested:
+            block["embedded"] = [_serialize_row(x, nested, fieldset, sub_only, link_index) for x in r]
+        else:
+            to_dict = EMBEDDED_SERIALIZERS.get(key, row2dict)
+            block["embedded"] = [to_dict(x, sub_only) for x in r]
     return result
 
 
-def jsonify_sqlalchemy(res, embed=[]):
+def serialize_row(row, embed, fieldset=ALL_FIELDS, link_index=None):
+    """Serialize one row
+
+    Without a `link_index` relationship links are read from the
+    related objects, loading them if needed.
+    """
+    return _serialize_row(row, parse_embed(embed), fieldset, fieldset.get(), link_index)
+
+
+_gc_lock = Lock()
+_gc_pauses = 0
+_gc_was_enabled = False
+
+
+@contextmanager
+def gc_paused():
+    """Pause the cyclic garbage collector, e.g. while serializing rows
+
+    Serialized rows are acyclic and freed by reference counting, but the
+    containers of a large page trigger collections that walk every
+    loaded ORM object. Nested and concurrent pauses are counted, the
+    collector resumes once the last one ends.
+    """
+    global _gc_pauses, _gc_was_enabled
+    with _gc_lock:
+        if _gc_pauses == 0:
+            _gc_was_enabled = gc.isenabled()
+            gc.disable()
+        _gc_pauses += 1
+    try:
+        yield
+    finally:
+        with _gc_lock:
+            _gc_pauses -= 1
+            if _gc_pauses == 0 and _gc_was_enabled:
+                gc.enable()
+
+
+def jsonify_sqlalchemy(res, embed=[], fieldset=ALL_FIELDS):
+    parsed_embed = parse_embed(embed)
+    only = fieldset.get()
     if not isinstance(res, list):
-        return serialize_row(res, embed=embed) 
-    return [serialize_row(r, embed=embed) for r in res]
+        link_index = LinkIndex([res], parsed_embed, fieldset)
+        return _serialize_row(res, parsed_embed, fieldset, only, link_index)
+    link_index = LinkIndex(res, parsed_embed, fieldset)
+    with gc_paused():
+        models = {type(r) for r in res}
+        if fieldset.links and not parsed_embed and len(models) == 1 and Media not in models:
+            # Links only, every row through the same compiled serializer
+            serialize = get_serializer(models.pop(), only).serialize
+            return [serialize(r, link_index) for r in res]
+        return [_serialize_row(r, parsed_embed, fieldset, only, link_index) for r in res]
+
+
+def get_sort(Doa, args):
+    """Parse `sort`, comma separated columns, `-` for descending
+
+    returns: [(column key, descending)]
+    """
+    sort = args.get('sort')
+    if not sort:
+        return []
+    columns = Doa.__table__.columns
+    order = []
+    for field in sort.split(','):
+        field = field.strip()
+        desc = field.startswith('-')
+        key = field.lstrip('-')
+        if key not in columns:
+            abort(400, f"Invalid sort field {key}")
+        if key in [k for k, _ in order]:
+            abort(400, f"Duplicate sort field {key}")
+        order.append((columns[key].key, desc))
+    return order
+
+
+def encode_cursor(values):
+    """Opaque `after` cursor for the sort key values of a row"""
+    data = json.dumps([_float(_isoformat(x)) for x in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(Doa, order, cursor):
+    """Sort key values of an `after` cursor made by `encode_cursor`"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        abort(400, "Invalid after cursor")
+    keys = get_order(Doa, order)
+    if not isinstance(values, list) or len(values) != len(keys):
+        abort(400, "Invalid after cursor")
+    try:
+        return tuple(x if x is None or not isinstance(column.type, (Date, DateTime))
+                     else convert_value(column, x) for (column, _), x in zip(keys, values))
+    except (TypeError, ValueError):
+        abort(400, "Invalid after cursor")
+
+
+def get_pagination(Doa, args, order=None):
+    """Parse `limit` and `after` keyset pagination arguments
+
+    `after` is a primary key, or a cursor when sorted by `order`.
+
+    returns: (limit, after) or (None, None) when pagination not requested
+    """
+    limit = args.get('limit')
+    after = args.get('after')
+    if limit is None and after is None:
+        return None, None
+    try:
+        limit = int(limit) if limit is not None else current_app.config['PAGE_SIZE']
+    except ValueError:
+        abort(400, "Invalid limit")
+    if limit < 1:
+        abort(400, "Invalid limit")
+    limit = min(limit, current_app.config['PAGE_SIZE_MAX'])
+    if after is not None and order:
+        after = decode_cursor(Doa, order, after)
+    # Cursor must match primary key type (Library uses string abbrev)
+    elif after is not None:
+        try:
+            after = get_primary_key(Doa).type.python_type(after)
+        except ValueError:
+            abort(400, "Invalid after cursor")
+    return limit, after
+
+
+def page_link(**kwargs):
+    """Link to the current endpoint with some query args replaced
+    """
+    args = request.args.to_dict(flat=False)
+    # Never leak query arg tokens into links / headers
+    args.pop('token', None)
+    for k, v in kwargs.items():
+        args[k] = [v]
+    return f"{request.path}?{urlencode(args, doseq=True)}"
+
+
+STREAM_FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def stream_collection(Doa, query, embed=[], fieldset=ALL_FIELDS, fmt='json', after=None,
+                      order=None):
+    """Stream a collection query as a chunked JSON array or NDJSON
+
+    Rows are fetched in keyset pages of `STREAM_CHUNK_SIZE`, serialized one
+    at a time and dropped from the session after each page, so memory use
+    does not depend on the size of the table.
+    """
+    sess = query.session
+    chunk_size = current_app.config['STREAM_CHUNK_SIZE']
+    parsed_embed = parse_embed(embed)
+    only = fieldset.get()
+
+    def generate():
+        first = True
+        if fmt == 'json':
+            yield '['
+        for rows in iter_pages(Doa, query, chunk_size, after, order):
+            link_index = LinkIndex(rows, parsed_embed, fieldset)
+            for row in rows:
+                data = json.dumps(_serialize_row(row, parsed_embed, fieldset, only, link_index))
+                if fmt == 'ndjson':
+                    yield data + '\n'
+                elif first:
+                    yield data
+                else:
+                    yield ',' + data
+                first = False
+            # Release page and any relationships loaded while serializing it
+            sess.expunge_all()
+        if fmt == 'json':
+            yield ']'
+
+    return Response(stream_with_context(generate()), mimetype=STREAM_FORMATS[fmt])
+
+
+def wants_count(args):
+    return args.get('count', 'false').lower() in ('true', '1', 'yes')
+
+
+def jsonify_collection(Doa, query, embed=[], fieldset=ALL_FIELDS, default_order=None):
+    """Serialize a collection query
+
+    Streamed when `stream` is given, paginated by primary key (or by
+    `sort` keys) when `limit` or `after` are given, otherwise the full
+    collection is returned as a list, in `default_order` unless
+    sorted. `HEAD` and `count=true` only return the number of rows,
+    in `X-Total-Count`.
+    """
+    if request.method == 'HEAD' or wants_count(request.args):
+        total = count_query(Doa, query)
+        return {"count": total}, 200, {'X-Total-Count': str(total)}
+    order = get_sort(Doa, request.args)
+    limit, after = get_pagination(Doa, request.args, order)
+    query = query.options(*plan_loading(Doa, embed, fieldset))
+    stream = request.args.get('stream')
+    if stream is not None:
+        if stream not in STREAM_FORMATS:
+            abort(400, "Invalid stream format")
+        return stream_collection(Doa, query, embed, fieldset, fmt=stream, after=after, order=order)
+    if limit is None:
+        if order:
+            query = query.order_by(*[c.desc() if desc else c for c, desc in get_order(Doa, order)])
+        elif default_order is not None:
+            query = query.order_by(default_order)
+        return jsonify_sqlalchemy(query.all(), embed, fieldset)
+    rows, last = paginate(Doa, query, limit, after, order)
+    headers = {}
+    next_ = None
+    if last is not None:
+        next_ = page_link(limit=limit, after=encode_cursor(last) if order else last)
+        headers['Link'] = f'<{next_}>; rel="next"'
+    result = {"results": jsonify_sqlalchemy(rows, embed, fieldset), "next": next_}
+    return result, 200, headers
+
+
+def _add_relationship_tables(Doa, tree, tables):
+    for rel, sub_tree in tree.items():
+        if rel is None:
+            continue
+        prop = Doa.__mapper__.relationships[rel]
+        tables.add(prop.mapper.local_table.name)
+        _add_relationship_tables(prop.mapper.class_, sub_tree, tables)
+
+
+def _dependent_tables(Doa, parsed_embed, tables):
+    tables.add(Doa.__table__.name)
+    # Relationship links
+    for prop in Doa.__mapper__.relationships:
+        tables.add(prop.mapper.local_table.name)
+        if prop.secondary is not None:
+            tables.add(prop.secondary.name)
+    for tree in SERIALIZED_FIELDS.get(Doa, {}).values():
+        _add_relationship_tables(Doa, tree, tables)
+    embeddable = get_serializer(Doa).embeddable
+    for key, nested in parsed_embed.items():
+        # Invalid embeds are rejected by the resource
+        if key in embeddable:
+            _dependent_tables(embeddable[key], nested or {}, tables)
+
+
+DEPENDENT_TABLES = {}
+def get_dependent_tables(Doa, embed):
+    """Tables whose changes can change a response for `Doa` with `embed`"""
+    key = (Doa, tuple(sorted(embed)))
+    if key not in DEPENDENT_TABLES:
+        tables = set()
+        _dependent_tables(Doa, parse_embed(embed), tables)
+        DEPENDENT_TABLES[key] = sorted(tables)
+    return DEPENDENT_TABLES[key]
+
+
+def get_filter_tables(Doa, args):
+    """Tables read by relationship path filters, see `get_filters`"""
+    tables = set()
+    for arg in args:
+        m = FILTER_ARG.match(arg)
+        if not m or '.' not in m.group(1):
+            continue
+        Sub = Doa
+        for rel in m.group(1).split('.')[:-1]:
+            related = _related_model(Sub, rel)
+            # Invalid filters are rejected by the resource
+            if related is None:
+                break
+            prop = Sub.__mapper__.relationships[related[0]]
+            if prop.secondary is not None:
+                tables.add(prop.secondary.name)
+            Sub = related[2]
+            tables.add(Sub.__table__.name)
+    return tables
+
+
+def get_validators(Doa, args, tables=None):
+    """Strong ETag and Last-Modified for a GET of `Doa`
+
+    Computed from the version counters of the tables the response
+    depends on (unless given as `tables`), the path and the query
+    parameters.
+    """
+    if tables is None:
+        tables = get_dependent_tables(Doa, get_embedding(args.get('embed')))
+        filter_tables = get_filter_tables(Doa, args)
+        if not filter_tables.issubset(tables):
+            tables = sorted(filter_tables.union(tables))
+    versions = get_table_versions()
+    digest = hashlib.sha1(request.path.encode())
+    for k, v in sorted(args.items(multi=True)):
+        # Auth token does not change the response
+        if k != 'token':
+            digest.update(f"&{k}={v}".encode())
+    modified = None
+    for table in tables:
+        version, table_modified = versions.get(table, (0, None))
+        # Modified time guards against counters restarting from 0
+        digest.update(f"|{table}:{version}:{table_modified}".encode())
+        if table_modified and (modified is None or table_modified > modified):
+            modified = table_modified
+    return digest.hexdigest(), modified
+
+
+def _with_headers(rv, headers):
+    if isinstance(rv, Response):
+        if rv.status_code == 200:
+            rv.headers.extend(headers)
+        return rv
+    data, code, rv_headers = unpack(rv)
+    if code == 200:
+        rv_headers = dict(rv_headers or {}, **headers)
+    return data, code, rv_headers
+
+
+# Headers recomputed for every response
+UNCACHED_HEADERS = ('Content-Length', 'ETag', 'Last-Modified')
+
+
+def _cache_response(cache, key, rv):
+    """Store a 200 response in the cache
+
+    returns: the response, as a Response object if it was cached
+    """
+    if not isinstance(rv, Response):
+        data, code, headers = unpack(rv)
+        if code != 200:
+            return rv
+        rv = output_json(data, code, headers)
+        rv.headers['Content-Type'] = 'application/json'
+    if rv.status_code != 200 or rv.is_streamed:
+        return rv
+    headers = [(k, v) for k, v in rv.headers.items() if k not in UNCACHED_HEADERS]
+    cache.set(key, (rv.status_code, headers, rv.get_data()))
+    return rv
+
+
+def conditional(Doa, dependent_tables=None):
+    """Resource decorator answering conditional GETs with 304
+
+    `If-None-Match` and `If-Modified-Since` are checked against the
+    table version counters before the resource runs any query.
+    With a response cache, responses are also cached under the ETag and
+    user level, so writes to any table a response depends on lead to
+    new keys and stale entries are never served.
+    `dependent_tables(**kwargs)` gives the tables a response depends on
+    when they are not those of a `Doa` collection.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return func(*args, **kwargs)
+            tables = dependent_tables(**kwargs) if dependent_tables else None
+            etag, modified = get_validators(Doa, request.args, tables)
+            headers = {'ETag': quote_etag(etag)}
+            if modified is not None:
+                headers['Last-Modified'] = http_date(modified)
+            if request.if_none_match:
+                if etag in request.if_none_match:
+                    return Response(status=304, headers=headers)
+            elif modified is not None and request.if_modified_since\
+                    and modified <= request.if_modified_since:
+                return Response(status=304, headers=headers)
+            cache = current_app.response_cache
+            # Streamed collections are not cached
+            if cache is None or 'stream' in request.args:
+                return _with_headers(func(*args, **kwargs), headers)
+            _, level = get_identify(request)
+            key = f"{etag}:{level}"
+            # HEAD of a collection only computes the count
+            if request.method == 'HEAD':
+                key += ':HEAD'
+            entry = cache.get(key)
+            if entry is not None:
+                status, cached_headers, body = entry
+                return _with_headers(Response(body, status, cached_headers), headers)
+            rv = _cache_response(cache, key, func(*args, **kwargs))
+            return _with_headers(rv, headers)
+        return wrapper
+    return decorator
+
+
+def post_many(Doa, items, validate=None, build=None, defaults=None, check=None):
+    """Create rows from a JSON array in one transaction
+
+    Invalid items are reported without touching the database. `check`
+    takes the valid [(index, data)] and returns {index: message} of
+    items conflicting with existing rows, reported as 409. With
+    `atomic=false` valid items are created even if others fail,
+    otherwise nothing is created unless every item succeeds.
+
+    returns: response body with a result per item and status code
+    """
+    atomic = request.args.get('atomic', 'true').lower() not in ('false', '0', 'no')
+    if validate is None:
+        validate = partial(validate_input, Doa)
+    endpoint = ENDPOINT_MAP[Doa.__table__.name]
+    results = [None] * len(items)
+    valid = []
+    for i, data in enumerate(items):
+        if isinstance(data, dict):
+            data = filter_empty_strings(dict(data, **(defaults or {})))
+            if validate(data):
+                valid.append((i, data))
+                continue
+        results[i] = {"status": 400, "error": "Invalid JSON input"}
+    if valid and check is not None:
+        conflicts = check(valid)
+        for i, message in conflicts.items():
+            results[i] = {"status": 409, "error": message}
+        valid = [(i, data) for i, data in valid if i not in conflicts]
+    if valid and not (atomic and len(valid) < len(items)):
+        added = add_many(Doa, [data for _, data in valid], build, atomic)
+        for (i, _), (id_, error) in zip(valid, added):
+            if error is None:
+                results[i] = {"status": 201, "link": f"/api/v1/{endpoint}/{id_}", "id": id_}
+            else:
+                results[i] = {"status": 409, "error": f"SQL Integrity Error - {error}"}
+    failed = [r["status"] for r in results if r is not None and r["status"] != 201]
+    if atomic and failed:
+        # Nothing was created
+        for i, r in enumerate(results):
+            if r is None or r["status"] == 201:
+                results[i] = {"status": 424, "error": "Not created, another item failed"}
+        return {"success": False, "results": results}, 400 if 400 in failed else 409
+    if failed:
+        return {"success": False, "results": results}, 207
+    return {"success": True, "results": results}, 201
+
+
+FRACTION_NAME = re.compile(r'^RL(\w+?)-(\d+)([A-Za-z]\w*)$')
+# End of a range, the library may be left out: RLABC-0001A..0050E
+FRACTION_RANGE_END = re.compile(r'^(?:RL(\w+?)-)?(\d+)([A-Za-z]\w*)$')
+
+
+def _fraction_name(abbrev, number, code):
+    # Same format as Extract.build_name / Fraction.build_name
+    return "RL{}-{:04d}{}".format(abbrev, number, code)
+
+
+def _code_range(first, last):
+    if first == last:
+        return [first]
+    if len(first) != 1 or len(last) != 1 or first > last:
+        raise ValidationException(f"Invalid code range {first}..{last}")
+    return [chr(x) for x in range(ord(first), ord(last) + 1)]
+
+
+def parse_fraction_names(items, limit):
+    """Parse fraction names and ranges such as RLABC-0001A..0050E
+
+    A range is every fraction of the numbers and codes between its
+    ends. Ranges are returned as the bounds of the names they cover,
+    so each can be fetched with one scan of the name index, and other
+    names are returned to be looked up individually.
+
+    returns: (all names in order, other names, [(first, last)])
+    """
+    names = {}
+    singles = {}
+    spans = []
+    for item in items:
+        if not isinstance(item, str):
+            raise ValidationException(f"Invalid fraction name {item}")
+        first, sep, last = item.strip().partition('..')
+        m = FRACTION_NAME.match(first)
+        n = FRACTION_RANGE_END.match(last) if sep else m
+        if not (m and n):
+            raise ValidationException(f"Invalid fraction name {item}")
+        if not sep:
+            # Already formatted unless the number is not 4 digits
+            if len(m.group(2)) != 4:
+                first = _fraction_name(m.group(1), int(m.group(2)), m.group(3))
+            names[first] = singles[first] = None
+            continue
+        abbrev, number, code = m.group(1), int(m.group(2)), m.group(3)
+        last_number, last_code = int(n.group(2)), n.group(3)
+        if n.group(1) not in (None, abbrev) or number > last_number:
+            raise ValidationException(f"Invalid fraction range {item}")
+        codes = _code_range(code, last_code)
+        if len(names) + (last_number - number + 1) * len(codes) > limit:
+            raise ValidationException(f"More than {limit} fraction names")
+        expanded = [_fraction_name(abbrev, i, c) for i in range(number, last_number + 1) for c in codes]
+        names.update(dict.fromkeys(expanded))
+        bounds = (expanded[0], expanded[-1])
+        # Names only sort like numbers when zero padded to the same width
+        if len(bounds[0]) - len(code) == len(bounds[1]) - len(last_code):
+            spans.append(bounds)
+        else:
+            singles.update(dict.fromkeys(expanded))
+    if len(names) > limit:
+        raise ValidationException(f"More than {limit} fraction names")
+    return list(names), list(singles), spans
 
 
 def validate_input(Doa, data):
@@ -265,7 +1613,7 @@ def validate_isolate_input(data):
     }
     """
     data_copy = data.copy()
-    stock = data_copy.pop("stock")
+    stock = data_copy.pop("stock", None)
     if not stock:
         return False
     return validate_input(Isolate, data_copy)
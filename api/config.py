@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 
 class Config(object):
@@ -8,6 +9,61 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     BASE_URL = os.getenv('BASE_URL', "localhost")
+    # Keyset pagination page sizes
+    PAGE_SIZE = int(os.getenv('PAGE_SIZE', 100))
+    PAGE_SIZE_MAX = int(os.getenv('PAGE_SIZE_MAX', 1000))
+    # Rows fetched per query when streaming collections
+    STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 500))
+    # Response cache backend: 'memory' (per worker LRU), 'disk' (SQLite
+    # file shared by the workers of a host) or 'none'
+    RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', 'none')
+    RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 512))
+    # Bytes of bodies held by the memory cache of each worker
+    RESPONSE_CACHE_MEMORY_BYTES = int(os.getenv('RESPONSE_CACHE_MEMORY_BYTES', 64 * 1024 * 1024))
+    RESPONSE_CACHE_FILE = os.getenv('RESPONSE_CACHE_FILE',
+        os.path.join(tempfile.gettempdir(), 'api_response_cache.db'))
+    RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+    # Larger bodies are not cached by either backend
+    RESPONSE_CACHE_ENTRY_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_ENTRY_MAX_BYTES', 1024 * 1024))
+    # Rows committed per chunk when importing CSV/TSV files
+    IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', 1000))
+    # Most fraction names resolved per request, after expanding ranges
+    FRACTION_RESOLVE_MAX = int(os.getenv('FRACTION_RESOLVE_MAX', 200000))
+    # New dive sites closer than this (km) to an existing one are
+    # rejected as duplicates unless posted with ?force=true
+    DIVE_SITE_DUPLICATE_KM = float(os.getenv('DIVE_SITE_DUPLICATE_KM', 0.1))
+    # k-mer sketches of isolate sequences shared by the workers of a host,
+    # built by `python -m api.common.kmers`
+    SEQUENCE_INDEX_FILE = os.getenv('SEQUENCE_INDEX_FILE',
+        os.path.join(tempfile.gettempdir(), 'api_sequence_index.db'))
+    # ASGI serving mode (api.asgi): threads running requests per process,
+    # and response chunks queued before a request waits for a slow client
+    ASGI_THREADS = int(os.getenv('ASGI_THREADS', 16))
+    ASGI_SEND_BUFFER = int(os.getenv('ASGI_SEND_BUFFER', 16))
+    # Read replicas serving GET requests, comma separated database URLs
+    REPLICA_DATABASE_URIS = [x for x in os.getenv('REPLICA_DATABASE_URLS', '').split(',') if x]
+    # Seconds a user or client reads from the primary after writing,
+    # through a SQLite file shared by the workers of a host
+    REPLICA_PIN_SECONDS = float(os.getenv('REPLICA_PIN_SECONDS', 10))
+    REPLICA_PIN_FILE = os.getenv('REPLICA_PIN_FILE',
+        os.path.join(tempfile.gettempdir(), 'api_replica_pins.db'))
+    # Cookie identifying anonymous clients that wrote
+    REPLICA_PIN_COOKIE = os.getenv('REPLICA_PIN_COOKIE', 'read_primary')
+    # Replicas further behind the primary (seconds) are skipped, lag is
+    # checked at most every REPLICA_LAG_CHECK seconds per worker
+    REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 5))
+    REPLICA_LAG_CHECK = float(os.getenv('REPLICA_LAG_CHECK', 1))
+    REPLICA_CONNECT_TIMEOUT = int(os.getenv('REPLICA_CONNECT_TIMEOUT', 2))
+    # Per-worker token identity cache, 0 TTL disables caching
+    # Hits are checked against the revoked token ids shared by all workers
+    AUTH_CACHE_TTL = int(os.getenv('AUTH_CACHE_TTL', 60))
+    AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', 1024))
+    # 'database' checks tokens against user_token, 'stateless' trusts
+    # verified claims and checks revoked token ids shared through a file
+    AUTH_MODE = os.getenv('AUTH_MODE', 'database')
+    AUTH_REVOCATION_FILE = os.getenv('AUTH_REVOCATION_FILE',
+        os.path.join(tempfile.gettempdir(), 'api_revoked_tokens.db'))
+    AUTH_REVOCATION_REFRESH = float(os.getenv('AUTH_REVOCATION_REFRESH', 1))
 
 
 class DevelopmentConfig(Config):
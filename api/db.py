@@ -1,26 +1,220 @@
+import datetime
 from contextlib import contextmanager
+from functools import partial
+from itertools import chain
 
-from flask import abort, current_app
-from sqlalchemy import create_engine
+from flask import abort, current_app, g, has_app_context, has_request_context
+from sqlalchemy import (and_, bindparam, create_engine, event, func, inspect,
+                        or_, select)
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm import Session as OrmSession
+from sqlalchemy.orm import aliased, scoped_session, sessionmaker
+from sqlalchemy.orm.interfaces import ONETOMANY
 
+from api.common.geo import (MAX_DISTANCE_KM, bbox_around, geohash_prefixes,
+                            haversine_km, split_bbox)
+from api.common.replicas import PRIMARY_TABLES, ReplicaRouter, set_pin_cookie
+from api.common.search import (SEARCH_TABLES, fulltext_query,
+                               index_search_text, init_search_index)
 from api.common.sql_models import Base
-from api.models import (Diver, Extract, Fraction, Isolate, IsolateStock, Library, Media,
-                        MediaRecipe, Sample)
+from api.models import (Diver, DiveSite, Extract, Fraction,
+                        FractionScreenPlate, Isolate, IsolateStock, Library,
+                        Media, MediaRecipe, Sample, ScreenPlate, TableVersion)
 
-Session = scoped_session(sessionmaker(autoflush=True, autocommit=False))
+
+class RoutingSession(OrmSession):
+    """Session reading from a replica during read-only requests
+
+    Flushes, DML and the user tables always use the primary, as does the
+    rest of a request once it wrote. See `api.common.replicas`.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        router = getattr(current_app, 'replicas', None) if has_request_context() else None
+        if (router is None or not router.engines or self._flushing
+                or getattr(clause, 'is_dml', False)
+                or getattr(mapper, 'local_table', None) is not None
+                and mapper.local_table.name in PRIMARY_TABLES):
+            return super().get_bind(mapper, clause)
+        if 'read_engine' not in g:
+            g.read_engine = router.read_engine()
+        return g.read_engine
+
+
+Session = scoped_session(sessionmaker(class_=RoutingSession, autoflush=True, autocommit=False))
 
 def init_db(app=current_app):
     app.engine = create_engine(app.config.get('SQLALCHEMY_DATABASE_URI'), pool_size=8, pool_pre_ping=True)
     
+    if app.engine.dialect.name == 'sqlite':
+        _sqlite_transactions(app.engine)
     Session.configure(bind=app.engine)
     Base.metadata.create_all(bind=app.engine)
+    init_table_versions(app.engine)
+    app.search_indexed = init_search_index(app.engine)
+    missing = set(SEARCH_TABLES) - app.search_indexed
+    if missing and app.engine.dialect.name == 'mysql':
+        app.logger.warning("No full-text index on %s, searching with LIKE. "
+                           "Run python -m api.common.search", ', '.join(sorted(missing)))
+    app.replicas = ReplicaRouter(app.engine, app.config)
 
     def teardown_session(exception=None):
         Session.remove()
 
     app.teardown_request(teardown_session)
+    app.after_request(set_pin_cookie)
+
+
+def _sqlite_transactions(engine):
+    # pysqlite defers BEGIN, which breaks SAVEPOINT, emit it ourselves
+    @event.listens_for(engine, "connect")
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def do_begin(conn):
+        conn.execute("BEGIN")
+
+
+def init_table_versions(engine):
+    """Add a version counter row for every table missing one"""
+    table = TableVersion.__table__
+    with engine.begin() as conn:
+        existing = {name for name, in conn.execute(select([table.c.name]))}
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        missing = [{'name': name, 'version': 0, 'modified': now}
+                   for name in Base.metadata.tables if name not in existing]
+        if missing:
+            conn.execute(table.insert(), missing)
+
+
+def collect_tables(session, flush_context):
+    """Remember the tables a flush wrote, see `bump_table_versions`"""
+    written_tables(session, {
+        obj.__table__.name for obj in chain(session.new, session.dirty, session.deleted)})
+
+
+def written_tables(session, tables):
+    """Add to the tables whose versions are bumped when `session` commits"""
+    session.info.setdefault('tables', set()).update(tables)
+
+
+def bump_table_versions(session):
+    """Bump the versions of the tables a committed transaction wrote
+
+    A single UPDATE in its own transaction after the commit, so writers
+    don't hold the version row locks for their whole transaction.
+    Cached responses only need the new versions once the writes are
+    visible.
+    """
+    # Savepoints commit too, wait for the outermost transaction
+    if session.transaction.nested:
+        return
+    tables = session.info.pop('tables', None)
+    if tables:
+        with session.bind.begin() as conn:
+            bump_versions(conn, tables)
+
+
+def discard_tables(session, previous_transaction):
+    # Tables of rolled back savepoints are bumped anyway, harmlessly
+    if previous_transaction.parent is None:
+        session.info.pop('tables', None)
+
+
+def bump_versions(conn, tables):
+    """Bump the version of the named tables"""
+    if not tables:
+        return
+    table = TableVersion.__table__
+    conn.execute(
+        table.update()
+        # Rows are locked in name order
+        .where(table.c.name.in_(sorted(tables)))
+        .values(version=table.c.version + 1,
+                modified=datetime.datetime.utcnow().replace(microsecond=0))
+    )
+
+
+event.listen(Session.session_factory, 'after_flush', collect_tables)
+event.listen(Session.session_factory, 'after_commit', bump_table_versions)
+event.listen(Session.session_factory, 'after_soft_rollback', discard_tables)
+event.listen(Session.session_factory, 'after_flush', index_search_text)
+
+
+def collect_sequences(session, flush_context):
+    """Remember isolates whose sequence a flush wrote, see `index_sequences`"""
+    changed = session.info.setdefault('sequences', {})
+    for obj in chain(session.new, session.dirty):
+        if isinstance(obj, Isolate) and (obj in session.new
+                                         or inspect(obj).attrs.sequence.history.has_changes()):
+            changed[obj.id] = obj.sequence
+    for obj in session.deleted:
+        if isinstance(obj, Isolate):
+            changed[obj.id] = None
+
+
+def index_sequences(session):
+    """Sketch the committed isolate sequences in the app's sequence index"""
+    changed = session.info.pop('sequences', None)
+    if changed and has_app_context():
+        index = getattr(current_app, 'sequence_index', None)
+        if index is not None:
+            index.add(list(changed.items()))
+
+
+def discard_sequences(session, previous_transaction=None):
+    session.info.pop('sequences', None)
+
+
+def note_write(session, flush_context):
+    """Send the rest of a request writing to the primary"""
+    session.info['wrote'] = True
+    if has_request_context() and getattr(current_app, 'replicas', None) is not None:
+        g.read_engine = current_app.replicas.primary
+
+
+def pin_writer(session):
+    """Read the next requests of a writer from the primary, see `ReplicaRouter.wrote`"""
+    if session.info.pop('wrote', None) and has_request_context():
+        router = getattr(current_app, 'replicas', None)
+        if router is not None and router.engines:
+            router.wrote()
+
+
+event.listen(Session.session_factory, 'after_flush', note_write)
+event.listen(Session.session_factory, 'after_commit', pin_writer)
+event.listen(Session.session_factory, 'after_flush', collect_sequences)
+event.listen(Session.session_factory, 'after_commit', index_sequences)
+event.listen(Session.session_factory, 'after_rollback', discard_sequences)
+
+
+def iter_isolate_sequences(after=0, batch_size=1000, sess=Session):
+    """Isolates with a sequence and an id above `after`, by id
+
+    returns: iterator of [(isolate id, sequence)] batches
+    """
+    while True:
+        batch = sess.query(Isolate.id, Isolate.sequence)\
+            .filter(Isolate.sequence != None, Isolate.id > after)\
+            .order_by(Isolate.id).limit(batch_size).all()
+        if not batch:
+            return
+        yield batch
+        after = batch[-1][0]
+
+
+def get_isolate_names(ids, sess=Session):
+    """returns: {isolate id: name} of the existing isolates"""
+    if not ids:
+        return {}
+    return dict(sess.query(Isolate.id, Isolate.name).filter(Isolate.id.in_(ids)))
+
+
+def get_table_versions(sess=Session):
+    """returns: {table name: (version, last modified)}"""
+    table = TableVersion.__table__
+    return {name: (version, modified) for name, version, modified in sess.execute(select([table]))}
 
 
 @contextmanager
@@ -122,26 +316,456 @@ def add_media_with_recipe(data):
         abort(409, "SQL Integrity Error - possible duplicate or missing field")
     
 
-def get_one(cls, id_, sess=Session):
-    return sess.query(cls).filter_by(id=id_).one()
+def build_rows(cls, items, sess):
+    return [cls(**data) for data in items]
+
+
+def build_samples(items, sess):
+    """Build samples, looking up divers for all items in one query
+    """
+    diver_ids = {i for data in items for i in data.get('diver_ids', [])}
+    divers = {}
+    if diver_ids:
+        divers = {d.id: d for d in sess.query(Diver).filter(Diver.id.in_(diver_ids))}
+    samples = []
+    for data in items:
+        data = data.copy()
+        ids = data.pop('diver_ids', [])
+        sample = Sample(**data)
+        sample.divers = [divers[i] for i in ids if i in divers]
+        samples.append(sample)
+    return samples
+
+
+def build_isolates(items, sess):
+    """Build isolates with their stock
+    """
+    isolates = []
+    for data in items:
+        data = data.copy()
+        stock = data.pop("stock")
+        isolate = Isolate(**data)
+        isolate.stocks = [IsolateStock(**stock)]
+        isolates.append(isolate)
+    return isolates
+
+
+def build_media(items, sess):
+    """Build media with recipes
+    """
+    media = []
+    for data in items:
+        m = Media(**data['media'])
+        for r in data['recipe']:
+            m.recipe.append(MediaRecipe(**r))
+        media.append(m)
+    return media
+
+
+def _add_each(sess, objs, key):
+    # One savepoint per row so failures can be reported per item
+    results = []
+    for obj in objs:
+        try:
+            with sess.begin_nested():
+                sess.add(obj)
+        except IntegrityError as e:
+            results.append((None, str(e.orig)))
+        else:
+            results.append((getattr(obj, key), None))
+    return results
+
+
+def _detach_children(cls, objs):
+    """Take the one-to-many children (stocks, recipes) off new rows
+
+    returns: [(relationship, [(parent, [child attributes])])]
+    """
+    detached = []
+    for rel in cls.__mapper__.relationships:
+        if rel.direction is not ONETOMANY or rel.secondary is not None:
+            continue
+        columns = {c.key for c in rel.mapper.column_attrs}
+        rows = []
+        for obj in objs:
+            children = inspect(obj).dict.get(rel.key)
+            if not children:
+                continue
+            rows.append((obj, [{k: v for k, v in inspect(child).dict.items() if k in columns}
+                               for child in children]))
+            setattr(obj, rel.key, [])
+        if rows:
+            detached.append((rel, rows))
+    return detached
+
+
+def _insert_children(sess, detached):
+    # The parents were flushed, set their keys and insert each child
+    # table with one executemany
+    for rel, rows in detached:
+        mappings = []
+        for parent, children in rows:
+            for local, remote in rel.local_remote_pairs:
+                value = getattr(parent, rel.parent.get_property_by_column(local).key)
+                for child in children:
+                    child[rel.mapper.get_property_by_column(remote).key] = value
+            mappings.extend(children)
+        sess.bulk_insert_mappings(rel.mapper, mappings)
+    written_tables(sess, {rel.mapper.local_table.name for rel, _ in detached})
+
+
+def add_many(cls, items, build=None, atomic=True):
+    """Add many rows in a single transaction
+
+    Rows are flushed together, parent rows one INSERT each since their
+    generated ids are needed. Association rows (sample divers) are then
+    inserted with executemany by the unit of work, and child rows
+    (stocks, recipes) with one executemany per table once their parent
+    ids are known. If that fails rows are added again one savepoint at a
+    time to find the failing ones. In atomic mode nothing is committed if
+    any row fails, otherwise the rows that can be inserted are committed.
+
+    returns: [(id, None) or (None, integrity error message)] per item
+    """
+    if build is None:
+        build = partial(build_rows, cls)
+    key = get_primary_key(cls).key
+    sess = Session()
+    try:
+        objs = build(items, sess)
+        try:
+            detached = _detach_children(cls, objs)
+            sess.add_all(objs)
+            sess.flush()
+            _insert_children(sess, detached)
+        except IntegrityError:
+            sess.rollback()
+        else:
+            results = [(getattr(obj, key), None) for obj in objs]
+            sess.commit()
+            return results
+        results = _add_each(sess, build(items, sess), key)
+        if atomic and any(error for _, error in results):
+            sess.rollback()
+        else:
+            sess.commit()
+        return results
+    except:
+        sess.rollback()
+        raise
+    finally:
+        sess.close()
+
+
+def get_primary_key(cls):
+    """Primary key column used as the pagination cursor
+
+    Every model has a single column primary key,
+    `id` for most tables and `abbrev` for Library.
+    """
+    return cls.__mapper__.primary_key[0]
 
 
-def get_all(cls, sess=Session):
-    return sess.query(cls).all()
+def get_one(cls, id_, sess=Session, options=()):
+    return sess.query(cls).options(*options).filter_by(id=id_).one()
 
 
-def search_query(cls, query_parameters, sess=Session):
-    # Filter empty query parameters
-    query = dict(filter(lambda x: x[1]!=None, query_parameters.items()))
-    # unpack query parameters as kwargs
-    return sess.query(cls).filter_by(**query).all()
+def get_all(cls, sess=Session, options=()):
+    return sess.query(cls).options(*options).all()
+
+
+def build_query(cls, query_parameters=None, sess=Session, options=(), filters=()):
+    """Build (but do not run) a collection query
+
+    `filters` are SQLAlchemy expressions, see `utils.get_filters`.
+    """
+    query = sess.query(cls).options(*options).filter(*filters)
+    if query_parameters:
+        # Filter empty query parameters
+        query_parameters = dict(filter(lambda x: x[1]!=None, query_parameters.items()))
+        # unpack query parameters as kwargs
+        query = query.filter_by(**query_parameters)
+    return query
+
+
+def search_query(cls, query_parameters, sess=Session, options=()):
+    return build_query(cls, query_parameters, sess=sess, options=options).all()
+
+
+def bbox_filter(south, west, north, east):
+    """Dive sites inside a bounding box
+
+    The geohash cells covering the box are index ranges of
+    `dive_site.geohash`, refined with the exact coordinates.
+    """
+    clauses = []
+    for s, w, n, e in split_bbox(south, west, north, east):
+        in_box = and_(DiveSite.lat.between(s, n), DiveSite.lon.between(w, e))
+        prefixes = geohash_prefixes(s, w, n, e)
+        if prefixes:
+            in_box = and_(or_(*[DiveSite.geohash.like(p + '%') for p in prefixes]), in_box)
+        clauses.append(in_box)
+    return or_(*clauses)
+
+
+def sites_within(lat, lon, radius_km, sess=Session, filters=()):
+    """Dive sites within `radius_km` by great circle distance
+
+    returns: [(distance in km, site id)], nearest first
+    """
+    query = sess.query(DiveSite.id, DiveSite.lat, DiveSite.lon)\
+                .filter(bbox_filter(*bbox_around(lat, lon, radius_km)), *filters)
+    found = sorted((haversine_km(lat, lon, site_lat, site_lon), id_) for id_, site_lat, site_lon in query)
+    return [x for x in found if x[0] <= radius_km]
+
+
+# First search radius of `nearest_sites`, multiplied until enough sites are found
+NEAREST_START_KM = 10.0
+
+
+def nearest_sites(lat, lon, k, max_km=MAX_DISTANCE_KM, sess=Session, filters=()):
+    """The `k` dive sites nearest to a point, within `max_km`
+
+    returns: [(distance in km, site id)], nearest first
+    """
+    radius = min(NEAREST_START_KM, max_km)
+    while True:
+        found = sites_within(lat, lon, radius, sess, filters)
+        # Sites outside the radius are all further than those inside
+        if len(found) >= k or radius >= max_km:
+            return found[:k]
+        radius = min(radius * 4, max_km)
+
+
+def search_rows(terms, tables, limit, after=None, sess=Session):
+    """Full-text search, see `api.common.search`
+
+    returns: [(resource table, primary key string, score)], best first
+    """
+    dialect = sess.get_bind().dialect.name
+    indexed = getattr(current_app, 'search_indexed', None) if has_app_context() else None
+    return sess.execute(fulltext_query(dialect, terms, tables, limit, after, indexed)).fetchall()
+
+
+def get_plate_layout(plate_id, sess=Session):
+    """A screen plate with the fraction, extract and library of each well
+
+    One joined query, plate columns are repeated on every well row.
+
+    returns: [row], one row with NULL wells for an empty plate, [] without plate
+    """
+    plate = ScreenPlate.__table__
+    wells = FractionScreenPlate.__table__
+    fraction = Fraction.__table__
+    extract = Extract.__table__
+    library = Library.__table__
+    query = select([
+        plate.c.id, plate.c.name, plate.c.well_format,
+        wells.c.id.label('well_id'), wells.c.well, wells.c.notes,
+        fraction.c.id.label('fraction_id'), fraction.c.name.label('fraction'),
+        extract.c.id.label('extract_id'), extract.c.name.label('extract'),
+        library.c.abbrev.label('library'), library.c.name.label('library_name'),
+    ]).select_from(
+        plate.outerjoin(wells, wells.c.screen_plate_id == plate.c.id)
+             .outerjoin(fraction, fraction.c.id == wells.c.fraction_id)
+             .outerjoin(extract, extract.c.id == fraction.c.extract_id)
+             .outerjoin(library, library.c.abbrev == extract.c.library_abbrev)
+    ).where(plate.c.id == plate_id)
+    return sess.execute(query).fetchall()
+
+
+def count_query(cls, query):
+    """COUNT of a collection query, without loading any rows"""
+    # Counting the primary key keeps the FROM clause of the query
+    return query.with_entities(func.count(get_primary_key(cls))).order_by(None).scalar()
+
+
+def get_table_counts(tables, sess=Session):
+    """Row counts of several tables in one query
+
+    returns: {table name: count}
+    """
+    metadata = Base.metadata.tables
+    counts = [select([func.count()]).select_from(metadata[x]).as_scalar().label(x) for x in tables]
+    return dict(sess.execute(select(counts)).first().items())
+
+
+AGGREGATES = {'count': func.count, 'min': func.min, 'max': func.max, 'avg': func.avg, 'sum': func.sum}
+
+
+def stats_query(cls, group_by, aggregates, filters=(), sess=Session):
+    """GROUP BY query of aggregates over a collection
+
+    `group_by` columns may be on related rows, which are outer joined
+    once per relationship path so rows without them form a NULL group.
+    See `utils.get_group_by` and `utils.get_aggregates`.
+
+    returns: query of (group values..., aggregate values...)
+    """
+    pk = get_primary_key(cls)
+    joined = {}
+    joins = []
+    group_columns = []
+    for _, path, key in group_by:
+        entity = cls
+        for i, (_, attr, _, Sub) in enumerate(path):
+            prefix = tuple(x[1] for x in path[:i + 1])
+            if prefix not in joined:
+                joined[prefix] = aliased(Sub)
+                joins.append((joined[prefix], getattr(entity, attr)))
+            entity = joined[prefix]
+        group_columns.append(getattr(entity, key))
+    values = [AGGREGATES[function](getattr(cls, key) if key else pk)
+              for _, function, key in aggregates]
+    query = sess.query(*group_columns, *values).select_from(cls)
+    for target, relationship in joins:
+        query = query.outerjoin(target, relationship)
+    return query.filter(*filters).group_by(*group_columns).order_by(*group_columns)
+
+
+def get_order(cls, order=()):
+    """Sort keys (column, descending) ending with the primary key
+
+    The primary key breaks ties in the direction of the last key,
+    so an index on that key (which includes the primary key) can
+    be read in one direction.
+    """
+    pk = get_primary_key(cls)
+    order = [(cls.__table__.columns[key], desc) for key, desc in order]
+    if not any(column is pk for column, _ in order):
+        order.append((pk, order[-1][1] if order else False))
+    return order
+
+
+def _after_key(order, after):
+    """Rows sorted after the key `after` in `order`
+
+    NULL sorts first in ascending order, as in MySQL and SQLite.
+    """
+    clauses = []
+    equal = []
+    for (column, desc), value in zip(order, after):
+        if value is None:
+            later = None if desc else column.isnot(None)
+        elif desc:
+            later = or_(column < value, column.is_(None))
+        else:
+            later = column > value
+        if later is not None:
+            clauses.append(and_(*equal, later))
+        equal.append(column.is_(None) if value is None else column == value)
+    return or_(*clauses)
+
+
+def paginate(cls, query, limit, after=None, order=None):
+    """Keyset pagination over the sort keys of `order`
+
+    Without `order` rows are sorted by primary key and `after` is a
+    primary key, otherwise `after` is the tuple of sort key values of
+    the last row of the previous page (see `get_order`).
+    Fetches one extra row to know if there is a following page
+    without running a COUNT.
+
+    returns: (rows, key of the last row or None if last page)
+    """
+    keys = get_order(cls, order or ())
+    if after is not None:
+        query = query.filter(_after_key(keys, after if order else (after,)))
+    rows = query.order_by(*[c.desc() if desc else c for c, desc in keys]).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = tuple(getattr(rows[-1], c.key) for c, _ in keys)
+    return rows, last if order else last[0]
+
+
+def get_link_ids(cls, rel, keys, sess=Session, chunk_size=1000):
+    """Ids of related rows for a collection relationship, by parent key
+
+    Id-only queries against the related (or association) table,
+    without loading the related objects.
+
+    returns: {parent key: [related ids]}
+    """
+    prop = cls.__mapper__.relationships[rel]
+    (_, remote_col), = prop.synchronize_pairs
+    if prop.secondary is not None:
+        (_, related_col), = prop.secondary_synchronize_pairs
+    else:
+        related_col = get_primary_key(prop.mapper.class_)
+    keys = [k for k in keys if k is not None]
+    ids = {}
+    # Expanding IN, chunks are bound as lists instead of one parameter per key
+    query = sess.query(remote_col, related_col)\
+                .filter(remote_col.in_(bindparam('keys', expanding=True)))\
+                .order_by(remote_col, related_col)
+    for i in range(0, len(keys), chunk_size):
+        for key, id_ in query.params(keys=keys[i:i + chunk_size]):
+            ids.setdefault(key, []).append(id_)
+    return ids
+
+
+def iter_pages(cls, query, page_size, after=None, order=None):
+    """Iterate over a whole query as consecutive keyset pages
+
+    Each page is an independent, fully fetched query so
+    relationship loads can run between pages.
+    """
+    while True:
+        rows, after = paginate(cls, query, page_size, after, order)
+        yield rows
+        if after is None:
+            break
+
+
+def name_filter(cls, name):
+    """Filter on persisted name, a prefix search if it ends with `*`
+
+    Both are a seek on the unique `name` index.
+    """
+    if name.endswith('*'):
+        prefix = name[:-1].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return cls.name.like(prefix + '%', escape='\\')
+    return cls.name == name
+
+
+def fraction_name_query(fraction_name, sess=Session):
+    return sess.query(Fraction).filter(name_filter(Fraction, fraction_name))
 
 
 def get_fraction_by_name(fraction_name, sess=Session):
-    lib_abbrev = fraction_name.split('-')[0].replace('RL', '')
-    extract_num = fraction_name.split('-')[-1][:4]
-    prefac_code = fraction_name[-1]
-    return sess.query(Fraction).filter(Fraction.code == prefac_code)\
-                .join(Extract).filter(Extract.number == extract_num)\
-                .join(Library).filter(Library.abbrev == lib_abbrev)\
-                .first()
+    return fraction_name_query(fraction_name, sess=sess).first()
+
+
+def resolve_fraction_names(names, singles=(), spans=(), sess=Session, chunk_size=1000):
+    """Fractions and their screen plates for many names at once
+
+    `spans` (first, last) are fetched with a range scan of the name
+    index and `singles` with chunked IN queries. Rows are only kept
+    for `names`.
+
+    returns: {name: {id, extract_id, screen_plates: [screen plate ids]}}
+    """
+    fraction = Fraction.__table__
+    plate = FractionScreenPlate.__table__
+    base = select([fraction.c.name, fraction.c.id, fraction.c.extract_id, plate.c.screen_plate_id])\
+        .select_from(fraction.outerjoin(plate, plate.c.fraction_id == fraction.c.id))
+    queries = [(base.where(fraction.c.name.between(lo, hi)), {}) for lo, hi in spans]
+    in_names = base.where(fraction.c.name.in_(bindparam('names', expanding=True)))
+    queries += [(in_names, {'names': singles[i:i + chunk_size]})
+                for i in range(0, len(singles), chunk_size)]
+    wanted = set(names)
+    found = {}
+    for statement, params in queries:
+        rows = {}
+        for name, id_, extract_id, plate_id in sess.execute(statement, params).fetchall():
+            row = rows.get(name)
+            if row is None:
+                row = rows[name] = {"id": id_, "extract_id": extract_id, "screen_plates": []}
+            if plate_id is not None:
+                row["screen_plates"].append(plate_id)
+        # A name in a range may also have been asked for on its own
+        for name, row in rows.items():
+            if name in wanted:
+                found.setdefault(name, row)
+    return found
@@ -0,0 +1,269 @@
+"""Import CSV/TSV files of samples, isolates, extracts and fractions
+
+Rows are streamed from the file, validated and inserted in chunks that
+are committed one at a time, so memory use does not depend on the size
+of the file. Foreign keys given by name (dive site, diver, library,
+sample, isolate, media, extract) are resolved with one query per
+lookup per chunk. A file that cannot be read to the end (bad encoding,
+malformed CSV, corrupt gzip) stops the import after the rows before it
+were committed.
+
+    python -m api.importer samples samples.csv.gz --chunk-size 1000
+"""
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import zlib
+from itertools import islice
+
+from api.common.exc import ValidationException
+from api.common.utils import (convert_value, filter_empty_strings,
+                              validate_input, validate_isolate_input,
+                              validate_sample_input)
+from api.db import Session, add_many, build_isolates, build_samples
+from api.models import (Diver, DiveSite, Extract, Fraction, Isolate,
+                        IsolateStock, Library, Media, Permit, Sample,
+                        SampleType)
+
+# Isolate stock columns are given as `stock_<column>`
+STOCK_PREFIX = 'stock_'
+# Several divers in one cell, as "First Last; First Last"
+DIVER_SEPARATOR = ';'
+
+DELIMITERS = {'csv': ',', 'tsv': '\t'}
+# Raised while reading the rows of a file
+READ_ERRORS = (csv.Error, UnicodeDecodeError, OSError, EOFError, zlib.error)
+
+
+class Lookup(object):
+    """Resolve a column of names to a foreign key
+
+    `name` is the SQL expression matched against the cell values
+    and `id_` the column that is stored in `key`.
+    """
+
+    def __init__(self, field, key, name, id_, many=False):
+        self.field = field
+        self.key = key
+        self.name = name
+        self.id_ = id_
+        self.many = many
+
+    def values(self, cell):
+        if self.many:
+            return [x.strip() for x in cell.split(DIVER_SEPARATOR) if x.strip()]
+        return [cell]
+
+    def resolve(self, names, sess):
+        """returns: {name: id} for names matching exactly one row"""
+        ids = {}
+        for name, id_ in sess.query(self.name, self.id_).filter(self.name.in_(names)):
+            # Ambiguous names are treated as unknown
+            ids[name] = None if name in ids else id_
+        return {k: v for k, v in ids.items() if v is not None}
+
+    def apply(self, data, ids):
+        names = self.values(data.pop(self.field))
+        missing = [x for x in names if x not in ids]
+        if missing:
+            return f"Unknown {self.field} {', '.join(missing)}"
+        resolved = [ids[x] for x in names]
+        data[self.key] = resolved if self.many else resolved[0]
+
+
+class ImportSpec(object):
+    """How to validate, resolve and build the rows of one resource"""
+
+    def __init__(self, Doa, validate, build=None, lookups=(), insert_by=False, stock=False):
+        self.Doa = Doa
+        self.validate = validate
+        self.build = build
+        self.lookups = {x.field: x for x in lookups}
+        self.insert_by = insert_by
+        self.stock = stock
+
+    def check_header(self, header):
+        columns = self.Doa.__table__.columns
+        unknown = []
+        for field in header:
+            if field in self.lookups or field in columns:
+                continue
+            if self.stock and field.startswith(STOCK_PREFIX)\
+                    and field[len(STOCK_PREFIX):] in IsolateStock.__table__.columns:
+                continue
+            unknown.append(field)
+        if unknown:
+            raise ValidationException(f"Unknown columns {', '.join(unknown)}")
+
+    def convert(self, row):
+        """Convert a CSV row to the input expected by `validate`"""
+        # DictReader puts extra cells under None and missing cells are None
+        if None in row:
+            raise ValueError("too many fields")
+        data = {}
+        stock = {}
+        row = {k: v for k, v in row.items() if v is not None}
+        for field, value in filter_empty_strings(row).items():
+            if field in self.lookups:
+                data[field] = value
+            elif field.startswith(STOCK_PREFIX) and self.stock:
+                field = field[len(STOCK_PREFIX):]
+                stock[field] = convert_value(IsolateStock.__table__.columns[field], value)
+            else:
+                data[field] = convert_value(self.Doa.__table__.columns[field], value)
+        if self.stock:
+            data['stock'] = stock
+        return data
+
+
+IMPORTS = {
+    'samples': ImportSpec(Sample, validate_sample_input, build_samples, [
+        Lookup('dive_site', 'dive_site_id', DiveSite.name, DiveSite.id),
+        Lookup('sample_type', 'sample_type_id', SampleType.name, SampleType.id),
+        Lookup('permit', 'permit_id', Permit.name, Permit.id),
+        Lookup('divers', 'diver_ids', Diver.first_name + ' ' + Diver.last_name, Diver.id, many=True),
+    ], insert_by=True),
+    'isolates': ImportSpec(Isolate, validate_isolate_input, build_isolates, [
+        Lookup('sample', 'sample_id', Sample.name, Sample.id),
+        Lookup('media', 'media_id', Media.name, Media.id),
+    ], insert_by=True, stock=True),
+    'extracts': ImportSpec(Extract, lambda data: validate_input(Extract, data), None, [
+        Lookup('library', 'library_abbrev', Library.abbrev, Library.abbrev),
+        Lookup('isolate', 'isolate_id', Isolate.name, Isolate.id),
+        Lookup('media', 'media_id', Media.name, Media.id),
+    ]),
+    'fractions': ImportSpec(Fraction, lambda data: validate_input(Fraction, data), None, [
+        Lookup('extract', 'extract_id', Extract.name, Extract.id),
+    ]),
+}
+
+
+def open_rows(stream, fmt=None, filename=None, compressed=None):
+    """Read a binary stream of CSV or TSV rows as dicts
+
+    Compression and delimiter are taken from the filename when not
+    given, e.g. `samples.tsv.gz`.
+    """
+    filename = (filename or '').lower()
+    if compressed is None:
+        compressed = filename.endswith('.gz')
+    if compressed:
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    if filename.endswith('.gz'):
+        filename = filename[:-3]
+    if fmt is None:
+        fmt = 'tsv' if filename.endswith(('.tsv', '.tab', '.txt')) else 'csv'
+    if fmt not in DELIMITERS:
+        raise ValidationException(f"Invalid format {fmt}")
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    return csv.DictReader(text, delimiter=DELIMITERS[fmt])
+
+
+def import_rows(resource, rows, chunk_size=1000, insert_by=None, max_errors=100):
+    """Validate and insert rows, committing every `chunk_size` rows
+
+    Yields a progress report after each chunk, the last one with `done`
+    set. Errors are reported with the line number of the row in the file,
+    up to `max_errors`. When the file cannot be read further, the rows
+    read before are still inserted and the final report carries the
+    `error` that stopped the import.
+    """
+    spec = IMPORTS[resource]
+    spec.check_header(rows.fieldnames or [])
+    report = {"resource": resource, "rows": 0, "created": 0, "failed": 0, "errors": [],
+              "done": False}
+
+    def error(line, message):
+        report["failed"] += 1
+        if len(report["errors"]) < max_errors:
+            report["errors"].append({"line": line, "error": message})
+
+    # Header is line 1
+    numbered = enumerate(rows, start=2)
+    last = 1
+    while True:
+        chunk = []
+        try:
+            for last, row in islice(numbered, chunk_size):
+                chunk.append((last, row))
+        except READ_ERRORS as e:
+            report["error"] = f"Unreadable file after line {last}, {e}"
+            report["errors"].append({"line": last + 1, "error": report["error"]})
+        report["done"] = "error" in report or len(chunk) < chunk_size
+        if not chunk:
+            yield report
+            break
+        report["rows"] += len(chunk)
+        items = []
+        for line, row in chunk:
+            try:
+                items.append((line, spec.convert(row)))
+            except ValueError as e:
+                error(line, f"Invalid value, {e}")
+        # One query per lookup for the whole chunk
+        sess = Session()
+        for field, lookup in spec.lookups.items():
+            names = {x for _, data in items if field in data for x in lookup.values(data[field])}
+            ids = lookup.resolve(names, sess) if names else {}
+            resolved = []
+            for line, data in items:
+                message = lookup.apply(data, ids) if field in data else None
+                if message:
+                    error(line, message)
+                else:
+                    resolved.append((line, data))
+            items = resolved
+        sess.close()
+        valid = []
+        for line, data in items:
+            if spec.insert_by:
+                data['insert_by'] = insert_by
+            if spec.validate(data):
+                valid.append((line, data))
+            else:
+                error(line, "Invalid row, missing or unknown fields")
+        if valid:
+            added = add_many(spec.Doa, [data for _, data in valid], spec.build, atomic=False)
+            for (line, _), (_, message) in zip(valid, added):
+                if message is None:
+                    report["created"] += 1
+                else:
+                    error(line, f"SQL Integrity Error - {message}")
+        yield report
+        if report["done"]:
+            break
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('resource', choices=sorted(IMPORTS))
+    parser.add_argument('file', help="CSV or TSV file, optionally gzip compressed, - for stdin")
+    parser.add_argument('--format', choices=sorted(DELIMITERS))
+    parser.add_argument('--gzip', action='store_true', default=None)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--insert-by', type=int)
+    parser.add_argument('--config', default=os.getenv('FLASK_ENV', 'development'))
+    args = parser.parse_args(argv)
+
+    from api.app import create_app
+    app = create_app(args.config)
+    if args.file == '-':
+        stream = sys.stdin.buffer
+    else:
+        stream = open(args.file, 'rb')
+    with app.app_context(), stream:
+        rows = open_rows(stream, args.format, args.file, args.gzip)
+        report = None
+        for report in import_rows(args.resource, rows, args.chunk_size, args.insert_by):
+            print(f"{report['rows']} rows, {report['created']} created, {report['failed']} failed",
+                  file=sys.stderr)
+    print(json.dumps(report, indent=2))
+    return 1 if report and (report['failed'] or 'error' in report) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
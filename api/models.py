@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
 from sqlalchemy.orm import relationship
 from werkzeug.security import check_password_hash, generate_password_hash
 
@@ -37,3 +37,11 @@ class UserToken(Base):
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("user.id"), nullable=False)
     token = Column(String(4056))
+
+
+class TableVersion(Base):
+    # Change counter per table, bumped by every flush writing to it
+    __tablename__ = "table_version"
+    name = Column(String(64), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    modified = Column(DateTime, nullable=False)
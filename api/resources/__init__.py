@@ -1,18 +1,25 @@
-from flask import jsonify
+from flask import jsonify, request
 from flask_restful import Resource
+
+from api.auth import check_auth
+from api.common.utils import TABLE_MAP, wants_count
+from api.db import get_table_counts
 from api.resources.divers import Divers
 from api.resources.divesites import DiveSites
 from api.resources.extracts import Extracts
-from api.resources.fractions import Fractions
+from api.resources.fractions import FractionNames, Fractions
+from api.resources.imports import Import
 # Remove this resource and link through Fractions
 # from api.resources.fractionscreenplates import FractionScreenPlates
-from api.resources.isolates import Isolates
+from api.resources.isolates import Isolates, SimilarIsolates
 from api.resources.libraries import Libraries
 from api.resources.media import MediaEP
 from api.resources.permits import Permits, PermitsFile
 from api.resources.samples import Samples
 from api.resources.sampletypes import SampleTypes
-from api.resources.screenplates import ScreenPlates
+from api.resources.screenplates import ScreenPlateLayout, ScreenPlates
+from api.resources.search import Search
+from api.resources.stats import Stats
 
 class Heartbeat(Resource):
     def get(self):
@@ -25,6 +32,17 @@ class Summary(Resource):
             'libraries', 'media', 'permits', 'samples', 'sampletypes',
             'screenplates'
         ]
+        if wants_count(request.args):
+            return check_auth(summary_counts)(resources)
         return jsonify([
             f"/api/v1/{x}" for x in sorted(resources)
-        ])
\ No newline at end of file
+        ])
+
+
+def summary_counts(resources):
+    """Number of rows of each resource, from one query"""
+    tables = {x: TABLE_MAP[x] for x in resources if x in TABLE_MAP}
+    counts = get_table_counts(sorted(tables.values()))
+    return jsonify({
+        f"/api/v1/{x}": counts[tables[x]] if x in tables else None for x in sorted(resources)
+    })
\ No newline at end of file
@@ -3,15 +3,16 @@ from flask_restful import Resource
 from sqlalchemy.orm.exc import NoResultFound
 
 from api.auth import check_auth
-from api.common.utils import (filter_empty_strings, get_embedding,
-                              jsonify_sqlalchemy, validate_embed,
-                              validate_input)
-from api.db import add_one, get_all, get_one, search_query
+from api.common.utils import (conditional, filter_empty_strings, get_embedding,
+                              get_fieldset, get_filters, jsonify_collection,
+                              jsonify_sqlalchemy, plan_loading, post_many,
+                              validate_embed, validate_input)
+from api.db import add_one, build_query, get_one
 from api.models import Diver
 
 
 class Divers(Resource):
-    decorators = [check_auth]
+    decorators = [conditional(Diver), check_auth]
 
     def get(self, **kwargs):
         id_ = kwargs.get('id')
@@ -19,6 +20,7 @@ class Divers(Resource):
         embed = get_embedding(args.get('embed'))
         if not validate_embed(Diver, embed):
             abort(404)
+        fieldset = get_fieldset(Diver, args)
         # Search query parameters only valid when no id_
         query_params = {}
         query_params['first_name'] = args.get('first_name')
@@ -28,14 +30,13 @@ class Divers(Resource):
         # Explicitly check for None incase of 0 id_
         if id_ != None:
             try:
-                res = get_one(Diver, id_)
+                res = get_one(Diver, id_, options=plan_loading(Diver, embed, fieldset))
             except NoResultFound as e:
                 abort(404, e)
-            return jsonify_sqlalchemy(res, embed=embed)
+            return jsonify_sqlalchemy(res, embed, fieldset)
         else:
-            if any(query_params.values()):
-                return jsonify_sqlalchemy(search_query(Diver, query_params), embed)
-            return jsonify_sqlalchemy(get_all(Diver), embed=embed)
+            query = build_query(Diver, query_params, filters=get_filters(Diver, args))
+            return jsonify_collection(Diver, query, embed, fieldset)
 
     def put(self, **kwargs):
         return {"message": "Method not implemented"}, 501
@@ -46,6 +47,8 @@ class Divers(Resource):
         data = request.get_json()
         if not data:
             abort(400, "No input provided")
+        if isinstance(data, list):
+            return post_many(Diver, data)
         data = filter_empty_strings(data)
         if not validate_input(Diver, data):
             abort(400, "Invalid JSON input")
@@ -1,17 +1,67 @@
-from flask import abort, request
+from flask import abort, current_app, request
 from flask_restful import Resource
 from sqlalchemy.orm.exc import NoResultFound
 
 from api.auth import check_auth
-from api.common.utils import (filter_empty_strings, get_embedding,
-                              jsonify_sqlalchemy, validate_embed,
+from api.common.utils import (conditional, filter_empty_strings, get_embedding,
+                              get_fieldset, get_filters, get_geo_filters,
+                              jsonify_collection, jsonify_sqlalchemy,
+                              plan_loading, post_many, validate_embed,
                               validate_input)
-from api.db import add_one, get_all, get_one, search_query
+from api.common.geo import haversine_km
+from api.db import add_one, build_query, get_one, sites_within
 from api.models import DiveSite
 
 
+def _position(data):
+    try:
+        return float(data['lat']), float(data['lon'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def duplicate_site(data):
+    """Message listing the sites within DIVE_SITE_DUPLICATE_KM, or None"""
+    position = _position(data)
+    if position is None:
+        return None
+    found = sites_within(*position, current_app.config['DIVE_SITE_DUPLICATE_KM'])
+    if found:
+        links = [f"/api/v1/divesites/{id_}" for _, id_ in found]
+        return f"Dive site already exists nearby: {', '.join(links)}"
+    return None
+
+
+def check_duplicate_site(data):
+    """Abort with 409 when a site exists within DIVE_SITE_DUPLICATE_KM"""
+    message = duplicate_site(data)
+    if message:
+        abort(409, message)
+
+
+def duplicate_sites(items):
+    """Items of a bulk POST near an existing site or an earlier item
+
+    returns: {index: message}
+    """
+    radius = current_app.config['DIVE_SITE_DUPLICATE_KM']
+    conflicts, seen = {}, []
+    for i, data in items:
+        message = duplicate_site(data)
+        position = _position(data)
+        if message is None and position is not None:
+            earlier = [j for j, other in seen if haversine_km(*position, *other) <= radius]
+            if earlier:
+                message = f"Dive site duplicates items {', '.join(map(str, earlier))}"
+        if message:
+            conflicts[i] = message
+        if position is not None:
+            seen.append((i, position))
+    return conflicts
+
+
 class DiveSites(Resource):
-    decorators = [check_auth]
+    decorators = [conditional(DiveSite), check_auth]
 
     def get(self, **kwargs):
         id_ = kwargs.get('id')
@@ -19,6 +69,7 @@ class DiveSites(Resource):
         embed = get_embedding(args.get('embed'))
         if not validate_embed(DiveSite, embed):
             abort(404)
+        fieldset = get_fieldset(DiveSite, args)
         # Search query parameters only valid when no id_
         query_params = {}
         query_params['name'] = args.get('name')
@@ -26,14 +77,15 @@ class DiveSites(Resource):
         # Explicitly check for None incase of 0 id_
         if id_ != None:
             try:
-                res = get_one(DiveSite, id_)
+                res = get_one(DiveSite, id_, options=plan_loading(DiveSite, embed, fieldset))
             except NoResultFound as e:
                 abort(404, e)
-            return jsonify_sqlalchemy(res, embed=embed)
+            return jsonify_sqlalchemy(res, embed, fieldset)
         else:            
-            if any(query_params.values()):
-                return jsonify_sqlalchemy(search_query(DiveSite, query_params), embed)
-            return jsonify_sqlalchemy(get_all(DiveSite), embed=embed)
+            geo_filters, distance = get_geo_filters(DiveSite, args)
+            query = build_query(DiveSite, query_params,
+                                filters=get_filters(DiveSite, args) + geo_filters)
+            return jsonify_collection(DiveSite, query, embed, fieldset, default_order=distance)
 
     def put(self, **kwargs):
         return {"message": "Method not implemented"}, 501
@@ -44,9 +96,14 @@ class DiveSites(Resource):
         data = request.get_json()
         if not data:
             abort(400, "No input provided")
+        force = request.args.get('force', 'false').lower() in ('true', '1', 'yes')
+        if isinstance(data, list):
+            return post_many(DiveSite, data, check=None if force else duplicate_sites)
         data = filter_empty_strings(data)
         if not validate_input(DiveSite, data):
             abort(400, "Invalid JSON input")
+        if not force:
+            check_duplicate_site(data)
         id_ = add_one(DiveSite, data)
         return {"success": True, "link": f"/api/v1/divesites/{id_}", "id": id_}, 201
 
@@ -3,15 +3,16 @@ from flask_restful import Resource
 from sqlalchemy.orm.exc import NoResultFound
 
 from api.auth import check_auth
-from api.common.utils import (filter_empty_strings, get_embedding,
-                              jsonify_sqlalchemy, validate_embed,
-                              validate_input)
-from api.db import add_one, get_all, get_one, search_query
+from api.common.utils import (conditional, filter_empty_strings, get_embedding,
+                              get_fieldset, get_filters, jsonify_collection,
+                              jsonify_sqlalchemy, plan_loading, post_many,
+                              validate_embed, validate_input)
+from api.db import add_one, build_query, get_one, name_filter
 from api.models import Extract
 
 
 class Extracts(Resource):
-    decorators = [check_auth]
+    decorators = [conditional(Extract), check_auth]
 
     def get(self, **kwargs):
         id_ = kwargs.get('id')
@@ -19,22 +20,25 @@ class Extracts(Resource):
         embed = get_embedding(args.get('embed'))
         if not validate_embed(Extract, embed):
             abort(404)
+        fieldset = get_fieldset(Extract, args)
         # Search query parameters only valid when no id_
         query_params = {}
         query_params['library_abbrev'] = args.get('library_abbrev')
         query_params['number'] = args.get('number')
+        name = args.get('name')
         # TODO: validate query parameters
         # Explicitly check for None incase of 0 id_
         if id_ != None:
             try:
-                res = get_one(Extract, id_)
+                res = get_one(Extract, id_, options=plan_loading(Extract, embed, fieldset))
             except NoResultFound as e:
                 abort(404, e)
-            return jsonify_sqlalchemy(res, embed)
+            return jsonify_sqlalchemy(res, embed, fieldset)
         else:
-            if any(query_params.values()):
-                return jsonify_sqlalchemy(search_query(Extract, query_params), embed)
-            return jsonify_sqlalchemy(get_all(Extract), embed)
+            query = build_query(Extract, query_params, filters=get_filters(Extract, args))
+            if name:
+                query = query.filter(name_filter(Extract, name))
+            return jsonify_collection(Extract, query, embed, fieldset)
 
     def put(self, **kwargs):
         return {"message": "Method not implemented"}, 501
@@ -45,6 +49,8 @@ class Extracts(Resource):
         data = request.get_json()
         if not data:
             abort(400, "No input provided")
+        if isinstance(data, list):
+            return post_many(Extract, data)
         data = filter_empty_strings(data)
         if not validate_input(Extract, data):
             abort(400, "Invalid JSON input")
@@ -1,17 +1,21 @@
-from flask import abort, request
+from flask import abort, current_app, request
 from flask_restful import Resource
 from sqlalchemy.orm.exc import NoResultFound
 
 from api.auth import check_auth
-from api.common.utils import (filter_empty_strings, get_embedding,
-                              jsonify_sqlalchemy, validate_embed,
+from api.common.exc import ValidationException
+from api.common.utils import (conditional, filter_empty_strings, get_embedding,
+                              get_fieldset, get_filters, jsonify_collection,
+                              jsonify_sqlalchemy, parse_fraction_names,
+                              plan_loading, post_many, validate_embed,
                               validate_input)
-from api.db import add_one, get_all, get_one, get_fraction_by_name
+from api.db import (add_one, build_query, get_one, name_filter,
+                    resolve_fraction_names)
 from api.models import Fraction
 
 
 class Fractions(Resource):
-    decorators = [check_auth]
+    decorators = [conditional(Fraction), check_auth]
 
     def get(self, **kwargs):
         id_ = kwargs.get('id')
@@ -19,23 +23,23 @@ class Fractions(Resource):
         embed = get_embedding(args.get('embed'))
         if not validate_embed(Fraction, embed):
             abort(404)
+        fieldset = get_fieldset(Fraction, args)
         # Search query parameters only valid when no id_
         query_params = {}
         query_params['name'] = args.get('name')
         # Explicitly check for None incase of 0 id_
         if id_ != None:
             try:
-                res = get_one(Fraction, id_)
+                res = get_one(Fraction, id_, options=plan_loading(Fraction, embed, fieldset))
             except NoResultFound as e:
                 abort(404, e)
-            return jsonify_sqlalchemy(res, embed=embed)
+            return jsonify_sqlalchemy(res, embed, fieldset)
         else:
-            # Keep form same as other methds
-            # Use custom query that results one result or None
-            # Make into list for consistency
-            if any(query_params.values()):
-                return jsonify_sqlalchemy([get_fraction_by_name(query_params['name'])], embed=embed)
-            return jsonify_sqlalchemy(get_all(Fraction), embed=embed)
+            name = query_params.pop('name')
+            query = build_query(Fraction, query_params, filters=get_filters(Fraction, args))
+            if name:
+                query = query.filter(name_filter(Fraction, name))
+            return jsonify_collection(Fraction, query, embed, fieldset)
 
     def put(self, **kwargs):
         return {"message": "Method not implemented"}, 501
@@ -47,6 +51,8 @@ class Fractions(Resource):
         data = request.get_json()
         if not data:
             abort(400, "No input provided")
+        if isinstance(data, list):
+            return post_many(Fraction, data)
         data = filter_empty_strings(data)
         if not validate_input(Fraction, data):
             abort(400, "Invalid JSON input")
@@ -55,3 +61,30 @@ class Fractions(Resource):
 
     def delete(self, **kwargs):
         return {"message": "Method not implemented"}, 501
+
+
+class FractionNames(Resource):
+    decorators = [check_auth]
+
+    def post(self):
+        """Resolve a list of fraction names and ranges to fractions
+
+        Input is a list, or {"names": [...]}, of names (RLABC-0001A) and
+        ranges of numbers and codes (RLABC-0001A..0050E). Matched names
+        map to their fractions in input order.
+        """
+        data = request.get_json()
+        if isinstance(data, dict):
+            data = data.get('names')
+        if not isinstance(data, list):
+            abort(400, "No input provided")
+        try:
+            names, singles, spans = parse_fraction_names(
+                data, current_app.config['FRACTION_RESOLVE_MAX'])
+        except ValidationException as e:
+            abort(400, str(e))
+        found = resolve_fraction_names(names, singles, spans)
+        return {
+            "results": {x: found[x] for x in names if x in found},
+            "unmatched": [x for x in names if x not in found],
+        }
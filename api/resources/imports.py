@@ -0,0 +1,54 @@
+from flask import Response, abort, current_app, json, request, stream_with_context
+from flask_restful import Resource
+
+from api.auth import check_auth, get_user_id
+from api.common.exc import ValidationException
+from api.common.utils import STREAM_FORMATS
+from api.importer import IMPORTS, READ_ERRORS, import_rows, open_rows
+
+CONTENT_FORMATS = {
+    'text/csv': 'csv',
+    'text/tab-separated-values': 'tsv',
+}
+
+
+class Import(Resource):
+    decorators = [check_auth]
+
+    def post(self, resource):
+        """Import a CSV or TSV file, raw or as multipart `file`
+
+        Progress is streamed as NDJSON, one report per committed chunk,
+        the last one with `done` set.
+        """
+        if resource not in IMPORTS:
+            abort(404)
+        args = request.args
+        try:
+            chunk_size = int(args.get('chunk_size', current_app.config['IMPORT_CHUNK_SIZE']))
+        except ValueError:
+            abort(400, "Invalid chunk_size")
+        if chunk_size < 1:
+            abort(400, "Invalid chunk_size")
+        if 'file' in request.files:
+            file_ = request.files['file']
+            stream, filename = file_.stream, file_.filename
+        else:
+            stream, filename = request.stream, None
+        fmt = args.get('format') or CONTENT_FORMATS.get(request.mimetype)
+        compressed = request.headers.get('Content-Encoding') == 'gzip' or None
+        try:
+            rows = open_rows(stream, fmt, filename, compressed)
+            # Reads the header line
+            IMPORTS[resource].check_header(rows.fieldnames or [])
+        except ValidationException as e:
+            abort(400, str(e))
+        except READ_ERRORS as e:
+            abort(400, f"Unreadable file, {e}")
+        insert_by = get_user_id(request)
+
+        def generate():
+            for report in import_rows(resource, rows, chunk_size, insert_by):
+                yield json.dumps(report) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype=STREAM_FORMATS['ndjson'])
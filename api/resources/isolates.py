@@ -1,17 +1,19 @@
-from flask import abort, request
+from flask import abort, current_app, request
 from flask_restful import Resource
 from sqlalchemy.orm.exc import NoResultFound
 
 from api.auth import check_auth, get_user_id
-from api.common.utils import (filter_empty_strings, get_embedding,
-                              jsonify_sqlalchemy, validate_embed,
-                              validate_isolate_input)
-from api.db import add_one_isolate, get_all, get_one, search_query
+from api.common.utils import (conditional, filter_empty_strings, get_embedding,
+                              get_fieldset, get_filters, jsonify_collection,
+                              jsonify_sqlalchemy, plan_loading, post_many,
+                              validate_embed, validate_isolate_input)
+from api.db import (add_one_isolate, build_isolates, build_query,
+                    get_isolate_names, get_one)
 from api.models import Isolate
 
 
 class Isolates(Resource):
-    decorators = [check_auth]
+    decorators = [conditional(Isolate), check_auth]
 
     def get(self, **kwargs):
         id_ = kwargs.get('id')
@@ -19,20 +21,20 @@ class Isolates(Resource):
         embed = get_embedding(args.get('embed'))
         if not validate_embed(Isolate, embed):
             abort(404)
+        fieldset = get_fieldset(Isolate, args)
         # Search query parameters only valid when no id_
         query_params = {}
         query_params['name'] = args.get('name')
         # Explicitly check for None incase of 0 id_
         if id_ != None:
             try:
-                res = get_one(Isolate, id_)
+                res = get_one(Isolate, id_, options=plan_loading(Isolate, embed, fieldset))
             except NoResultFound as e:
                 abort(404, e)
-            return jsonify_sqlalchemy(res, embed=embed)
+            return jsonify_sqlalchemy(res, embed, fieldset)
         else:
-            if any(query_params.values()):
-                return jsonify_sqlalchemy(search_query(Isolate, query_params), embed)
-            return jsonify_sqlalchemy(get_all(Isolate), embed=embed)
+            query = build_query(Isolate, query_params, filters=get_filters(Isolate, args))
+            return jsonify_collection(Isolate, query, embed, fieldset)
 
     def put(self, **kwargs):
         return {"message": "Method not implemented"}, 501
@@ -43,6 +45,9 @@ class Isolates(Resource):
         data = request.get_json()
         if not data:
             abort(400, "No input provided")
+        if isinstance(data, list):
+            return post_many(Isolate, data, validate_isolate_input, build_isolates,
+                             {'insert_by': get_user_id(request)})
         data['insert_by'] = get_user_id(request)
         data = filter_empty_strings(data)
         if not validate_isolate_input(data):
@@ -52,3 +57,33 @@ class Isolates(Resource):
 
     def delete(self, **kwargs):
         return {"message": "Method not implemented"}, 501
+
+
+class SimilarIsolates(Resource):
+    decorators = [check_auth]
+
+    def post(self):
+        """Isolates with the most k-mers in common with a sequence
+
+        Input is {"sequence": "ACGT...", "limit": 10}.
+        """
+        data = request.get_json()
+        if not isinstance(data, dict) or not isinstance(data.get('sequence'), str):
+            abort(400, "No input provided")
+        limit = data.get('limit', 10)
+        if not isinstance(limit, int) or not 0 < limit <= current_app.config['PAGE_SIZE_MAX']:
+            abort(400, "Invalid limit")
+        index = current_app.sequence_index
+        # Built offline, a build takes minutes for tens of thousands of isolates
+        if not index.is_built():
+            abort(503, "Sequence index not built, run python -m api.common.kmers")
+        try:
+            results = index.search(data['sequence'], limit)
+        except ValueError as e:
+            abort(400, str(e))
+        names = get_isolate_names([x['id'] for x in results])
+        # Isolates deleted since they were sketched are skipped
+        return {"results": [
+            dict(x, name=names[x['id']], link=f"/api/v1/isolates/{x['id']}")
+            for x in results if x['id'] in names
+        ]}
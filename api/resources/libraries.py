@@ -3,31 +3,33 @@ from flask_restful import Resource
 from sqlalchemy.orm.exc import NoResultFound
 
 from api.auth import check_auth
-from api.common.utils import (filter_empty_strings, get_embedding,
-                              jsonify_sqlalchemy, validate_embed,
-                              validate_input)
-from api.db import add_one, get_all, get_one
+from api.common.utils import (conditional, filter_empty_strings, get_embedding,
+                              get_fieldset, get_filters, jsonify_collection,
+                              jsonify_sqlalchemy, plan_loading, post_many,
+                              validate_embed, validate_input)
+from api.db import add_one, build_query, get_one
 from api.models import Library
 
 
 class Libraries(Resource):
-    decorators = [check_auth]
+    decorators = [conditional(Library), check_auth]
 
     def get(self, **kwargs):
         id_ = kwargs.get('id')
         embed = get_embedding(request.args.get('embed'))
         if not validate_embed(Library, embed):
             abort(404)
-        # No need for search query here
+        fieldset = get_fieldset(Library, request.args)
         # Explicitly check for None incase of 0 id_
         if id_ != None:
             try:
-                res = get_one(Library, id_)
+                res = get_one(Library, id_, options=plan_loading(Library, embed, fieldset))
             except NoResultFound as e:
                 abort(404, e)
-            return jsonify_sqlalchemy(res, embed=embed)
+            return jsonify_sqlalchemy(res, embed, fieldset)
         else:
-            return jsonify_sqlalchemy(get_all(Library), embed=embed)
+            query = build_query(Library, filters=get_filters(Library, request.args))
+            return jsonify_collection(Library, query, embed, fieldset)
 
     def put(self, **kwargs):
         return {"message": "Method not implemented"}, 501
@@ -38,6 +40,8 @@ class Libraries(Resource):
         data = request.get_json()
         if not data:
             abort(400, "No input provided")
+        if isinstance(data, list):
+            return post_many(Library, data)
         data = filter_empty_strings(data)
         if not validate_input(Library, data):
             abort(400, "Invalid JSON input")
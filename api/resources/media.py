@@ -3,15 +3,16 @@ from flask_restful import Resource
 from sqlalchemy.orm.exc import NoResultFound
 
 from api.auth import check_auth
-from api.common.utils import (filter_empty_strings, get_embedding,
-                              jsonify_sqlalchemy, validate_embed,
-                              validate_media_input)
-from api.db import add_media_with_recipe, get_all, get_one, search_query
+from api.common.utils import (conditional, filter_empty_strings, get_embedding,
+                              get_fieldset, get_filters, jsonify_collection,
+                              jsonify_sqlalchemy, plan_loading, post_many,
+                              validate_embed, validate_media_input)
+from api.db import add_media_with_recipe, build_media, build_query, get_one
 from api.models import Media
 
 
 class MediaEP(Resource):
-    decorators = [check_auth]
+    decorators = [conditional(Media), check_auth]
 
     def get(self, **kwargs):
         id_ = kwargs.get('id')
@@ -19,20 +20,20 @@ class MediaEP(Resource):
         embed = get_embedding(args.get('embed'))
         if not validate_embed(Media, embed):
             abort(404)
+        fieldset = get_fieldset(Media, args)
         # Search query parameters only valid when no id_
         query_params = {}
         query_params['name'] = args.get('name')
         # Explicitly check for None incase of 0 id_
         if id_ != None:
             try:
-                res = get_one(Media, id_)
+                res = get_one(Media, id_, options=plan_loading(Media, embed, fieldset))
             except NoResultFound as e:
                 abort(404, e)
-            return jsonify_sqlalchemy(res, embed=embed)
+            return jsonify_sqlalchemy(res, embed, fieldset)
         else:
-            if any(query_params.values()):
-                return jsonify_sqlalchemy(search_query(Media, query_params), embed)
-            return jsonify_sqlalchemy(get_all(Media), embed=embed)
+            query = build_query(Media, query_params, filters=get_filters(Media, args))
+            return jsonify_collection(Media, query, embed, fieldset)
 
     def put(self, **kwargs):
         return {"message": "Method not implemented"}, 501
@@ -43,6 +44,8 @@ class MediaEP(Resource):
         data = request.get_json()
         if not data:
             abort(400, "No input provided")
+        if isinstance(data, list):
+            return post_many(Media, data, validate_media_input, build_media)
         data = filter_empty_strings(data)
         if not validate_media_input(data):
             abort(400, "Invalid JSON input")
@@ -5,15 +5,17 @@ from flask_restful import Resource
 from sqlalchemy.orm.exc import NoResultFound
 
 from api.auth import check_auth
-from api.common.utils import (allowed_file, filter_empty_strings,
-                              get_embedding, jsonify_sqlalchemy,
-                              validate_embed, validate_input)
-from api.db import add_one, get_all, get_one, search_query
+from api.common.utils import (allowed_file, conditional, filter_empty_strings,
+                              get_embedding, get_fieldset, get_filters,
+                              jsonify_collection, jsonify_sqlalchemy,
+                              plan_loading, post_many, validate_embed,
+                              validate_input)
+from api.db import add_one, build_query, get_one
 from api.models import Permit
 from werkzeug.utils import secure_filename
 
 class Permits(Resource):
-    decorators = [check_auth]
+    decorators = [conditional(Permit), check_auth]
 
     def get(self, **kwargs):
         id_ = kwargs.get('id')
@@ -21,6 +23,7 @@ class Permits(Resource):
         embed = get_embedding(args.get('embed'))
         if not validate_embed(Permit, embed):
             abort(404)
+        fieldset = get_fieldset(Permit, args)
         # Search query parameters only valid when no id_
         query_params = {}
         query_params['name'] = args.get('name')
@@ -29,14 +32,13 @@ class Permits(Resource):
         # Explicitly check for None incase of 0 id_
         if id_ != None:
             try:
-                res = get_one(Permit, id_)
+                res = get_one(Permit, id_, options=plan_loading(Permit, embed, fieldset))
             except NoResultFound as e:
                 abort(404, e)
-            return jsonify_sqlalchemy(res, embed=embed)
+            return jsonify_sqlalchemy(res, embed, fieldset)
         else:
-            if any(query_params.values()):
-                return jsonify_sqlalchemy(search_query(Permit, query_params), embed)
-            return jsonify_sqlalchemy(get_all(Permit), embed=embed)
+            query = build_query(Permit, query_params, filters=get_filters(Permit, args))
+            return jsonify_collection(Permit, query, embed, fieldset)
 
     def put(self, **kwargs):
         return {"message": "Method not implemented"}, 501
@@ -47,6 +49,8 @@ class Permits(Resource):
         data = request.get_json()
         if not data:
             abort(400, "No input provided")
+        if isinstance(data, list):
+            return post_many(Permit, data)
         data = filter_empty_strings(data)
         if not validate_input(Permit, data):
             abort(400, "Invalid JSON input")
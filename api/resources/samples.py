@@ -6,10 +6,12 @@ from sqlalchemy.orm.exc import NoResultFound
 # from api.common.utils import (get_relationships, jsonify_sqlalchemy,
 #                               get_embedding)
 from api.auth import check_auth, get_user_id
-from api.common.utils import (filter_empty_strings, get_embedding,
-                              jsonify_sqlalchemy, validate_embed,
+from api.common.utils import (conditional, filter_empty_strings, get_embedding,
+                              get_fieldset, get_filters, get_geo_filters,
+                              jsonify_collection, jsonify_sqlalchemy,
+                              plan_loading, post_many, validate_embed,
                               validate_sample_input)
-from api.db import add_one_sample, get_all, get_one, search_query
+from api.db import add_one_sample, build_query, build_samples, get_one
 from api.models import Sample
 
 # First attempt at getting relationships
@@ -19,7 +21,7 @@ from api.models import Sample
 
 
 class Samples(Resource):
-    decorators = [check_auth]
+    decorators = [conditional(Sample), check_auth]
     
     def get(self, **kwargs):
         id_ = kwargs.get('id')
@@ -31,20 +33,22 @@ class Samples(Resource):
         # return args
         if not validate_embed(Sample, embed):
             abort(404)
+        fieldset = get_fieldset(Sample, args)
         # Search query parameters only valid when no id_
         query_params = {}
         query_params['name'] = args.get('name')
         # Explicitly check for None incase of 0 id_
         if id_ != None:
             try:
-                res = get_one(Sample, id_)
+                res = get_one(Sample, id_, options=plan_loading(Sample, embed, fieldset))
             except NoResultFound as e:
                 abort(404, e)
-            return jsonify_sqlalchemy(res, embed=embed)
+            return jsonify_sqlalchemy(res, embed, fieldset)
         else:
-            if any(query_params.values()):
-                return jsonify_sqlalchemy(search_query(Sample, query_params), embed)
-            return jsonify_sqlalchemy(get_all(Sample), embed=embed)
+            geo_filters, distance = get_geo_filters(Sample, args)
+            query = build_query(Sample, query_params,
+                                filters=get_filters(Sample, args) + geo_filters)
+            return jsonify_collection(Sample, query, embed, fieldset, default_order=distance)
 
     def put(self, **kwargs):
         return {"message": "Method not implemented"}, 501
@@ -55,6 +59,9 @@ class Samples(Resource):
         data = request.get_json()
         if not data:
             abort(400, "No input provided")
+        if isinstance(data, list):
+            return post_many(Sample, data, validate_sample_input, build_samples,
+                             {'insert_by': get_user_id(request)})
         data['insert_by'] = get_user_id(request)
         data = filter_empty_strings(data)
         if not validate_sample_input(data):
@@ -3,30 +3,33 @@ from flask_restful import Resource
 from sqlalchemy.orm.exc import NoResultFound
 
 from api.auth import check_auth
-from api.common.utils import (filter_empty_strings, get_embedding,
-                              jsonify_sqlalchemy, validate_embed,
-                              validate_input)
-from api.db import add_one, get_all, get_one, search_query
+from api.common.utils import (conditional, filter_empty_strings, get_embedding,
+                              get_fieldset, get_filters, jsonify_collection,
+                              jsonify_sqlalchemy, plan_loading, post_many,
+                              validate_embed, validate_input)
+from api.db import add_one, build_query, get_one
 from api.models import SampleType
 
 
 class SampleTypes(Resource):
-    decorators = [check_auth]
+    decorators = [conditional(SampleType), check_auth]
 
     def get(self, **kwargs):
         id_ = kwargs.get('id')
         embed = get_embedding(request.args.get('embed'))
         if not validate_embed(SampleType, embed):
             abort(404)
+        fieldset = get_fieldset(SampleType, request.args)
         # Explicitly check for None incase of 0 id_
         if id_ != None:
             try:
-                res = get_one(SampleType, id_)
+                res = get_one(SampleType, id_, options=plan_loading(SampleType, embed, fieldset))
             except NoResultFound as e:
                 abort(404, e)
-            return jsonify_sqlalchemy(res, embed=embed)
+            return jsonify_sqlalchemy(res, embed, fieldset)
         else:
-            return jsonify_sqlalchemy(get_all(SampleType), embed=embed)
+            query = build_query(SampleType, filters=get_filters(SampleType, request.args))
+            return jsonify_collection(SampleType, query, embed, fieldset)
 
     def put(self, **kwargs):
         return {"message": "Method not implemented"}, 501
@@ -37,6 +40,8 @@ class SampleTypes(Resource):
         data = request.get_json()
         if not data:
             abort(400, "No input provided")
+        if isinstance(data, list):
+            return post_many(SampleType, data)
         data = filter_empty_strings(data)
         if not validate_input(SampleType, data):
             abort(400, "Invalid JSON input")
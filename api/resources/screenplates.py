@@ -3,30 +3,34 @@ from flask_restful import Resource
 from sqlalchemy.orm.exc import NoResultFound
 
 from api.auth import check_auth
-from api.common.utils import (filter_empty_strings, get_embedding,
-                              jsonify_sqlalchemy, validate_embed,
+from api.common.utils import (LAYOUT_TABLES, conditional, filter_empty_strings,
+                              get_embedding, get_fieldset, get_filters,
+                              jsonify_collection, jsonify_layout,
+                              jsonify_sqlalchemy, plan_loading, validate_embed,
                               validate_input)
-from api.db import get_all, get_one, search_query
+from api.db import build_query, get_one, get_plate_layout
 from api.models import ScreenPlate
 
 
 class ScreenPlates(Resource):
-    decorators = [check_auth]
+    decorators = [conditional(ScreenPlate), check_auth]
 
     def get(self, **kwargs):
         id_ = kwargs.get('id')
         embed = get_embedding(request.args.get('embed'))
         if not validate_embed(ScreenPlate, embed):
             abort(404)
+        fieldset = get_fieldset(ScreenPlate, request.args)
         # Explicitly check for None incase of 0 id_
         if id_ != None:
             try:
-                res = get_one(ScreenPlate, id_)
+                res = get_one(ScreenPlate, id_, options=plan_loading(ScreenPlate, embed, fieldset))
             except NoResultFound as e:
                 abort(404, e)
-            return jsonify_sqlalchemy(res, embed=embed)
+            return jsonify_sqlalchemy(res, embed, fieldset)
         else:
-            return jsonify_sqlalchemy(get_all(ScreenPlate), embed=embed)
+            query = build_query(ScreenPlate, filters=get_filters(ScreenPlate, request.args))
+            return jsonify_collection(ScreenPlate, query, embed, fieldset)
 
     def put(self, **kwargs):
         return {"message": "Method not implemented"}, 501
@@ -36,3 +40,24 @@ class ScreenPlates(Resource):
 
     def delete(self, **kwargs):
         return {"message": "Method not implemented"}, 501
+
+
+def layout_tables(**kwargs):
+    return LAYOUT_TABLES
+
+
+class ScreenPlateLayout(Resource):
+    decorators = [conditional(None, layout_tables), check_auth]
+
+    def get(self, id):
+        """Every well of a plate with its fraction, extract and library
+
+        `?format=grid` returns fraction names as rows of columns.
+        """
+        try:
+            rows = get_plate_layout(int(id))
+        except ValueError:
+            abort(404)
+        if not rows:
+            abort(404)
+        return jsonify_layout(rows, request.args.get('format'))
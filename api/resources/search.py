@@ -0,0 +1,20 @@
+from flask import request
+from flask_restful import Resource
+
+from api.auth import check_auth
+from api.common.utils import conditional, jsonify_search, search_tables
+
+
+def dependent_tables():
+    return search_tables(request.args)
+
+
+class Search(Resource):
+    decorators = [conditional(None, dependent_tables), check_auth]
+
+    def get(self):
+        """Rows of any resource whose names or notes match `q`
+
+        e.g. /api/v1/search?q=coral reef&resource=samples,permits
+        """
+        return jsonify_search(request.args)
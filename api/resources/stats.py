@@ -0,0 +1,37 @@
+from flask import abort, request
+from flask_restful import Resource
+
+from api.auth import check_auth
+from api.common.utils import (MODEL_MAP, TABLE_MAP, conditional,
+                              get_aggregates, get_filters, get_group_by,
+                              jsonify_stats, stats_tables)
+from api.db import stats_query
+
+
+def get_model(resource):
+    try:
+        return MODEL_MAP[TABLE_MAP[resource]]
+    except KeyError:
+        abort(404)
+
+
+def dependent_tables(resource):
+    if resource not in TABLE_MAP:
+        return []
+    return stats_tables(get_model(resource), request.args)
+
+
+class Stats(Resource):
+    decorators = [conditional(None, dependent_tables), check_auth]
+
+    def get(self, resource):
+        """Aggregates of a collection grouped by `group_by`
+
+        e.g. /api/v1/stats/samples?group_by=collection_year&agg=count,avg(depth_ft)
+        """
+        Doa = get_model(resource)
+        args = request.args
+        group_by = get_group_by(Doa, args)
+        aggregates = get_aggregates(Doa, args)
+        query = stats_query(Doa, group_by, aggregates, get_filters(Doa, args))
+        return jsonify_stats(group_by, aggregates, query)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Fraction name resolution benchmark
+
+Fills a temporary SQLite database with N_FRACTIONS fractions (5 codes
+per extract, one screen plate well for every 10th fraction) and times
+POST /api/v1/fractions/resolve with half of them as single names and
+half as one range, end to end through the test client with DEBUG off,
+and the query alone.
+
+    python -m bench.resolve [N_FRACTIONS] [REPEAT]
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+
+def fill(engine, n):
+    from api.models import Extract, Fraction, FractionScreenPlate, Library, ScreenPlate
+    codes = 'ABCDE'
+    with engine.begin() as conn:
+        conn.execute(Library.__table__.insert(), abbrev='BEN', name='Bench library')
+        conn.execute(ScreenPlate.__table__.insert(), id=1, name='Bench plate', well_format=384)
+        extracts = n // len(codes)
+        conn.execute(Extract.__table__.insert(), [
+            {'id': i, 'number': i, 'library_abbrev': 'BEN', 'name': f'RLBEN-{i:04d}'}
+            for i in range(1, extracts + 1)])
+        conn.execute(Fraction.__table__.insert(), [
+            {'id': (i - 1) * len(codes) + j + 1, 'extract_id': i, 'code': code,
+             'name': f'RLBEN-{i:04d}{code}'}
+            for i in range(1, extracts + 1) for j, code in enumerate(codes)])
+        conn.execute(FractionScreenPlate.__table__.insert(), [
+            {'fraction_id': id_, 'screen_plate_id': 1, 'well': 'A1'}
+            for id_ in range(1, n + 1, 10)])
+    return extracts
+
+
+def timed(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+
+def main(n=100000, repeat=5):
+    path = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+    os.environ['TEST_DATABASE_URL'] = f'sqlite:///{path}'
+    # Authentication is bypassed in the testing environment
+    os.environ['FLASK_ENV'] = 'testing'
+    from api.app import create_app
+    from api.common.utils import parse_fraction_names
+    from api.db import resolve_fraction_names
+    try:
+        app = create_app('testing')
+        app.debug = False
+        app.response_cache = None
+        extracts = fill(app.engine, n)
+        half = extracts // 2
+        names = [f'RLBEN-{i:04d}{code}' for i in range(1, half + 1) for code in 'ABCDE']
+        names.append(f'RLBEN-{half + 1:04d}A..{extracts:04d}E')
+        client = app.test_client()
+
+        def request():
+            r = client.post('/api/v1/fractions/resolve', json=names)
+            assert r.status_code == 200, r.get_data(as_text=True)
+            return r
+
+        def query():
+            with app.test_request_context():
+                parsed = parse_fraction_names(names, app.config['FRACTION_RESOLVE_MAX'])
+                return resolve_fraction_names(*parsed)
+
+        seconds, r = timed(request, repeat)
+        print(f"request    {n:,} names in {seconds:.2f} s, {len(r.get_data()) / 2**20:.1f} MB "
+              f"({len(r.json['results']):,} matched)")
+        seconds, _ = timed(query, repeat)
+        print(f"query      {seconds:.2f} s (parse and resolve only)")
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
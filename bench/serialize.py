@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""Serializer throughput benchmark
+
+Compares the compiled per-model serializers against the previous
+per-row introspection (kept here as `legacy_*` for reference) on an
+in-memory SQLite database, both for serialization alone (same fully
+loaded rows) and end to end (query, relationship loading and links).
+
+    python -m bench.serialize [N_ROWS]
+"""
+import datetime
+import sys
+import time
+from decimal import Decimal
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import selectinload, sessionmaker
+
+from api.common.sql_models import (Base, Diver, DiveSite, Extract, Fraction,
+                                   FractionScreenPlate, Library, Permit,
+                                   Sample, SampleType, ScreenPlate)
+from api.common.utils import (ENDPOINT_MAP, compile_serializers,
+                              jsonify_sqlalchemy, plan_loading)
+
+
+def legacy_row2dict(row):
+    result = {}
+    if isinstance(row, Extract):
+        extra = ['name']
+    else:
+        extra = []
+    for c in row.__table__.columns:
+        if c.name in ['insert_by', 'insert_date']:
+            continue
+        r = getattr(row, c.name)
+        if c.foreign_keys:
+            continue
+        elif isinstance(r, Decimal):
+            result[c.name] = float(r)
+        elif isinstance(r, datetime.date):
+            result[c.name] = r.isoformat()
+        else:
+            result[c.name] = r
+    for e in extra:
+        result[e] = getattr(row, e)
+    return result
+
+
+def legacy_fraction2dict(row):
+    result = {}
+    for c in row.__table__.columns:
+        result[c.name] = getattr(row, c.name)
+    result['name'] = row.name
+    result['screen_plates'] = [{
+            "name": i.screen_plate.name,
+            "htcb_name": i.screen_plate.htcb_name,
+            "plate_format": i.screen_plate.well_format,
+            "well": i.well,
+            "notes": i.notes
+        } for i in row.fraction_screen_plates]
+    return result
+
+
+def legacy_serialize_row(row):
+    if isinstance(row, Fraction):
+        result = legacy_fraction2dict(row)
+    else:
+        result = legacy_row2dict(row)
+    for rel in row.__mapper__.relationships.keys():
+        try:
+            key = ENDPOINT_MAP[rel]
+        except KeyError:
+            key = rel
+        r = getattr(row, rel)
+        if not isinstance(r, list):
+            r = [r]
+        result[key] = {"links": [f"/api/v1/{key}/{x.id}" for x in r if x]}
+    return result
+
+
+def populate(sess, n):
+    site = DiveSite(name='Bench site', lat=49.2, lon=-123.1)
+    permit = Permit(name='Bench permit', iss_auth='BENCH')
+    sample_type = SampleType(name='Bench type')
+    divers = [Diver(first_name='Bench', last_name=f'Diver{i}') for i in range(3)]
+    library = Library(abbrev='BEN', name='Bench library')
+    plate = ScreenPlate(name='Bench plate', well_format=384)
+    for i in range(n):
+        sess.add(Sample(
+            name=f'BENCH-{i}', collection_number=i, collection_year=2016,
+            collection_date=datetime.date(2016, 1, 1), depth_ft=float(i),
+            genus_species='Bench sp.', notes='Benchmark sample',
+            dive_site=site, permit=permit, sample_type=sample_type, divers=divers,
+        ))
+        extract = Extract(number=i, library=library)
+        sess.add(Fraction(code='A', extract=extract, fraction_screen_plates=[
+            FractionScreenPlate(screen_plate=plate, well='A1')
+        ]))
+    sess.commit()
+
+
+def rate(func, n, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return n / best
+
+
+def report(name, legacy, compiled):
+    print(f"{name:<20} legacy {legacy:>10,.0f} rows/s  "
+          f"compiled {compiled:>10,.0f} rows/s  ({compiled/legacy:.1f}x)")
+
+
+def main(n=10000):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(bind=engine)
+    sess = sessionmaker(bind=engine)()
+    populate(sess, n)
+    compile_serializers()
+    for Doa in (Sample, Fraction):
+        def load_all():
+            sess.expunge_all()
+            options = [selectinload(getattr(Doa, rel)) for rel in Doa.__mapper__.relationships.keys()]
+            if Doa is Fraction:
+                # Plates are read by both serializers, load them up front too
+                options.append(selectinload(Fraction.fraction_screen_plates)
+                               .joinedload(FractionScreenPlate.screen_plate))
+            return sess.query(Doa).options(*options).all()
+
+        def load_planned():
+            sess.expunge_all()
+            return sess.query(Doa).options(*plan_loading(Doa, [])).all()
+
+        rows = load_all()
+        assert [legacy_serialize_row(r) for r in rows] == jsonify_sqlalchemy(rows)
+        report(f"{Doa.__name__} serialize",
+            rate(lambda: [legacy_serialize_row(r) for r in rows], n),
+            rate(lambda: jsonify_sqlalchemy(rows), n))
+        report(f"{Doa.__name__} end to end",
+            rate(lambda: [legacy_serialize_row(r) for r in load_all()], n),
+            rate(lambda: jsonify_sqlalchemy(load_planned()), n))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
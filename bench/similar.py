@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Sequence index benchmark
+
+Builds the k-mer sketch index of N_ISOLATES synthetic 16S-like
+sequences (families of 3% mutants of random 1500 bp sequences) in a
+temporary file, then times similarity searches served from the file by
+a fresh `SequenceIndex`, as a worker sees it.
+
+    python -m bench.similar [N_ISOLATES] [N_QUERIES]
+"""
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+from api.common.kmers import SequenceIndex
+
+LENGTH = 1500
+FAMILY_SIZE = 50
+
+
+def random_sequence(rng, length=LENGTH):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+def mutate(rng, sequence, rate=0.03):
+    return ''.join(rng.choice('ACGT') if rng.random() < rate else x for x in sequence)
+
+
+def isolates(n, seed=0):
+    rng = random.Random(seed)
+    base = None
+    for id_ in range(1, n + 1):
+        if id_ % FAMILY_SIZE == 1:
+            base = random_sequence(rng)
+        yield id_, mutate(rng, base)
+
+
+def batches(n, batch_size=1000):
+    def generate(after):
+        batch = []
+        for id_, sequence in isolates(n):
+            if id_ <= after:
+                continue
+            batch.append((id_, sequence))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    return generate
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main(n=20000, queries=50):
+    path = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+    try:
+        rss = max_rss_mb()
+        start = time.perf_counter()
+        SequenceIndex(path).build(batches(n))
+        build = time.perf_counter() - start
+        print(f"build      {n:,} isolates in {build:.1f} s ({n / build:,.0f} isolates/s), "
+              f"max RSS +{max_rss_mb() - rss:.0f} MB, file {os.path.getsize(path) / 2**20:.0f} MB")
+
+        index = SequenceIndex(path)
+        rng = random.Random(1)
+        sequences = dict(isolates(n))
+        targets = [rng.randint(1, n) for _ in range(queries)]
+        timings, found = [], 0
+        for id_ in targets:
+            query = mutate(rng, sequences[id_], 0.01)
+            start = time.perf_counter()
+            results = index.search(query, 10)
+            timings.append(time.perf_counter() - start)
+            found += results[0]['id'] == id_
+        timings.sort()
+        print(f"search     median {statistics.median(timings) * 1000:.1f} ms, "
+              f"p95 {timings[int(len(timings) * 0.95) - 1] * 1000:.1f} ms, "
+              f"top hit is the mutated isolate {found}/{queries}")
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
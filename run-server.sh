@@ -9,4 +9,7 @@ while true; do
     sleep 10
 done
 
+if [[ "$SERVER_MODE" == "asgi" ]]; then
+    exec gunicorn -k uvicorn.workers.UvicornWorker -w 4 "api.asgi:create_asgi_app('production')" -b 0.0.0.0:8000
+fi
 exec gunicorn -k gevent -w 4 "api.app:create_app('production')" -b 0.0.0.0:8000
\ No newline at end of file
@@ -1,21 +1,102 @@
+import asyncio
+import os
 import unittest
 
+from flask.testing import FlaskClient
+from werkzeug.http import HTTP_STATUS_CODES
+from werkzeug.test import run_wsgi_app
+
 from api.app import create_app
+from api.asgi import AsgiAdapter
 from api.db import session_scope
 from api.common.sql_models import Base
 from api.db import Session
 
 
+def asgi_scope(environ):
+    """ASGI http scope of a WSGI environ, inverse of `build_environ`"""
+    headers = [
+        (key[5:].replace('_', '-').lower().encode('latin1'), value.encode('latin1'))
+        for key, value in environ.items() if key.startswith('HTTP_')
+    ]
+    for key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+        if environ.get(key):
+            headers.append((key.replace('_', '-').lower().encode('latin1'),
+                            environ[key].encode('latin1')))
+    return {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': environ['SERVER_PROTOCOL'].split('/')[-1],
+        'method': environ['REQUEST_METHOD'],
+        'scheme': environ['wsgi.url_scheme'],
+        'root_path': environ.get('SCRIPT_NAME', '').encode('latin1').decode('utf8'),
+        'path': environ['PATH_INFO'].encode('latin1').decode('utf8'),
+        'query_string': environ.get('QUERY_STRING', '').encode('latin1'),
+        'headers': headers,
+        'server': (environ['SERVER_NAME'], int(environ['SERVER_PORT'])),
+        'client': (environ.get('REMOTE_ADDR', '127.0.0.1'), 0),
+    }
+
+
+async def call_asgi(app, scope, body=b''):
+    """returns: (status, headers, [body chunks]) of an ASGI app"""
+    response = {'chunks': []}
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            return {'type': 'http.disconnect'}
+        sent = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = message['headers']
+        else:
+            response['chunks'].append(message.get('body', b''))
+
+    await app(scope, receive, send)
+    return response['status'], response['headers'], response['chunks']
+
+
+class AsgiClient(FlaskClient):
+    """Test client sending requests through `AsgiAdapter`"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.asgi = AsgiAdapter(self.application, threads=4)
+
+    def wsgi_bridge(self, environ, start_response):
+        body = environ['wsgi.input'].read()
+        status, headers, chunks = asyncio.run(call_asgi(self.asgi, asgi_scope(environ), body))
+        start_response(f"{status} {HTTP_STATUS_CODES.get(status, '')}",
+                       [(k.decode('latin1'), v.decode('latin1')) for k, v in headers])
+        return chunks
+
+    def run_wsgi_app(self, environ, buffered=False):
+        if self.cookie_jar is not None:
+            self.cookie_jar.inject_wsgi(environ)
+        rv = run_wsgi_app(self.wsgi_bridge, environ, buffered=buffered)
+        if self.cookie_jar is not None:
+            self.cookie_jar.extract_wsgi(environ, rv[2])
+        return rv
+
+
 class MyTestCase(unittest.TestCase):
-    
+
     def tearDown(self):
         Session.rollback()
 
     @classmethod
     def setUpClass(cls):
         cls.app = create_app('testing')
+        # TEST_SERVER=asgi runs every request through the ASGI serving mode
+        if os.getenv('TEST_SERVER') == 'asgi':
+            cls.app.test_client_class = AsgiClient
 
     @classmethod
     def tearDownClass(cls):
     #     Session.remove()
-        Base.metadata.drop_all(bind=cls.app.engine)
\ No newline at end of file
+        Base.metadata.drop_all(bind=cls.app.engine)
@@ -1,12 +1,37 @@
 import unittest
+import asyncio
 import datetime
+import gzip
+import io
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from itertools import chain
+from unittest import mock
+import jwt
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.dialects import mysql
 from tests.myTestCase import MyTestCase
 
-from api.db import session_scope
+from api.asgi import AsgiAdapter
+from api.auth import (ALGORITHM, PRIVATE_KEY, TOKEN_CACHE, RevocationList,
+                      decode_token, get_identify, get_user_id)
+from api.common.cache import DiskCache, MemoryCache
+from api.common.kmers import SequenceIndex
+from api.common.plates import parse_well
+from api.common.replicas import ReplicaRouter
+from api.common.search import fulltext_query, parse_search
+from api.common.sql_models import Base
+from api.db import (Session, get_table_versions, iter_isolate_sequences,
+                    session_scope)
 from api.models import (Diver, DiveSite, Extract, Fraction,
-                        Isolate, IsolateStock, Library,
-                        Media, MediaRecipe, Permit, Sample, SampleType,
-                        ScreenPlate, User)
+                        FractionScreenPlate, Isolate, IsolateStock, Library,
+                        Media, Permit, Sample, SampleType,
+                        ScreenPlate, TableVersion, User)
 
 
 class TestApiRoot(MyTestCase):
@@ -645,4 +670,1767 @@ class TestLogin(MyTestCase):
         print(r)
         self.assertEqual(r.status_code, 200)
         data = r.json or {}
-        self.assertEqual(data.get('success'), True)
\ No newline at end of file
+        self.assertEqual(data.get('success'), True)
+
+page_sample_types = [SampleType(name=f'Page type {i}') for i in range(5)]
+page_libraries = [Library(name=f'Page library {i}', abbrev=f'PL{i}') for i in range(3)]
+class TestPagination(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add_all(page_sample_types + page_libraries)
+
+    def test_unpaginated(self):
+        r = self.client.get('/api/v1/sampletypes')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(r.json), 5)
+
+    def test_first_page(self):
+        r = self.client.get('/api/v1/sampletypes?limit=2')
+        self.assertEqual(r.status_code, 200)
+        data = r.json
+        self.assertEqual([x['id'] for x in data['results']], [1, 2])
+        self.assertEqual(data['next'], '/api/v1/sampletypes?limit=2&after=2')
+        self.assertIn('rel="next"', r.headers.get('Link'))
+
+    def test_follow_pages(self):
+        ids = []
+        url = '/api/v1/sampletypes?limit=2'
+        while url:
+            data = self.client.get(url).json
+            ids.extend(x['id'] for x in data['results'])
+            url = data['next']
+        self.assertEqual(ids, [1, 2, 3, 4, 5])
+
+    def test_last_page(self):
+        r = self.client.get('/api/v1/sampletypes?limit=2&after=4')
+        data = r.json
+        self.assertEqual([x['id'] for x in data['results']], [5])
+        self.assertIsNone(data['next'])
+        self.assertIsNone(r.headers.get('Link'))
+
+    def test_string_key(self):
+        r = self.client.get('/api/v1/libraries?limit=2&after=PL0')
+        data = r.json
+        self.assertEqual([x['abbrev'] for x in data['results']], ['PL1', 'PL2'])
+        self.assertIsNone(data['next'])
+
+    def test_bad_limit(self):
+        r = self.client.get('/api/v1/sampletypes?limit=ABC')
+        self.assertEqual(r.status_code, 400)
+
+    def test_bad_after(self):
+        r = self.client.get('/api/v1/sampletypes?after=ABC')
+        self.assertEqual(r.status_code, 400)
+
+
+stream_divers = [Diver(first_name='Stream', last_name=f'Diver{i}') for i in range(5)]
+class TestStreaming(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        self.app.config['STREAM_CHUNK_SIZE'] = 2
+        with session_scope() as sess:
+            sess.add_all(stream_divers)
+
+    def test_stream_json(self):
+        r = self.client.get('/api/v1/divers?stream=json')
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.is_streamed)
+        data = r.json
+        self.assertIsInstance(data, list)
+        self.assertEqual([x['id'] for x in data], [1, 2, 3, 4, 5])
+        self.assertEqual(data, self.client.get('/api/v1/divers').json)
+
+    def test_stream_ndjson(self):
+        r = self.client.get('/api/v1/divers?stream=ndjson&after=2')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.mimetype, 'application/x-ndjson')
+        lines = r.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(x)['id'] for x in lines], [3, 4, 5])
+
+    def test_stream_embed(self):
+        r = self.client.get('/api/v1/divers?stream=json&embed=samples')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(r.json), 5)
+
+    def test_stream_bad_format(self):
+        r = self.client.get('/api/v1/divers?stream=xml')
+        self.assertEqual(r.status_code, 400)
+
+
+eager_library = Library(name='Eager library', abbrev='EAG')
+eager_plate = ScreenPlate(name='Eager plate', well_format=384)
+eager_extracts = [Extract(number=i, library=eager_library) for i in range(1, 5)]
+eager_fractions = [
+    Fraction(code=code, extract=e,
+        fraction_screen_plates=[FractionScreenPlate(screen_plate=eager_plate, well=f'A{i}')])
+    for i, e in enumerate(eager_extracts) for code in 'AB'
+]
+class TestEagerLoading(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add_all(eager_fractions)
+
+    def count_queries(self, url):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            r = self.client.get(url)
+        finally:
+            event.remove(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(r.status_code, 200)
+        return len(statements)
+
+    def test_fractions_constant_queries(self):
+        few = self.count_queries('/api/v1/fractions?limit=2')
+        many = self.count_queries('/api/v1/fractions?limit=8')
+        self.assertEqual(few, many)
+
+    def test_nested_embed_constant_queries(self):
+        few = self.count_queries('/api/v1/extracts?limit=1&embed=fractions,libraries')
+        many = self.count_queries('/api/v1/extracts?limit=4&embed=fractions,libraries')
+        self.assertEqual(few, many)
+        few = self.count_queries('/api/v1/libraries?embed=extracts fractions')
+        self.assertLess(few, 10)
+
+    def test_embedded_content_unchanged(self):
+        r = self.client.get('/api/v1/extracts/1?embed=fractions')
+        embedded = r.json['fractions']['embedded']
+        self.assertEqual(len(embedded), 2)
+        self.assertEqual(embedded[0]['name'], 'RLEAG-0001A')
+        self.assertEqual(embedded[0]['screen_plates'][0]['name'], 'Eager plate')
+
+
+fields_site = DiveSite(name='Fields site', lat=1.0, lon=2.0)
+fields_divers = [Diver(first_name='Fields', last_name=f'Diver{i}', email='diver@test') for i in range(2)]
+fields_sample = Sample(name='Fields sample', collection_number=1, collection_year=2016,
+    notes='Long notes', dive_site=fields_site, divers=fields_divers)
+class TestFieldsets(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add(fields_sample)
+
+    def test_fields(self):
+        r = self.client.get('/api/v1/samples?fields=name')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json, [{'id': 1, 'name': 'Fields sample'}])
+
+    def test_fields_relationship_links(self):
+        r = self.client.get('/api/v1/samples/1?fields=name,divesites')
+        self.assertEqual(r.json, {
+            'id': 1, 'name': 'Fields sample',
+            'divesites': {'links': ['/api/v1/divesites/1']}
+        })
+
+    def test_links_false(self):
+        r = self.client.get('/api/v1/samples/1?links=false')
+        data = r.json
+        self.assertEqual(data['notes'], 'Long notes')
+        self.assertNotIn('divers', data)
+        self.assertNotIn('divesites', data)
+
+    def test_embedded_fields(self):
+        r = self.client.get('/api/v1/samples/1?fields=name&fields[divers]=last_name&embed=divers&links=false')
+        self.assertEqual(r.json, {
+            'id': 1, 'name': 'Fields sample',
+            'divers': {'embedded': [
+                {'id': 1, 'last_name': 'Diver0'}, {'id': 2, 'last_name': 'Diver1'}
+            ]}
+        })
+
+    def test_unused_columns_not_selected(self):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            self.client.get('/api/v1/samples?fields=name&embed=divers&fields[divers]=last_name')
+        finally:
+            event.remove(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertTrue(statements)
+        for statement in statements:
+            self.assertNotIn('notes', statement)
+            self.assertNotIn('email', statement)
+
+    def test_bad_fields(self):
+        r = self.client.get('/api/v1/samples?fields=BAD')
+        self.assertEqual(r.status_code, 400)
+        r = self.client.get('/api/v1/samples?fields[BAD]=name')
+        self.assertEqual(r.status_code, 400)
+
+
+links_site = DiveSite(name='Links site', lat=1.0, lon=2.0)
+links_samples = [
+    Sample(name=f'Links sample {i}', collection_number=i, collection_year=2016, dive_site=links_site,
+        divers=[Diver(first_name='Links', last_name=f'Diver{i}{j}', email='diver@test') for j in range(2)],
+        isolates=[Isolate(name=f'Links isolate {i}{j}') for j in range(i)])
+    for i in range(4)
+]
+class TestLinks(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add_all(links_samples)
+
+    def get_statements(self, url):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            r = self.client.get(url)
+        finally:
+            event.remove(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(r.status_code, 200)
+        return r, statements
+
+    def test_links(self):
+        r = self.client.get('/api/v1/samples/4')
+        data = r.json
+        self.assertEqual(data['divesites'], {'links': ['/api/v1/divesites/1']})
+        self.assertEqual(len(data['divers']['links']), 2)
+        self.assertEqual(len(data['isolates']['links']), 3)
+        # Links match the embedded rows
+        r = self.client.get('/api/v1/samples/4?embed=divers,isolates&links=true')
+        for key in ('divers', 'isolates'):
+            embedded = r.json[key]['embedded']
+            self.assertEqual(data[key]['links'], [f'/api/v1/{key}/{x["id"]}' for x in embedded])
+        r = self.client.get('/api/v1/samples/1')
+        self.assertEqual(r.json['isolates'], {'links': []})
+
+    def test_related_rows_not_loaded(self):
+        r, statements = self.get_statements('/api/v1/samples')
+        self.assertEqual(len(r.json), 4)
+        for statement in statements:
+            self.assertNotIn('FROM dive_site', statement)
+        _, more = self.get_statements('/api/v1/samples?limit=1')
+        self.assertEqual(len(statements), len(more))
+
+    def test_nested_links(self):
+        r = self.client.get('/api/v1/divesites/1?embed=samples divers')
+        embedded = r.json['samples']['embedded']
+        self.assertEqual(len(embedded), 4)
+        for sample in embedded:
+            self.assertEqual(sample['divesites'], {'links': ['/api/v1/divesites/1']})
+            self.assertEqual(len(sample['isolates']['links']), sample['collection_number'])
+            self.assertEqual(len(sample['divers']['embedded']), 2)
+
+
+cache_user = User(login='cacheuser', name='Cache User', password='cachepassword', level=1)
+class TestAuthCache(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        TOKEN_CACHE.clear()
+        with session_scope() as sess:
+            sess.add(cache_user)
+        r = self.client.post('/api/v1/login', json={'login': 'cacheuser', 'password': 'cachepassword'})
+        self.token = r.json['user']['token']
+        self.statements = []
+        event.listen(self.app.engine, 'before_cursor_execute', self.before_cursor_execute)
+
+    def tearDown(self):
+        event.remove(self.app.engine, 'before_cursor_execute', self.before_cursor_execute)
+        super().tearDown()
+
+    def before_cursor_execute(self, conn, cursor, statement, *args):
+        if statement != 'BEGIN':
+            self.statements.append(statement)
+
+    def identify(self, **kwargs):
+        with self.app.test_request_context('/', **kwargs):
+            return get_identify(request)
+
+    def test_cache_hit(self):
+        identity = self.identify(headers={'Authorization': f'JWT {self.token}'})
+        self.assertEqual(identity, (1, 1))
+        self.assertEqual(len(self.statements), 1)
+        identity = self.identify(query_string={'token': self.token})
+        self.assertEqual(identity, (1, 1))
+        self.assertEqual(len(self.statements), 1)
+
+    def test_resolved_once_per_request(self):
+        with self.app.test_request_context('/', headers={'Authorization': f'JWT {self.token}'}):
+            self.assertEqual(get_user_id(request), 1)
+            TOKEN_CACHE.clear()
+            self.assertEqual(get_identify(request), (1, 1))
+        self.assertEqual(len(self.statements), 1)
+
+    def test_logout_invalidates(self):
+        self.identify(headers={'Authorization': f'JWT {self.token}'})
+        r = self.client.get('/api/v1/logout', headers={'Authorization': f'JWT {self.token}'})
+        self.assertEqual(r.status_code, 200)
+        identity = self.identify(headers={'Authorization': f'JWT {self.token}'})
+        self.assertEqual(identity, (None, None))
+
+    def test_logout_other_worker(self):
+        self.identify(headers={'Authorization': f'JWT {self.token}'})
+        # Revoked by another worker, this one still has the token cached
+        claims = jwt.decode(self.token, verify=False)
+        other = RevocationList(self.app.config['AUTH_REVOCATION_FILE'])
+        other.revoke(claims['jti'], claims['exp'])
+        self.app.revocations.checked = 0
+        identity = self.identify(headers={'Authorization': f'JWT {self.token}'})
+        self.assertEqual(identity, (None, None))
+
+    def test_bad_token(self):
+        token = jwt.encode({'login': 'cacheuser'}, key='BAD', algorithm='HS256').decode()
+        identity = self.identify(headers={'Authorization': f'JWT {token}'})
+        self.assertEqual(identity, (None, None))
+
+
+stateless_user = User(login='statelessuser', name='Stateless User', password='statelesspassword', level=1)
+class TestStatelessAuth(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        self.app.config['AUTH_MODE'] = 'stateless'
+        with session_scope() as sess:
+            sess.add(stateless_user)
+        r = self.client.post('/api/v1/login', json={'login': 'statelessuser', 'password': 'statelesspassword'})
+        self.token = r.json['user']['token']
+        self.statements = []
+        event.listen(self.app.engine, 'before_cursor_execute', self.before_cursor_execute)
+
+    def tearDown(self):
+        event.remove(self.app.engine, 'before_cursor_execute', self.before_cursor_execute)
+        self.app.config['AUTH_MODE'] = 'database'
+        super().tearDown()
+
+    def before_cursor_execute(self, conn, cursor, statement, *args):
+        if statement != 'BEGIN':
+            self.statements.append(statement)
+
+    def identify(self, token):
+        with self.app.test_request_context('/', headers={'Authorization': f'JWT {token}'}):
+            return get_identify(request)
+
+    def test_no_queries(self):
+        self.assertEqual(self.identify(self.token), (1, 1))
+        self.assertEqual(self.statements, [])
+
+    def test_logout_revokes(self):
+        r = self.client.get('/api/v1/logout', headers={'Authorization': f'JWT {self.token}'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.identify(self.token), (None, None))
+        # Other workers see the revocation through the shared file
+        claims = jwt.decode(self.token, verify=False)
+        other = RevocationList(self.app.config['AUTH_REVOCATION_FILE'], refresh=0)
+        self.assertTrue(other.is_revoked(claims['jti']))
+
+    def test_token_without_jti(self):
+        claims = jwt.decode(self.token, verify=False)
+        del claims['jti']
+        token = jwt.encode(claims, key=PRIVATE_KEY, algorithm=ALGORITHM).decode()
+        # Unknown to user_token, the claims are decoded once
+        with mock.patch('api.auth.decode_token', wraps=decode_token) as decode:
+            self.assertEqual(self.identify(token), (None, None))
+        self.assertEqual(decode.call_count, 1)
+        self.assertTrue(self.statements)
+
+
+bulk_site = DiveSite(name='Bulk site', lat=1.0, lon=2.0)
+bulk_diver = Diver(first_name='Bulk', last_name='Diver', email='diver@test')
+class TestBulkCreate(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add_all([bulk_site, bulk_diver])
+
+    def divers(self, *names):
+        return [{'first_name': 'Bulk', 'last_name': x, 'email': 'diver@test'} for x in names]
+
+    def test_bulk_create(self):
+        r = self.client.post('/api/v1/divers', json=self.divers('A', 'B', 'C'))
+        self.assertEqual(r.status_code, 201)
+        data = r.json
+        self.assertTrue(data['success'])
+        ids = [x['id'] for x in data['results']]
+        self.assertEqual(data['results'][0]['link'], f'/api/v1/divers/{ids[0]}')
+        r = self.client.get(f'/api/v1/divers/{ids[2]}')
+        self.assertEqual(r.json['last_name'], 'C')
+
+    def test_atomic_integrity_error(self):
+        r = self.client.post('/api/v1/divers', json=self.divers('D', 'Diver', 'E'))
+        self.assertEqual(r.status_code, 409)
+        results = r.json['results']
+        self.assertEqual([x['status'] for x in results], [424, 409, 424])
+        r = self.client.get('/api/v1/divers?last_name=D')
+        self.assertEqual(r.json, [])
+
+    def test_atomic_invalid_input(self):
+        r = self.client.post('/api/v1/divers', json=self.divers('F') + [{'BAD': 1}])
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual([x['status'] for x in r.json['results']], [424, 400])
+        r = self.client.get('/api/v1/divers?last_name=F')
+        self.assertEqual(r.json, [])
+
+    def test_partial(self):
+        items = self.divers('G', 'Diver') + [{'BAD': 1}] + self.divers('H')
+        r = self.client.post('/api/v1/divers?atomic=false', json=items)
+        self.assertEqual(r.status_code, 207)
+        data = r.json
+        self.assertFalse(data['success'])
+        self.assertEqual([x['status'] for x in data['results']], [201, 409, 400, 201])
+        r = self.client.get('/api/v1/divers?last_name=H')
+        self.assertEqual(len(r.json), 1)
+
+    def test_bulk_samples(self):
+        items = [
+            {'name': f'Bulk sample {i}', 'collection_number': i, 'collection_year': 2016,
+             'dive_site_id': 1, 'diver_ids': [1]}
+            for i in range(3)
+        ]
+        r = self.client.post('/api/v1/samples', json=items)
+        self.assertEqual(r.status_code, 201)
+        id_ = r.json['results'][2]['id']
+        r = self.client.get(f'/api/v1/samples/{id_}')
+        self.assertEqual(r.json['divers'], {'links': ['/api/v1/divers/1']})
+
+    def test_bulk_media(self):
+        items = [
+            {'media': {'name': f'BLK{i}'}, 'recipe': [{'ingredient': 'salt', 'amount': 1.0, 'unit': 'g'}]}
+            for i in range(2)
+        ]
+        r = self.client.post('/api/v1/media', json=items)
+        self.assertEqual(r.status_code, 201)
+        id_ = r.json['results'][1]['id']
+        r = self.client.get(f'/api/v1/media/{id_}')
+        self.assertEqual(r.json['recipe'][0]['ingredient'], 'salt')
+
+    def test_bulk_isolates(self):
+        items = [{'name': f'Bulk isolate {i}', 'stock': {'box': 1, 'box_position': i}} for i in range(5)]
+        inserts = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('INSERT INTO isolate_stock'):
+                inserts.append(len(parameters) if executemany else 1)
+        event.listen(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            r = self.client.post('/api/v1/isolates', json=items)
+        finally:
+            event.remove(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(r.status_code, 201, r.json)
+        # All stocks in one executemany
+        self.assertEqual(inserts, [5])
+        id_ = r.json['results'][3]['id']
+        r = self.client.get(f'/api/v1/isolates/{id_}')
+        stock = r.json['stocks'][0]
+        self.assertEqual(stock['box_position'], 3)
+        self.assertEqual(stock['volume_ul'], 1000)
+
+
+import_site = DiveSite(name='Import site', lat=1.0, lon=2.0)
+import_diver = Diver(first_name='Import', last_name='Diver', email='diver@test')
+import_library = Library(name='Import library', abbrev='IMP')
+class TestImport(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add_all([import_site, import_diver, import_library])
+
+    def post(self, url, body, **kwargs):
+        r = self.client.post(url, data=body, **kwargs)
+        self.assertEqual(r.status_code, 200)
+        return [json.loads(x) for x in r.get_data(as_text=True).splitlines()]
+
+    def test_import_samples(self):
+        body = (
+            'name,collection_number,collection_year,collection_date,dive_site,divers\n'
+            'Import sample 1,1,2016,2016-07-09,Import site,Import Diver\n'
+            'Import sample 2,2,2016,,Import site,\n'
+            'Import sample 3,3,2016,,Unknown site,\n'
+            'Import sample 4,,2016,,Import site,\n'
+            'Import sample 5,x,2016,,Import site,\n'
+        )
+        reports = self.post('/api/v1/import/samples?chunk_size=2', body, content_type='text/csv')
+        self.assertEqual(len(reports), 3)
+        report = reports[-1]
+        self.assertEqual(report['rows'], 5)
+        self.assertEqual(report['created'], 2)
+        self.assertEqual(report['failed'], 3)
+        self.assertEqual([x['line'] for x in report['errors']], [4, 5, 6])
+        r = self.client.get('/api/v1/samples?name=Import sample 1')
+        sample = r.json[0]
+        self.assertEqual(sample['collection_date'], '2016-07-09')
+        self.assertEqual(sample['divers'], {'links': ['/api/v1/divers/1']})
+        self.assertEqual(sample['divesites'], {'links': ['/api/v1/divesites/1']})
+
+    def test_import_gzip_tsv_file(self):
+        extracts = 'number\tlibrary\tvolume_ml\n1\tIMP\t1.5\n2\tIMP\t2.5\n'
+        data = {'file': (io.BytesIO(gzip.compress(extracts.encode())), 'extracts.tsv.gz')}
+        reports = self.post('/api/v1/import/extracts', data, content_type='multipart/form-data')
+        self.assertEqual(reports[-1]['created'], 2)
+        fractions = 'extract,code\nRLIMP-0001,A\nRLIMP-0002,A\nRLIMP-0003,A\n'
+        reports = self.post('/api/v1/import/fractions', fractions, content_type='text/csv')
+        report = reports[-1]
+        self.assertEqual(report['created'], 2)
+        self.assertEqual(report['errors'], [{'line': 4, 'error': 'Unknown extract RLIMP-0003'}])
+        r = self.client.get('/api/v1/fractions?name=RLIMP-0002A')
+        self.assertEqual(len(r.json), 1)
+
+    def test_import_isolates(self):
+        body = 'name,media,stock_box,stock_box_position\nImport isolate,,1,2\nNo stock isolate,,,\n'
+        report = self.post('/api/v1/import/isolates', body, content_type='text/csv')[-1]
+        self.assertEqual(report['created'], 1)
+        self.assertEqual(report['errors'][0]['line'], 3)
+
+    def test_bad_import(self):
+        r = self.client.post('/api/v1/import/samples', data='name,BAD\n', content_type='text/csv')
+        self.assertEqual(r.status_code, 400)
+        r = self.client.post('/api/v1/import/BAD', data='name\n', content_type='text/csv')
+        self.assertEqual(r.status_code, 404)
+        r = self.client.post('/api/v1/import/samples', data=b'\xffname\n', content_type='text/csv')
+        self.assertEqual(r.status_code, 400)
+
+    def test_unreadable_import(self):
+        # Invalid UTF-8 past the first block the file is decoded in
+        rows = ''.join(f'{i},IMP\n' for i in range(1001, 2001))
+        body = ('number,library\n' + rows).encode() + b'\xff\n'
+        reports = self.post('/api/v1/import/extracts?chunk_size=500', body, content_type='text/csv')
+        report = reports[-1]
+        self.assertTrue(report['done'])
+        self.assertFalse(any(x['done'] for x in reports[:-1]))
+        self.assertIn('Unreadable file', report['error'])
+        self.assertEqual(report['errors'][-1]['error'], report['error'])
+        # Rows read before the error are committed
+        self.assertGreater(report['created'], 500)
+        self.assertEqual(report['created'], report['rows'])
+        r = self.client.head('/api/v1/extracts?library_abbrev=IMP&number[gt]=1000')
+        self.assertEqual(r.headers['X-Total-Count'], str(report['created']))
+        # Truncated gzip file
+        data = {'file': (io.BytesIO(gzip.compress(b'name\n' * 100)[:-10]), 'samples.csv.gz')}
+        report = self.post('/api/v1/import/samples', data, content_type='multipart/form-data')[-1]
+        self.assertTrue(report['done'])
+        self.assertIn('Unreadable file', report['error'])
+
+
+etag_library = Library(name='ETag library', abbrev='ETG')
+class TestConditionalGet(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add(etag_library)
+
+    def test_etag(self):
+        r = self.client.get('/api/v1/libraries')
+        self.assertEqual(r.status_code, 200)
+        etag = r.headers['ETag']
+        self.assertTrue(r.headers['Last-Modified'])
+        r = self.client.get('/api/v1/libraries', headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.headers['ETag'], etag)
+        # Depends on query parameters
+        r = self.client.get('/api/v1/libraries?embed=extracts', headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 200)
+        r = self.client.get('/api/v1/libraries/ETG', headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 200)
+
+    def test_not_modified_skips_query(self):
+        etag = self.client.get('/api/v1/libraries').headers['ETag']
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            r = self.client.get('/api/v1/libraries', headers={'If-None-Match': etag})
+        finally:
+            event.remove(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(r.status_code, 304)
+        self.assertFalse([x for x in statements if 'FROM library' in x])
+
+    def test_write_changes_etag(self):
+        etag = self.client.get('/api/v1/libraries').headers['ETag']
+        r = self.client.post('/api/v1/libraries', json={'name': 'ETag library 2', 'abbrev': 'ET2'})
+        self.assertEqual(r.status_code, 201)
+        r = self.client.get('/api/v1/libraries', headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r.headers['ETag'], etag)
+        # Related table changes links
+        etag = r.headers['ETag']
+        r = self.client.post('/api/v1/extracts', json={'number': 1, 'library_abbrev': 'ETG'})
+        self.assertEqual(r.status_code, 201)
+        r = self.client.get('/api/v1/libraries', headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 200)
+
+    def test_failed_write_keeps_etag(self):
+        etag = self.client.get('/api/v1/libraries').headers['ETag']
+        r = self.client.post('/api/v1/libraries', json={'name': 'Duplicate', 'abbrev': 'ETG'})
+        self.assertEqual(r.status_code, 409)
+        r = self.client.get('/api/v1/libraries', headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+
+    def test_if_modified_since(self):
+        modified = self.client.get('/api/v1/libraries').headers['Last-Modified']
+        r = self.client.get('/api/v1/libraries', headers={'If-Modified-Since': modified})
+        self.assertEqual(r.status_code, 304)
+
+
+cache_library = Library(name='Cache library', abbrev='CCH')
+cache_extract = Extract(number=1, library=cache_library)
+class TestResponseCache(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        self.app.response_cache = MemoryCache()
+        with session_scope() as sess:
+            sess.add(cache_extract)
+
+    def get(self, url):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            r = self.client.get(url)
+        finally:
+            event.remove(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(r.status_code, 200)
+        return r, [x for x in statements if 'FROM extract' in x]
+
+    def test_memory_cache(self):
+        url = '/api/v1/extracts?embed=fractions,libraries'
+        first, queries = self.get(url)
+        self.assertTrue(queries)
+        second, queries = self.get(url)
+        self.assertEqual(queries, [])
+        self.assertEqual(first.json, second.json)
+        self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+        self.assertEqual(second.headers['Content-Type'], 'application/json')
+        # Writes to an embedded table invalidate the entry
+        r = self.client.post('/api/v1/fractions', json={'extract_id': 1, 'code': 'A'})
+        self.assertEqual(r.status_code, 201)
+        third, queries = self.get(url)
+        self.assertTrue(queries)
+        self.assertEqual(len(third.json[0]['fractions']['embedded']), 1)
+
+    def test_disk_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cache.db')
+            memory_cache = self.app.response_cache
+            self.app.response_cache = DiskCache(path)
+            try:
+                first, _ = self.get('/api/v1/extracts/1')
+                second, queries = self.get('/api/v1/extracts/1')
+            finally:
+                self.app.response_cache = memory_cache
+            self.assertEqual(queries, [])
+            self.assertEqual(first.json, second.json)
+            # Shared by other workers
+            other = DiskCache(path)
+            etag = second.headers['ETag'].strip('"')
+            key = f"{etag}:None"
+            self.assertIsNotNone(other.get(key))
+
+    def test_disk_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DiskCache(os.path.join(tmp, 'cache.db'), max_bytes=10)
+            cache.set('a', (200, [], b'123456'))
+            cache.set('b', (200, [], b'123456'))
+            self.assertIsNone(cache.get('a'))
+            self.assertEqual(cache.get('b'), (200, [], b'123456'))
+
+    def test_memory_cache_eviction(self):
+        cache = MemoryCache(max_bytes=10, max_entry_bytes=8)
+        cache.set('a', (200, [], b'123456'))
+        cache.set('b', (200, [], b'123456'))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), (200, [], b'123456'))
+        self.assertEqual(cache.size, 6)
+        # Replacing an entry releases its bytes
+        cache.set('b', (200, [], b'1234'))
+        self.assertEqual(cache.size, 4)
+        # Too large to cache
+        cache.set('c', (200, [], b'123456789'))
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.size, 4)
+
+    def test_entry_limit(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DiskCache(os.path.join(tmp, 'cache.db'), max_entry_bytes=8)
+            cache.set('a', (200, [], b'123456789'))
+            self.assertIsNone(cache.get('a'))
+        self.app.response_cache = MemoryCache(max_entry_bytes=10)
+        _, queries = self.get('/api/v1/extracts?embed=fractions,libraries')
+        _, queries = self.get('/api/v1/extracts?embed=fractions,libraries')
+        self.assertTrue(queries)
+
+    def test_versions_after_commit(self):
+        version = get_table_versions()['diver'][0]
+        sess = Session()
+        try:
+            sess.add(Diver(first_name='Version', last_name='Rollback'))
+            sess.flush()
+            # Not bumped inside the writing transaction
+            self.assertEqual(get_table_versions(sess)['diver'][0], version)
+            sess.rollback()
+        finally:
+            Session.remove()
+        self.assertEqual(get_table_versions()['diver'][0], version)
+        with session_scope() as sess:
+            sess.add(Diver(first_name='Version', last_name='Commit'))
+        self.assertEqual(get_table_versions()['diver'][0], version + 1)
+
+
+name_library = Library(name='Name library', abbrev='NAM')
+name_extracts = [
+    Extract(number=i, library=name_library, fractions=[Fraction(code=c) for c in 'AB'])
+    for i in (1, 2, 10)
+]
+class TestNames(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add_all(name_extracts)
+
+    def test_names_persisted(self):
+        r = self.client.post('/api/v1/fractions', json={'extract_id': 1, 'code': 'C'})
+        self.assertEqual(r.status_code, 201)
+        with session_scope() as sess:
+            fraction = sess.query(Fraction).get(r.json['id'])
+            self.assertEqual(fraction.name, 'RLNAM-0001C')
+            self.assertEqual(sess.query(Extract.name).filter_by(number=10).scalar(), 'RLNAM-0010')
+
+    def test_name_filter(self):
+        r = self.client.get('/api/v1/fractions?name=RLNAM-0002B')
+        self.assertEqual([x['name'] for x in r.json], ['RLNAM-0002B'])
+        r = self.client.get('/api/v1/fractions?name=RLNAM-0001*')
+        self.assertEqual(sorted(x['name'] for x in r.json)[:2], ['RLNAM-0001A', 'RLNAM-0001B'])
+        r = self.client.get('/api/v1/extracts?name=RLNAM-001*')
+        self.assertEqual([x['name'] for x in r.json], ['RLNAM-0010'])
+        r = self.client.get('/api/v1/extracts?name=RLNAM-0002')
+        self.assertEqual(len(r.json), 1)
+
+    def test_fractions_without_extract_load(self):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            r = self.client.get('/api/v1/fractions?fields=name')
+        finally:
+            event.remove(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertIn('RLNAM-0010A', [x['name'] for x in r.json])
+        self.assertFalse([x for x in statements if 'FROM extract' in x])
+
+    def test_rename_extract(self):
+        with session_scope() as sess:
+            extract = sess.query(Extract).filter_by(number=2).one()
+            extract.number = 3
+        r = self.client.get('/api/v1/fractions?name=RLNAM-0003*')
+        self.assertEqual(sorted(x['name'] for x in r.json), ['RLNAM-0003A', 'RLNAM-0003B'])
+        with session_scope() as sess:
+            extract = sess.query(Extract).filter_by(number=3).one()
+            extract.number = 2
+
+    def test_duplicate_name(self):
+        r = self.client.post('/api/v1/extracts', json={'number': 1, 'library_abbrev': 'NAM'})
+        self.assertEqual(r.status_code, 409)
+
+    def test_bulk_names(self):
+        with session_scope() as sess:
+            ids = [id_ for id_, in sess.query(Extract.id).filter(Extract.name.in_(['RLNAM-0001', 'RLNAM-0010']))]
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        # Sessions of this thread may still be bound to an earlier app's engine
+        engines = {self.app.engine, Session().get_bind()}
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            items = [{'extract_id': id_, 'code': code} for id_ in ids for code in 'EF']
+            r = self.client.post('/api/v1/fractions', json=items)
+        finally:
+            for engine in engines:
+                event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(r.status_code, 201, r.json)
+        # Extracts loaded in one query, not one per fraction
+        self.assertEqual(len([x for x in statements if 'FROM extract' in x]), 1)
+        r = self.client.get('/api/v1/fractions?name=RLNAM-0010F')
+        self.assertEqual(len(r.json), 1)
+
+    def test_name_from_relationship(self):
+        with session_scope() as sess:
+            extract = sess.query(Extract).filter_by(number=10).one()
+            extract.library = Library(name='Name library 2', abbrev='NM2')
+            # Foreign key not set yet
+            self.assertEqual(extract.build_name(), 'RLNM2-0010')
+            self.assertEqual(extract.fractions[0].build_name()[:10], 'RLNM2-0010')
+            sess.rollback()
+
+
+resolve_library = Library(name='Resolve library', abbrev='RES')
+resolve_plate = ScreenPlate(name='Resolve plate', well_format=384)
+resolve_extracts = [Extract(number=i, library=resolve_library) for i in range(1, 4)]
+resolve_fractions = [Fraction(code=code, extract=x) for x in resolve_extracts for code in 'AB']
+resolve_fractions[0].fraction_screen_plates.append(FractionScreenPlate(screen_plate=resolve_plate, well='A1'))
+
+
+class TestFractionNames(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add_all(resolve_fractions)
+
+    def test_resolve_names(self):
+        r = self.client.post('/api/v1/fractions/resolve',
+            json={'names': ['RLRES-0001A', 'RLRES-0009A', 'RLRES-0002A..0003B']})
+        self.assertEqual(r.status_code, 200)
+        results = r.json['results']
+        # Input order
+        self.assertEqual(list(results), ['RLRES-0001A', 'RLRES-0002A', 'RLRES-0002B',
+                                         'RLRES-0003A', 'RLRES-0003B'])
+        self.assertEqual(len(results['RLRES-0001A']['screen_plates']), 1)
+        self.assertEqual(results['RLRES-0002B']['screen_plates'], [])
+        self.assertEqual(results['RLRES-0002A']['extract_id'], results['RLRES-0002B']['extract_id'])
+        self.assertNotEqual(results['RLRES-0002A']['id'], results['RLRES-0002B']['id'])
+        with session_scope() as sess:
+            name = sess.query(Fraction.name).filter_by(id=results['RLRES-0003A']['id']).scalar()
+        self.assertEqual(name, 'RLRES-0003A')
+        self.assertEqual(r.json['unmatched'], ['RLRES-0009A'])
+
+    def test_resolve_range_with_library(self):
+        r = self.client.post('/api/v1/fractions/resolve', json=['RLRES-0001B..RLRES-0004B'])
+        self.assertEqual(list(r.json['results']), ['RLRES-0001B', 'RLRES-0002B', 'RLRES-0003B'])
+        self.assertEqual(r.json['unmatched'], ['RLRES-0004B'])
+
+    def test_resolve_input_order(self):
+        names = ['RLRES-0003B', 'RLRES-0001A', 'RLRES-0002A']
+        r = self.client.post('/api/v1/fractions/resolve', json=names)
+        self.assertEqual(list(r.json['results']), names)
+
+    def test_resolve_overlapping(self):
+        r = self.client.post('/api/v1/fractions/resolve', json=['RLRES-1A', 'RLRES-0001A..0001B'])
+        results = r.json['results']
+        self.assertEqual(list(results), ['RLRES-0001A', 'RLRES-0001B'])
+        self.assertEqual(len(results['RLRES-0001A']['screen_plates']), 1)
+
+    def test_resolve_invalid(self):
+        for names in (['RES-1A'], ['RLRES-0003A..0001A'], ['RLRES-0001A..RLOTH-0002A'], [1], {}):
+            r = self.client.post('/api/v1/fractions/resolve', json=names)
+            self.assertEqual(r.status_code, 400, names)
+
+    def test_resolve_limit(self):
+        self.app.config['FRACTION_RESOLVE_MAX'] = 100
+        try:
+            r = self.client.post('/api/v1/fractions/resolve', json=['RLRES-0001A..0999Z'])
+        finally:
+            self.app.config['FRACTION_RESOLVE_MAX'] = 200000
+        self.assertEqual(r.status_code, 400)
+
+
+filter_site = DiveSite(name='Filter site', lat=1.0, lon=2.0)
+filter_samples = [
+    Sample(name=f'Filter {year}', collection_number=i, collection_year=year,
+        collection_date=datetime.date(year, 6, 1), depth_ft=10.0 * i,
+        genus_species=species, dive_site=filter_site)
+    for i, (year, species) in enumerate([(2014, 'Streptomyces sp.'), (2015, 'Salinispora sp.'),
+                                         (2016, 'Streptomyces albus'), (2017, None)], start=1)
+]
+
+
+class TestFilters(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add_all(filter_samples)
+
+    def names(self, query):
+        r = self.client.get(f'/api/v1/samples?{query}')
+        self.assertEqual(r.status_code, 200, r.json)
+        return sorted(x['name'] for x in r.json)
+
+    def test_comparisons(self):
+        self.assertEqual(self.names('collection_year[gte]=2015&collection_year[lt]=2017'),
+                         ['Filter 2015', 'Filter 2016'])
+        self.assertEqual(self.names('depth_ft[gt]=25&collection_year[ne]=2017'), ['Filter 2016'])
+        self.assertEqual(self.names('collection_date[lte]=2014-12-31'), ['Filter 2014'])
+
+    def test_like_in_null(self):
+        self.assertEqual(self.names('genus_species[like]=Strepto%'), ['Filter 2014', 'Filter 2016'])
+        self.assertEqual(self.names('collection_year[in]=2014,2017'), ['Filter 2014', 'Filter 2017'])
+        self.assertEqual(self.names('collection_year[nin]=2014,2017'), ['Filter 2015', 'Filter 2016'])
+        self.assertEqual(self.names('genus_species[null]=true'), ['Filter 2017'])
+        self.assertEqual(len(self.names('genus_species[null]=false')), 3)
+
+    def test_other_resources(self):
+        r = self.client.get('/api/v1/divesites?name[eq]=Filter site')
+        self.assertEqual([x['name'] for x in r.json], ['Filter site'])
+        r = self.client.get('/api/v1/libraries?abbrev[in]=NONE')
+        self.assertEqual(r.json, [])
+
+    def test_with_pagination(self):
+        r = self.client.get('/api/v1/samples?collection_year[gte]=2015&limit=1')
+        self.assertEqual([x['name'] for x in r.json['results']], ['Filter 2015'])
+        r = self.client.get(r.json['next'])
+        self.assertEqual([x['name'] for x in r.json['results']], ['Filter 2016'])
+
+    def test_invalid_filters(self):
+        for query in ('collection_year[foo]=1', 'unknown[eq]=1', 'collection_year[gte]=abc',
+                      'collection_year[like]=20%', 'collection_date[lt]=June', 'id[in]=,'):
+            r = self.client.get(f'/api/v1/samples?{query}')
+            self.assertEqual(r.status_code, 400, query)
+
+
+path_sites = [DiveSite(name=f'Path site {i}', lat=1.0, lon=2.0) for i in range(2)]
+path_divers = [Diver(first_name=first, last_name=last, email='diver@test')
+               for first, last in [('Ann', 'Path'), ('Ann', 'Other'), ('Bob', 'Path')]]
+path_samples = [
+    Sample(name='Path 2016 A', collection_number=1, collection_year=2016, dive_site=path_sites[0],
+           divers=[path_divers[0]], isolates=[Isolate(name='Path isolate 1')]),
+    Sample(name='Path 2015 A', collection_number=2, collection_year=2015, dive_site=path_sites[0],
+           divers=[path_divers[1], path_divers[2]], isolates=[Isolate(name='Path isolate 2')]),
+    Sample(name='Path 2016 B', collection_number=3, collection_year=2016, dive_site=path_sites[1],
+           isolates=[Isolate(name='Path isolate 3')]),
+]
+
+
+class TestRelationshipFilters(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add_all(path_samples)
+
+    def names(self, url):
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 200, r.json)
+        return sorted(x['name'] for x in r.json)
+
+    def test_many_to_one_path(self):
+        self.assertEqual(self.names('/api/v1/isolates?sample.dive_site.name=Path site 0'
+                                    '&sample.collection_year=2016'), ['Path isolate 1'])
+        self.assertEqual(self.names('/api/v1/isolates?sample.collection_year[lt]=2016'
+                                    '&sample.name[like]=Path%'), ['Path isolate 2'])
+
+    def test_collection_path(self):
+        self.assertEqual(self.names('/api/v1/divesites?samples.isolates.name=Path isolate 3'),
+                         ['Path site 1'])
+        # Conditions on one relationship apply to the same related row
+        self.assertEqual(self.names('/api/v1/samples?divers.first_name=Ann&divers.last_name=Path'),
+                         ['Path 2016 A'])
+
+    def test_endpoint_keys(self):
+        self.assertEqual(self.names('/api/v1/samples?divesites.name=Path site 1'), ['Path 2016 B'])
+
+    def test_single_query(self):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            self.client.get('/api/v1/isolates?sample.dive_site.name=Path site 0&links=false')
+        finally:
+            event.remove(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        selects = [x for x in statements if 'FROM isolate \n' in x]
+        self.assertEqual(len(selects), 1)
+        self.assertIn('EXISTS', selects[0])
+
+    def test_etag_depends_on_path_tables(self):
+        url = '/api/v1/isolates?sample.dive_site.name=Path site 0'
+        etag = self.client.get(url).headers['ETag']
+        with session_scope() as sess:
+            sess.query(DiveSite).filter_by(name='Path site 1').one().notes = 'changed'
+        r = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 200)
+
+    def test_invalid_paths(self):
+        for query in ('sample.unknown.name=1', 'sample.unknown=1', 'sample.collection_year[foo]=1'):
+            r = self.client.get(f'/api/v1/isolates?{query}')
+            self.assertEqual(r.status_code, 400, query)
+
+
+sort_site = DiveSite(name='Sort site', lat=1.0, lon=2.0)
+sort_values = [(f'Sort {i}', 2000 + i % 3, datetime.date(2000 + i % 3, 1, 1) if i % 4 else None)
+               for i in range(10)]
+sort_samples = [
+    Sample(name=name, collection_number=1, collection_year=year, collection_date=date,
+           dive_site=sort_site)
+    for name, year, date in sort_values
+]
+# sort=-collection_year,collection_date,name
+sort_expected = [name for name, _, _ in
+                 sorted(sort_values, key=lambda x: (-x[1], x[2] or datetime.date.min, x[0]))]
+
+
+class TestSorting(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add_all(sort_samples)
+
+    def pages(self, url):
+        names = []
+        while url:
+            r = self.client.get(url)
+            self.assertEqual(r.status_code, 200, r.json)
+            names += [x['name'] for x in r.json['results']]
+            url = r.json['next']
+        return names
+
+    def test_sort(self):
+        r = self.client.get('/api/v1/samples?sort=-collection_year,collection_date,name')
+        self.assertEqual([x['name'] for x in r.json], sort_expected)
+
+    def test_sort_pages(self):
+        names = self.pages('/api/v1/samples?sort=-collection_year,collection_date,name&limit=3')
+        self.assertEqual(names, sort_expected)
+        # Descending with NULL dates, which sort last
+        names = self.pages('/api/v1/samples?sort=-collection_date&limit=2')
+        r = self.client.get('/api/v1/samples?sort=-collection_date')
+        self.assertEqual(names, [x['name'] for x in r.json])
+        self.assertEqual(len(set(names)), 10)
+
+    def test_sort_stream(self):
+        self.app.config['STREAM_CHUNK_SIZE'] = 3
+        try:
+            r = self.client.get('/api/v1/samples?sort=-collection_year,collection_date,name&stream=json')
+        finally:
+            self.app.config['STREAM_CHUNK_SIZE'] = 500
+        self.assertEqual([x['name'] for x in json.loads(r.data)], sort_expected)
+
+    def test_sort_names(self):
+        with session_scope() as sess:
+            sess.add(Extract(number=2, library=Library(name='Sort library', abbrev='SRT')))
+            sess.add(Extract(number=1, library_abbrev='SRT'))
+        r = self.client.get('/api/v1/extracts?sort=-name&library_abbrev=SRT')
+        self.assertEqual([x['name'] for x in r.json], ['RLSRT-0002', 'RLSRT-0001'])
+
+    def test_invalid_sort(self):
+        for query in ('sort=unknown', 'sort=name,-name', 'sort=name&after=1', 'sort=name&after=W10'):
+            r = self.client.get(f'/api/v1/samples?{query}')
+            self.assertEqual(r.status_code, 400, query)
+
+
+count_site = DiveSite(name='Count site', lat=1.0, lon=2.0)
+count_samples = [Sample(name=f'Count {i}', collection_number=i, collection_year=2010 + i % 2,
+                        dive_site=count_site) for i in range(5)]
+
+
+class TestCounts(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add_all(count_samples)
+
+    def statements(self, method, url):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        # The first request of a class may run on the session left by the previous
+        # class, requests served through ASGI run on sessions of their own threads
+        engines = {Session().get_bind(), self.app.engine}
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            r = self.client.open(url, method=method)
+        finally:
+            for engine in engines:
+                event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        return r, [x for x in statements if 'FROM sample' in x]
+
+    def test_count(self):
+        r, statements = self.statements('GET', '/api/v1/samples?count=true&collection_year[eq]=2010')
+        self.assertEqual(r.json, {'count': 3})
+        self.assertEqual(r.headers['X-Total-Count'], '3')
+        self.assertEqual(len(statements), 1)
+        self.assertIn('count(', statements[0])
+
+    def test_head(self):
+        r, statements = self.statements('HEAD', '/api/v1/samples?collection_year[gte]=2011')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers['X-Total-Count'], '2')
+        self.assertEqual(r.data, b'')
+        self.assertIn('count(', statements[0])
+        # Cached HEAD is not returned for GET
+        r = self.client.get('/api/v1/samples?collection_year[gte]=2011')
+        self.assertEqual(len(r.json), 2)
+        r = self.client.head('/api/v1/samples?collection_year[gte]=2011')
+        self.assertEqual(r.headers['X-Total-Count'], '2')
+
+    def test_count_changes(self):
+        r = self.client.get('/api/v1/divesites?count=true&name=Count site')
+        self.assertEqual(r.json['count'], 1)
+        r = self.client.post('/api/v1/divesites', json={'name': 'Count site 2', 'lat': 3.0, 'lon': 2.0})
+        r = self.client.get('/api/v1/divesites?count=true&name[like]=Count site%')
+        self.assertEqual(r.json['count'], 2)
+
+    def test_summary_counts(self):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            r = self.client.get('/api/v1/?count=true')
+        finally:
+            event.remove(self.app.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(len([x for x in statements if x != 'BEGIN']), 1)
+        self.assertEqual(r.json['/api/v1/samples'], 5)
+        self.assertIsNone(r.json['/api/v1/heartbeat'])
+        self.assertEqual(len(r.json), 12)
+
+
+stats_sites = [DiveSite(name=f'Stats site {i}', lat=1.0, lon=2.0) for i in range(2)]
+stats_divers = [Diver(first_name='Stats', last_name=f'Diver{i}', email='diver@test') for i in range(2)]
+stats_samples = [
+    Sample(name='Stats 1', collection_number=1, collection_year=2015, depth_ft=10.0,
+           dive_site=stats_sites[0], divers=stats_divers),
+    Sample(name='Stats 2', collection_number=2, collection_year=2015, depth_ft=20.0,
+           dive_site=stats_sites[1], divers=[stats_divers[0]]),
+    Sample(name='Stats 3', collection_number=3, collection_year=2016, depth_ft=30.0,
+           dive_site=stats_sites[1]),
+]
+stats_library = Library(name='Stats library', abbrev='STA')
+stats_extracts = [Extract(number=i, library=stats_library) for i in range(1, 3)]
+stats_fractions = [Fraction(code=code, extract=x) for x in stats_extracts for code in 'ABC']
+
+
+class TestStats(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add_all(stats_samples + stats_fractions)
+
+    def test_group_by_column(self):
+        r = self.client.get('/api/v1/stats/samples?group_by=collection_year'
+                            '&agg=count,avg(depth_ft),max(depth_ft),min(depth_ft)')
+        self.assertEqual(r.status_code, 200, r.json)
+        self.assertEqual(r.json['results'], [
+            {'collection_year': 2015, 'count': 2, 'avg_depth_ft': 15.0,
+             'max_depth_ft': 20.0, 'min_depth_ft': 10.0},
+            {'collection_year': 2016, 'count': 1, 'avg_depth_ft': 30.0,
+             'max_depth_ft': 30.0, 'min_depth_ft': 30.0},
+        ])
+
+    def test_group_by_relationship(self):
+        r = self.client.get('/api/v1/stats/samples?group_by=dive_site.name')
+        self.assertEqual(r.json['results'], [
+            {'dive_site.name': 'Stats site 0', 'count': 1},
+            {'dive_site.name': 'Stats site 1', 'count': 2},
+        ])
+        r = self.client.get('/api/v1/stats/samples?group_by=divers.last_name')
+        self.assertEqual(r.json['results'], [
+            {'divers.last_name': None, 'count': 1},
+            {'divers.last_name': 'Diver0', 'count': 2},
+            {'divers.last_name': 'Diver1', 'count': 1},
+        ])
+        r = self.client.get('/api/v1/stats/fractions?group_by=extract.library_abbrev')
+        self.assertEqual(r.json['results'], [{'extract.library_abbrev': 'STA', 'count': 6}])
+
+    def test_filters_and_cache(self):
+        url = '/api/v1/stats/samples?group_by=collection_year&dive_site.name=Stats site 1'
+        r = self.client.get(url)
+        self.assertEqual([x['count'] for x in r.json['results']], [1, 1])
+        etag = r.headers['ETag']
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 304)
+        with session_scope() as sess:
+            sess.query(DiveSite).filter_by(name='Stats site 0').one().notes = 'changed'
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_invalid(self):
+        for url in ('/api/v1/stats/unknown?group_by=id', '/api/v1/stats/samples',
+                    '/api/v1/stats/samples?group_by=unknown', '/api/v1/stats/samples?group_by=id&agg=median(depth_ft)',
+                    '/api/v1/stats/samples?group_by=id&agg=avg(name)',
+                    '/api/v1/stats/samples?group_by=divers,isolates'):
+            r = self.client.get(url)
+            self.assertIn(r.status_code, (400, 404), url)
+
+
+geo_sites = [
+    DiveSite(name='Geo Halifax', lat=44.65, lon=-63.57),
+    DiveSite(name='Geo Dartmouth', lat=44.67, lon=-63.57),
+    DiveSite(name='Geo Sable', lat=43.93, lon=-59.91),
+    DiveSite(name='Geo Fiji east', lat=-17.0, lon=179.9),
+    DiveSite(name='Geo Fiji west', lat=-17.0, lon=-179.9),
+    DiveSite(name='Geo Lisbon', lat=38.7, lon=-9.1),
+]
+geo_samples = [
+    Sample(name='Geo sample 1', collection_number=1, collection_year=2020, dive_site=geo_sites[0]),
+    Sample(name='Geo sample 2', collection_number=2, collection_year=2020, dive_site=geo_sites[3]),
+    Sample(name='Geo sample 3', collection_number=3, collection_year=2020, dive_site=geo_sites[5]),
+]
+
+
+class TestGeo(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add_all(geo_sites + geo_samples)
+
+    def names(self, url):
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 200, r.json)
+        return [x['name'] for x in r.json]
+
+    def test_bbox(self):
+        names = self.names('/api/v1/divesites?bbox=-64,44,-63,45')
+        self.assertEqual(sorted(names), ['Geo Dartmouth', 'Geo Halifax'])
+        # West > east crosses the antimeridian
+        names = self.names('/api/v1/divesites?bbox=179,-18,-179,-16')
+        self.assertEqual(sorted(names), ['Geo Fiji east', 'Geo Fiji west'])
+        names = self.names('/api/v1/divesites?bbox=-180,-90,180,90&name[like]=Geo%')
+        self.assertEqual(len(names), 6)
+
+    def test_radius(self):
+        names = self.names('/api/v1/divesites?near=44.65,-63.57&radius_km=5')
+        self.assertEqual(names, ['Geo Halifax', 'Geo Dartmouth'])
+        names = self.names('/api/v1/divesites?near=44.66,-63.57&radius_km=0.5')
+        self.assertEqual(names, [])
+
+    def test_nearest(self):
+        names = self.names('/api/v1/divesites?near=44.0,-60.0&k=3')
+        self.assertEqual(names, ['Geo Sable', 'Geo Halifax', 'Geo Dartmouth'])
+        names = self.names('/api/v1/divesites?near=-17.0,179.95&k=2')
+        self.assertEqual(names, ['Geo Fiji east', 'Geo Fiji west'])
+        names = self.names('/api/v1/divesites?near=44.0,-60.0&k=3&radius_km=100')
+        self.assertEqual(names, ['Geo Sable'])
+        # Explicit sort overrides distance order
+        names = self.names('/api/v1/divesites?near=44.0,-60.0&k=3&sort=name')
+        self.assertEqual(names, ['Geo Dartmouth', 'Geo Halifax', 'Geo Sable'])
+
+    def test_nearest_paginated(self):
+        for query in ['limit=2', 'after=1', 'stream=ndjson']:
+            r = self.client.get(f'/api/v1/divesites?near=44.0,-60.0&k=3&{query}')
+            self.assertEqual(r.status_code, 400, query)
+        r = self.client.get('/api/v1/divesites?near=44.0,-60.0&k=3&sort=name&limit=2')
+        self.assertEqual([x['name'] for x in r.json['results']], ['Geo Dartmouth', 'Geo Halifax'])
+
+    def test_samples(self):
+        names = self.names('/api/v1/samples?bbox=170,-20,-60,50')
+        self.assertEqual(sorted(names), ['Geo sample 1', 'Geo sample 2'])
+        names = self.names('/api/v1/samples?near=38.0,-9.0&k=2')
+        self.assertEqual(names, ['Geo sample 3', 'Geo sample 1'])
+
+    def test_invalid(self):
+        for query in ['bbox=1,2,3', 'bbox=a,b,c,d', 'bbox=0,10,1,5', 'bbox=0,-95,1,0',
+                      'k=3', 'radius_km=3', 'near=44.0', 'near=100,0&k=1',
+                      'near=44,-60', 'near=44,-60&k=0', 'near=44,-60&radius_km=-1']:
+            r = self.client.get(f'/api/v1/divesites?{query}')
+            self.assertEqual(r.status_code, 400, query)
+
+    def test_duplicate(self):
+        site = {'name': 'Lisbon again', 'lat': 38.7002, 'lon': -9.1002}
+        r = self.client.post('/api/v1/divesites', json=site)
+        self.assertEqual(r.status_code, 409)
+        self.assertIn('/api/v1/divesites/', r.json['message'])
+        r = self.client.post('/api/v1/divesites?force=true', json=site)
+        self.assertEqual(r.status_code, 201)
+
+    def test_bulk_duplicate(self):
+        sites = [{'name': 'Bulk Lisbon', 'lat': 38.7001, 'lon': -9.1001},
+                 {'name': 'Bulk far', 'lat': -30.0, 'lon': 80.0},
+                 {'name': 'Bulk far again', 'lat': -30.0001, 'lon': 80.0001}]
+        r = self.client.post('/api/v1/divesites', json=sites)
+        self.assertEqual(r.status_code, 409)
+        results = r.json['results']
+        self.assertEqual([x['status'] for x in results], [409, 424, 409])
+        self.assertIn('/api/v1/divesites/', results[0]['error'])
+        self.assertIn('items 1', results[2]['error'])
+        r = self.client.post('/api/v1/divesites?atomic=false', json=sites)
+        self.assertEqual([x['status'] for x in r.json['results']], [409, 201, 409])
+        r = self.client.post('/api/v1/divesites?force=1', json=sites[2:])
+        self.assertEqual(r.status_code, 201)
+
+    def test_geohash(self):
+        r = self.client.post('/api/v1/divesites', json={'name': 'New site', 'lat': 57.64911, 'lon': 10.40744})
+        self.assertEqual(r.status_code, 201)
+        id_ = r.json['id']
+        with session_scope() as sess:
+            site = sess.query(DiveSite).get(id_)
+            self.assertEqual(site.geohash, 'u4pruydqq')
+            site.lat = 0.0
+            site.lon = 0.0
+        with session_scope() as sess:
+            self.assertEqual(sess.query(DiveSite).get(id_).geohash, 's00000000')
+
+
+def random_sequence(rng, n=1500):
+    return ''.join(rng.choice('ACGT') for _ in range(n))
+
+
+def mutate(rng, sequence, rate):
+    return ''.join(rng.choice('ACGT') if rng.random() < rate else x for x in sequence)
+
+
+similar_rng = random.Random(21)
+similar_base = random_sequence(similar_rng)
+similar_isolates = [
+    Isolate(name='Similar base', sequence=similar_base),
+    Isolate(name='Similar close', sequence=mutate(similar_rng, similar_base, 0.02)),
+    Isolate(name='Similar far', sequence=mutate(similar_rng, similar_base, 0.15)),
+    Isolate(name='Similar unrelated', sequence=random_sequence(similar_rng)),
+    Isolate(name='Similar empty'),
+]
+
+
+class TestSimilarIsolates(MyTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.index_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+        cls.app.sequence_index = SequenceIndex(cls.index_file)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        os.remove(cls.index_file)
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add_all(similar_isolates)
+        with session_scope() as sess:
+            self.app.sequence_index.build(lambda after: iter_isolate_sequences(after, sess=sess))
+
+    def similar(self, sequence, **kwargs):
+        r = self.client.post('/api/v1/isolates/similar', json=dict(sequence=sequence, **kwargs))
+        self.assertEqual(r.status_code, 200, r.json)
+        return r.json['results']
+
+    def test_similar(self):
+        results = self.similar(similar_base)
+        self.assertEqual([x['name'] for x in results[:3]], ['Similar base', 'Similar close', 'Similar far'])
+        self.assertEqual(results[0]['identity'], 1.0)
+        self.assertGreater(results[1]['identity'], 0.95)
+        self.assertGreater(results[1]['identity'], results[2]['identity'])
+        self.assertTrue(results[0]['link'].startswith('/api/v1/isolates/'))
+        # Reverse complement matches as well
+        reverse = similar_base.translate(str.maketrans('ACGT', 'TGCA'))[::-1]
+        self.assertEqual(self.similar(reverse, limit=1)[0]['name'], 'Similar base')
+
+    def test_added(self):
+        sequence = random_sequence(random.Random(1))
+        r = self.client.post('/api/v1/isolates', json={
+            'name': 'Similar posted', 'sequence': sequence, 'stock': {'box': 1}})
+        self.assertEqual(r.status_code, 201, r.json)
+        self.assertEqual(self.similar(sequence)[0]['name'], 'Similar posted')
+        # Changed sequences are sketched again, in every worker sharing the file
+        other = SequenceIndex(self.index_file)
+        self.assertTrue(other.is_built())
+        changed = random_sequence(random.Random(2))
+        self.assertEqual(other.search(sequence, 1)[0]['id'], r.json['id'])
+        with self.app.app_context(), session_scope() as sess:
+            sess.query(Isolate).get(r.json['id']).sequence = changed
+        results = self.similar(sequence)
+        self.assertNotIn('Similar posted', [x['name'] for x in results])
+        self.assertEqual(other.search(changed, 1)[0]['id'], r.json['id'])
+
+    def test_build(self):
+        index = SequenceIndex(tempfile.NamedTemporaryFile(suffix='.db', delete=False).name)
+        try:
+            # Searches wait for the index built offline
+            self.app.sequence_index, saved = index, self.app.sequence_index
+            r = self.client.post('/api/v1/isolates/similar', json={'sequence': similar_base})
+            self.assertEqual(r.status_code, 503)
+            # An interrupted build resumes after the last committed batch
+            with session_scope() as sess:
+                batches = iter_isolate_sequences(batch_size=2, sess=sess)
+                with self.assertRaises(KeyboardInterrupt):
+                    index.build(lambda after: chain([next(batches)], iter(self.interrupt, None)))
+                self.assertFalse(index.is_built())
+                resumed = []
+                def resume_batches(after):
+                    resumed.append(after)
+                    return iter_isolate_sequences(after, 2, sess)
+                index.build(resume_batches)
+            self.assertGreater(resumed[0], 0)
+            self.assertEqual(self.similar(similar_base)[0]['name'], 'Similar base')
+        finally:
+            self.app.sequence_index = saved
+            os.remove(index.path)
+
+    def interrupt(self):
+        raise KeyboardInterrupt
+
+    def test_invalid(self):
+        for data in [None, {}, {'sequence': 1}, {'sequence': 'ACGTN' * 5},
+                     {'sequence': similar_base, 'limit': 0}, {'sequence': similar_base, 'limit': 'a'}]:
+            r = self.client.post('/api/v1/isolates/similar', json=data)
+            self.assertEqual(r.status_code, 400, data)
+
+
+search_library = Library(abbrev='SRC', name='Search library', description='Coral reef extracts')
+search_samples = [
+    Sample(name='Search sample 1', collection_number=1, collection_year=2019,
+           notes='Collected on a coral reef near the wall'),
+    Sample(name='Search sample 2', collection_number=2, collection_year=2019,
+           notes='Sponge from a sandy bottom'),
+    Sample(name='Search sample 3', collection_number=3, collection_year=2019,
+           notes='reef reef reef'),
+]
+search_permit = Permit(name='Search permit', iss_auth='DFO', notes='Reef sampling permit')
+search_site = DiveSite(name='Reefs end', lat=5.0, lon=5.0)
+
+
+class TestSearch(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add_all(search_samples + [search_library, search_permit, search_site])
+
+    def search(self, query):
+        r = self.client.get(f'/api/v1/search?{query}')
+        self.assertEqual(r.status_code, 200, r.json)
+        return r.json
+
+    def links(self, query):
+        return sorted(x['link'] for x in self.search(query)['results'])
+
+    def test_search(self):
+        results = self.search('q=coral')['results']
+        self.assertEqual(sorted((x['resource'], x['id']) for x in results),
+                         [('libraries', 'SRC'), ('samples', 1)])
+        self.assertIn('/api/v1/libraries/SRC', [x['link'] for x in results])
+        # Every word must match
+        self.assertEqual(self.links('q=coral wall'), ['/api/v1/samples/1'])
+        self.assertEqual(self.links('q=coral sponge'), [])
+
+    def test_words(self):
+        # Stemmed, case insensitive
+        self.assertEqual(self.links('q=REEFS'), [
+            '/api/v1/divesites/1', '/api/v1/libraries/SRC', '/api/v1/permits/1',
+            '/api/v1/samples/1', '/api/v1/samples/3'])
+        self.assertEqual(self.links('q=spon*'), ['/api/v1/samples/2'])
+
+    def test_ranking(self):
+        results = self.search('q=reef&resource=samples')['results']
+        self.assertEqual([x['id'] for x in results], [3, 1])
+        self.assertGreater(results[0]['score'], results[1]['score'])
+
+    def test_resource(self):
+        self.assertEqual(self.links('q=reef&resource=permits,divesites'),
+                         ['/api/v1/divesites/1', '/api/v1/permits/1'])
+        for query in ['q=reef&resource=fractions', 'q=reef&resource=nope', 'q=', 'q=%20*',
+                      'q=reef&limit=0', 'q=reef&after=nope']:
+            r = self.client.get(f'/api/v1/search?{query}')
+            self.assertEqual(r.status_code, 400, query)
+
+    def test_pagination(self):
+        expected = self.search('q=reef')['results']
+        results = []
+        url = '/api/v1/search?q=reef&limit=2'
+        while url:
+            r = self.client.get(url)
+            self.assertEqual(r.status_code, 200, r.json)
+            results += r.json["results"]
+            url = r.json['next']
+        self.assertEqual(results, expected)
+        self.assertEqual(len(results), 5)
+
+    def test_changes(self):
+        r = self.client.post('/api/v1/divesites', json={
+            'name': 'Search new site', 'lat': 6.0, 'lon': 6.0, 'notes': 'Lionfish everywhere'})
+        link = r.json['link']
+        self.assertEqual(self.links('q=lionfish'), [link])
+        with session_scope() as sess:
+            sess.query(DiveSite).get(r.json['id']).notes = 'Barracuda'
+        self.assertEqual(self.links('q=lionfish'), [])
+        self.assertEqual(self.links('q=barracuda'), [link])
+        with session_scope() as sess:
+            sess.delete(sess.query(DiveSite).get(r.json['id']))
+        self.assertEqual(self.links('q=barracuda'), [])
+
+    def test_mysql_without_index(self):
+        terms = parse_search('coral')
+        query = fulltext_query('mysql', terms, ['sample', 'library'], 10, indexed={'sample'})
+        sql = str(query.compile(dialect=mysql.dialect()))
+        self.assertIn('MATCH (sample.name', sql)
+        self.assertNotIn('MATCH (library.name', sql)
+        self.assertIn('library.description LIKE', sql)
+        # The LIKE fallback is plain SQL, run it here
+        query = fulltext_query('mysql', parse_search('coral wall'), ['sample', 'library'], 10, indexed=set())
+        with session_scope() as sess:
+            self.assertEqual([tuple(x) for x in sess.execute(query)], [('sample', '1', 0)])
+            query = fulltext_query('mysql', terms, ['sample', 'library'], 10, indexed=set())
+            self.assertEqual(sorted(x.resource for x in sess.execute(query)), ['library', 'sample'])
+
+
+layout_library = Library(abbrev='LAY', name='Layout library')
+layout_extracts = [Extract(number=i, library=layout_library) for i in (1, 2)]
+layout_plate = ScreenPlate(name='Layout plate', well_format=96)
+layout_plates = [layout_plate, ScreenPlate(name='Layout empty', well_format=1536),
+                 ScreenPlate(name='Layout unknown format')]
+layout_fractions = [
+    Fraction(code=code, extract=layout_extracts[i],
+             fraction_screen_plates=[FractionScreenPlate(screen_plate=layout_plate, well=well)])
+    for well, i, code in [('B3', 0, 'A'), ('A12', 1, 'B'), ('A01', 0, 'B'), ('H12', 1, 'A'),
+                          ('Z99', 0, 'C'), ('pool', 0, 'D'), ('C5', 1, 'C'), ('c5', 1, 'D')]
+]
+
+
+class TestPlateLayout(MyTestCase):
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add_all(layout_plates + layout_fractions)
+            self.ids = dict(sess.query(ScreenPlate.name, ScreenPlate.id).filter(
+                ScreenPlate.name.like('Layout%')))
+
+    def layout(self, name, query=''):
+        r = self.client.get(f'/api/v1/screenplates/{self.ids[name]}/layout{query}')
+        self.assertEqual(r.status_code, 200, r.json)
+        return r.json
+
+    def test_parse_well(self):
+        self.assertEqual(parse_well('A1'), (0, 0))
+        self.assertEqual(parse_well('h12'), (7, 11))
+        self.assertEqual(parse_well('P024'), (15, 23))
+        self.assertEqual(parse_well('AF48'), (31, 47))
+        self.assertIsNone(parse_well('pool'))
+        self.assertIsNone(parse_well('A0'))
+
+    def test_layout(self):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        engines = {Session().get_bind(), self.app.engine}
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            data = self.layout('Layout plate')
+        finally:
+            for engine in engines:
+                event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(len([x for x in statements if 'fraction_screen_plate' in x]), 1)
+        self.assertEqual(data['well_format'], 96)
+        wells = data['wells']
+        self.assertEqual([x['well'] for x in wells],
+                         ['A01', 'A12', 'B3', 'C5', 'c5', 'H12', 'Z99', 'pool'])
+        self.assertEqual((wells[1]['row'], wells[1]['column']), (0, 11))
+        self.assertEqual((wells[-1]['row'], wells[-1]['column']), (None, None))
+        self.assertEqual(wells[1]['fraction'], 'RLLAY-0002B')
+        self.assertEqual(wells[1]['extract'], 'RLLAY-0002')
+        self.assertEqual(wells[1]['library'], 'LAY')
+        self.assertEqual(wells[1]['library_name'], 'Layout library')
+
+    def test_grid(self):
+        data = self.layout('Layout plate', '?format=grid')
+        self.assertEqual((data['rows'], data['columns']), (8, 12))
+        grid = data['grid']
+        self.assertEqual(len(grid), 8)
+        self.assertEqual(grid[0][0], 'RLLAY-0001B')
+        self.assertEqual(grid[1][2], 'RLLAY-0001A')
+        self.assertEqual(grid[2][4], ['RLLAY-0002C', 'RLLAY-0002D'])
+        self.assertEqual(grid[7][11], 'RLLAY-0002A')
+        self.assertIsNone(grid[7][10])
+        self.assertEqual([x['well'] for x in data['unplaced']], ['Z99', 'pool'])
+
+    def test_empty(self):
+        data = self.layout('Layout empty', '?format=grid')
+        self.assertEqual((data['rows'], data['columns']), (32, 48))
+        self.assertTrue(all(x is None for row in data['grid'] for x in row))
+        self.assertEqual(self.layout('Layout empty')['wells'], [])
+
+    def test_invalid(self):
+        r = self.client.get(f"/api/v1/screenplates/{self.ids['Layout unknown format']}/layout?format=grid")
+        self.assertEqual(r.status_code, 400)
+        r = self.client.get(f"/api/v1/screenplates/{self.ids['Layout plate']}/layout?format=nope")
+        self.assertEqual(r.status_code, 400)
+        for id_ in ['999', 'abc']:
+            r = self.client.get(f'/api/v1/screenplates/{id_}/layout')
+            self.assertEqual(r.status_code, 404)
+
+
+asgi_divers = [Diver(first_name='Asgi', last_name=f'Diver{i}') for i in range(5)]
+
+
+def http_scope(method, path, query=b'', headers=()):
+    return {'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http',
+            'path': path, 'query_string': query, 'headers': list(headers),
+            'server': ('localhost', 80), 'client': ('127.0.0.1', 5000)}
+
+
+class TestAsgi(MyTestCase):
+
+    def setUp(self):
+        self.asgi = AsgiAdapter(self.app, threads=2, send_buffer=1)
+        self.app.config['STREAM_CHUNK_SIZE'] = 2
+        # Tear down the request of a response closed early, as in production
+        self.app.config['PRESERVE_CONTEXT_ON_EXCEPTION'] = False
+        with session_scope() as sess:
+            sess.add_all(asgi_divers)
+
+    def run_asgi(self, scope, messages, send=None):
+        sent = []
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await asyncio.sleep(3600)
+        async def default_send(message):
+            sent.append(message)
+        async def run():
+            await asyncio.wait_for(self.asgi(scope, receive, send or default_send), 10)
+        asyncio.run(run())
+        return sent
+
+    def tearDown(self):
+        self.asgi.executor.shutdown(wait=True)
+        super().tearDown()
+
+    def test_lifespan(self):
+        sent = self.run_asgi({'type': 'lifespan'}, [
+            {'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+        self.assertEqual([x['type'] for x in sent],
+                         ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+
+    def test_chunked_body(self):
+        body = json.dumps({'name': 'Asgi site', 'lat': 7.0, 'lon': 7.0}).encode()
+        sent = self.run_asgi(
+            http_scope('POST', '/api/v1/divesites', headers=[(b'content-type', b'application/json')]),
+            [{'type': 'http.request', 'body': body[:10], 'more_body': True},
+             {'type': 'http.request', 'body': body[10:], 'more_body': False}])
+        self.assertEqual(sent[0]['status'], 201)
+        self.assertTrue(json.loads(b''.join(x.get('body', b'') for x in sent[1:]))['success'])
+
+    def test_stream(self):
+        sent = self.run_asgi(http_scope('GET', '/api/v1/divers', b'stream=ndjson&last_name[like]=Diver%'),
+                             [{'type': 'http.request'}])
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn((b'content-type', b'application/x-ndjson'), sent[0]['headers'])
+        chunks = [x['body'] for x in sent[1:] if x['body']]
+        self.assertGreater(len(chunks), 1)
+        lines = b''.join(chunks).decode().splitlines()
+        self.assertEqual([json.loads(x)['last_name'] for x in lines], [f'Diver{i}' for i in range(5)])
+        self.assertFalse(sent[-1]['more_body'])
+
+    def test_disconnect(self):
+        # A client going away stops the thread producing the response
+        async def send(message):
+            if message['type'] == 'http.response.body':
+                raise ConnectionResetError
+        with self.assertRaises(ConnectionResetError):
+            self.run_asgi(http_scope('GET', '/api/v1/divers', b'stream=ndjson'),
+                          [{'type': 'http.request'}], send)
+
+
+replica_divers = [Diver(first_name='Replica', last_name=f'Diver{i}') for i in range(3)]
+
+
+class TestReplicas(MyTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.replica_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+        cls.pin_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+        cls.app.config.update(REPLICA_DATABASE_URIS=[f'sqlite:///{cls.replica_file}'],
+                              REPLICA_PIN_FILE=cls.pin_file, REPLICA_LAG_CHECK=3600)
+        cls.app.replicas = ReplicaRouter(cls.app.engine, cls.app.config)
+        cls.replica = cls.app.replicas.engines[0]
+        Base.metadata.create_all(bind=cls.replica)
+        # Responses of the primary and replica differ at equal table versions
+        cls.app.response_cache = None
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.replica.dispose()
+        os.remove(cls.replica_file)
+        os.remove(cls.pin_file)
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        with session_scope() as sess:
+            sess.add_all(replica_divers)
+        # Replicate, then add a row only found on the replica
+        with self.app.engine.connect() as primary, self.replica.begin() as replica:
+            for table in (Diver.__table__, TableVersion.__table__):
+                replica.execute(table.delete())
+                replica.execute(table.insert(), [dict(x) for x in primary.execute(table.select())])
+            replica.execute(Diver.__table__.insert(), first_name='Replica', last_name='Only')
+        with sqlite3.connect(self.pin_file) as conn:
+            conn.execute("DELETE FROM pin")
+        self.app.replicas.check()
+
+    def last_names(self, **kwargs):
+        r = self.client.get('/api/v1/divers?first_name=Replica', **kwargs)
+        self.assertEqual(r.status_code, 200)
+        return {x['last_name'] for x in r.json}
+
+    def test_reads_replica(self):
+        self.assertIn('Only', self.last_names())
+        only = self.replica.execute("SELECT id FROM diver WHERE last_name = 'Only'").scalar()
+        self.assertEqual(self.client.get(f'/api/v1/divers/{only}').status_code, 200)
+        count = self.replica.execute("SELECT count(*) FROM diver WHERE first_name = 'Replica'").scalar()
+        r = self.client.head('/api/v1/divers?first_name=Replica')
+        self.assertEqual(r.headers['X-Total-Count'], str(count))
+
+    def test_read_your_writes(self):
+        r = self.client.post('/api/v1/divers', json={'first_name': 'Replica', 'last_name': 'Posted'})
+        self.assertEqual(r.status_code, 201, r.json)
+        self.assertIn(self.app.config['REPLICA_PIN_COOKIE'], r.headers['Set-Cookie'])
+        names = self.last_names()
+        self.assertIn('Posted', names)
+        self.assertNotIn('Only', names)
+        # Other clients still read the replica, even from the same address
+        other = self.app.test_client().get('/api/v1/divers?first_name=Replica')
+        names = {x['last_name'] for x in other.json}
+        self.assertIn('Only', names)
+        self.assertNotIn('Posted', names)
+        # Until the pin expires
+        self.app.replicas.pin_seconds = 0
+        try:
+            self.client.post('/api/v1/divers', json={'first_name': 'Replica', 'last_name': 'Expired'})
+            self.assertIn('Only', self.last_names())
+        finally:
+            self.app.replicas.pin_seconds = self.app.config['REPLICA_PIN_SECONDS']
+
+    def test_lagging_replica(self):
+        table = TableVersion.__table__
+        missed = datetime.datetime.utcnow() - datetime.timedelta(seconds=60)
+        with self.app.engine.begin() as conn:
+            conn.execute(table.update().where(table.c.name == 'diver')
+                         .values(version=table.c.version + 1, modified=missed))
+        self.app.replicas.check()
+        self.assertNotIn('Only', self.last_names())
+        self.assertGreaterEqual(self.app.replicas.lags[0], 60)
+        # A recent change not yet replicated is within the allowed lag
+        with self.app.engine.begin() as conn:
+            conn.execute(table.update().where(table.c.name == 'diver')
+                         .values(modified=datetime.datetime.utcnow()))
+        self.app.replicas.check()
+        self.assertIn('Only', self.last_names())
+
+    def test_unreachable_replica(self):
+        router = self.app.replicas
+        self.app.replicas = ReplicaRouter(self.app.engine, dict(
+            self.app.config, REPLICA_DATABASE_URIS=['sqlite:////nonexistent/replica.db']))
+        try:
+            self.app.replicas.check()
+            self.assertNotIn('Only', self.last_names())
+            self.assertEqual(self.app.replicas.lags, [None])
+        finally:
+            self.app.replicas = router
+
+    def test_background_check(self):
+        router = ReplicaRouter(self.app.engine, self.app.config)
+        # Requests do not wait for the check, they read the primary until it ran
+        self.assertIsNone(router.replica())
+        for _ in range(100):
+            if not router.checking:
+                break
+            time.sleep(0.05)
+        self.assertEqual(router.lags, [0])
+        self.assertIs(router.replica(), router.engines[0])
+        router.engines[0].dispose()